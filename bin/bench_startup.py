@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+Measures the cold-start time of each f5aws subcommand: every run is a new
+python process, as when the command is typed in a shell.
+
+Usage:
+  python bin/bench_startup.py [ENVIRONMENT] [-n RUNS]
+
+The read-only commands (list, info ...) are run against ENVIRONMENT (the
+first environment found by default).  The commands which change an
+environment are only run with -h, which measures the imports they need
+before doing any work.  For each command the heavy modules which were
+loaded (ansible.playbook, ansible.inventory, boto, yaml) are shown too.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+BIN_PATH = os.path.dirname(os.path.abspath(__file__))
+INSTALL_PATH = os.path.dirname(BIN_PATH)
+
+HEAVY_MODULES = ['ansible.playbook', 'ansible.inventory', 'ansible.callbacks',
+  'boto', 'yaml']
+
+# runs bin/f5aws and reports the heavy modules loaded on the last line of
+#  stderr
+RUNNER = """
+import sys, json, runpy
+sys.argv = %(argv)r
+try:
+  runpy.run_path(%(script)r, run_name='__main__')
+except SystemExit:
+  pass
+sys.stderr.write('\\n' + json.dumps(
+  [m for m in %(heavy)r if sys.modules.get(m)]) + '\\n')
+"""
+
+def get_commands(env_name):
+  read_only = [['list']]
+  if env_name:
+    read_only += [['info', cmd, env_name] for cmd in
+      ['inventory', 'resources', 'login', 'timeline']]
+  read_only += [['stats']]
+  changing = [[cmd, '-h'] for cmd in ['init', 'deploy', 'deploy-many',
+    'teardown', 'start_traffic', 'stop_traffic', 'remove']]
+  return read_only + changing
+
+def run_once(argv):
+  script = os.path.join(BIN_PATH, 'f5aws')
+  code = RUNNER % {'argv': [script] + argv, 'script': script,
+    'heavy': HEAVY_MODULES}
+  # cold start: the start of python itself is timed as well
+  start = time.time()
+  proc = subprocess.Popen([sys.executable, '-c', code], cwd=INSTALL_PATH,
+    stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE)
+  stderr = proc.communicate()[1]
+  return time.time() - start, json.loads(stderr.strip().splitlines()[-1])
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('env_name', metavar='ENVIRONMENT', nargs='?',
+    default=None, help='environment used by the info commands')
+  parser.add_argument('-n', '--runs', type=int, default=5,
+    help='number of runs of each command')
+  args = parser.parse_args()
+
+  env_name = args.env_name
+  if env_name is None:
+    env_path = os.path.expanduser('~/vars/f5aws/env')
+    envs = sorted(os.listdir(env_path)) if os.path.isdir(env_path) else []
+    env_name = envs[0] if envs else None
+
+  print '{:<32} {:>8} {:>8}  {}'.format('command', 'median', 'min', 'heavy modules')
+  for argv in get_commands(env_name):
+    results = [run_once(argv) for i in range(args.runs)]
+    times = sorted(t for t, modules in results)
+    print '{:<32} {:>7.3f}s {:>7.3f}s  {}'.format(' '.join(argv),
+      times[len(times) / 2], times[0], ', '.join(results[-1][1]))
+
+if __name__ == '__main__':
+  main()
@@ -6,47 +6,322 @@ Ansible module for managing configuration resources on BIG-IP over iControlRest.
 It handles some of this subtleties encountered when dealing with 
 provisioning objects using iControlRest, and aims to provide some level of idempotence. 
 Some of the gotchas when using the "patch" method are documented in _get_safe_patch_payload()
+
+A resource which exists is read first and only patched when it differs from the
+payload, see get_differences(), so the task reports changed only when a request
+changed the BIG-IP.
+
+Several resources can be configured by one task with the `resources` parameter,
+a list of items each taking name, state, collection_path, payload (a json string
+or a dict), payload_file, resource_id and resource_key.  They share one
+session to the BIG-IP and are applied in order, stopping at the first failure,
+or `parallel` at a time when they do not depend on each other:
+
+  bigip_config:
+    host: "{{ ansible_ssh_host }}"
+    user: "{{ bigip_rest_user }}"
+    password: "{{ bigip_rest_password }}"
+    parallel: 4
+    resources:
+      - collection_path: mgmt/tm/sys/ntp
+        payload: {"servers": ["0.pool.ntp.org"]}
+      - collection_path: mgmt/tm/ltm/profile/tcp
+        resource_key: name
+        payload: {"name": "tcp-ssl-lan-optimized", "nagle": "disabled"}
+
+Settings which restart httpd, such as mgmt/tm/sys/httpd, interrupt the REST
+API and should not be applied alongside others.
+
+With `transaction: yes` the creates, updates and deletes of the items are
+queued in one iControlRest transaction (mgmt/tm/transaction) and committed
+at once, so mcpd validates and saves the configuration once for the whole
+task.  If an item fails, or the commit does, none of the items are changed.
+The items are then applied one at a time, and the asynchronous ASM tasks and
+the draft handling of LTM policies cannot be part of a transaction.
 """
 
 import os
 import sys
 import json
+import time
 import requests
+import threading
 from copy import deepcopy
 from time import localtime, strftime
+from multiprocessing.pool import ThreadPool
 
 from requests.exceptions import ConnectionError, HTTPError, Timeout, TooManyRedirects
 
+# tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 60
+# lifetime of a token when the login response does not say, in seconds
+DEFAULT_TOKEN_TIMEOUT = 1200
+# how long to wait for a transaction to be validated and committed, in seconds
+TRANSACTION_TIMEOUT = 300
+# the collections which cannot be configured in a transaction
+NON_TRANSACTIONAL_PATHS = ["mgmt/tm/asm/", "mgmt/tm/ltm/policy"]
+# the fields which the BIG-IP fills in, they are not compared to the payload
+SERVER_FIELDS = ["kind", "selfLink", "generation", "lastUpdateMicros",
+  "fullPath", "id"]
+# the values of the fields the BIG-IP omits when they are unset
+UNSET_VALUES = ["", "none", [], {}]
+
 class NoChangeError(Exception):
   pass
 
+def normalize(value):
+  """Ignores the formatting differences between a payload and the BIG-IP"""
+  if isinstance(value, basestring):
+    value = value.strip()
+    # names are returned with their partition, e.g. /Common/analytics
+    if value.startswith("/Common/"):
+      value = value[len("/Common/"):]
+    return value
+  if isinstance(value, (bool, int, long, float)):
+    # e.g. "sessionTimeoutMinutes": "5" is returned as 5
+    return str(value).lower()
+  return value
+
+def matches(desired, current):
+  """Whether the current value of a field already is the desired value"""
+  if isinstance(desired, dict):
+    return isinstance(current, dict) and not get_differences(desired, current)
+  if isinstance(desired, list):
+    # the order of e.g. pool members or data-group records does not matter
+    if not isinstance(current, list) or len(desired) != len(current):
+      return False
+    remaining = list(current)
+    for value in desired:
+      for candidate in remaining:
+        if matches(value, candidate):
+          remaining.remove(candidate)
+          break
+      else:
+        return False
+    return True
+  return normalize(desired) == normalize(current)
+
+def get_differences(payload, current):
+  """
+    Returns the fields of payload whose value differs from the resource
+    current, as returned by the BIG-IP.  The fields the payload does not
+    give, and those of SERVER_FIELDS, are not compared.
+  """
+  differences = []
+  for key, value in payload.items():
+    if key in SERVER_FIELDS:
+      continue
+    if key in current:
+      current_value = current[key]
+    elif isinstance(current.get(key + "Reference"), dict):
+      # subcollections such as the members of a pool, see expandSubcollections
+      current_value = current[key + "Reference"].get("items", [])
+    elif normalize(value) in UNSET_VALUES:
+      continue
+    else:
+      differences.append(key)
+      continue
+    if not matches(value, current_value):
+      differences.append(key)
+  return sorted(differences)
+
+class BigipSession(object):
+  """
+    One keep-alive connection pool to a BIG-IP.  Instead of sending the
+    password with every request (basic auth, which BIG-IP checks through
+    PAM), we log in once through mgmt/shared/authn/login and send the
+    X-F5-Auth-Token we get back.  The token is refreshed shortly before it
+    expires, or when it is rejected.  Versions without token authentication
+    get basic auth.
+  """
+  def __init__(self, host, user, password):
+    self.hosturl = "https://%s" % host
+    self.user = user
+    self.password = password
+    self.session = requests.Session()
+    self.session.verify = False
+    self.session.headers["Content-Type"] = "application/json"
+    self.token_expires = 0
+    self.basic_auth = False
+    # batched resources may be applied from several threads
+    self.lock = threading.Lock()
+    # while set, changes are queued in this transaction, see begin_transaction()
+    self.transaction_id = None
+    # (collection_path, resource_key) => {key: item}, see list_collection()
+    self.collections = {}
+    self.collections_lock = threading.Lock()
+
+  def login(self, rejected_token=None):
+    with self.lock:
+      # another thread may have logged in while we waited
+      token = self.session.headers.get("X-F5-Auth-Token")
+      if self.basic_auth or (token is not None and token != rejected_token and
+          time.time() < self.token_expires - TOKEN_REFRESH_MARGIN):
+        return
+      self._login()
+
+  def _login(self):
+    self.session.headers.pop("X-F5-Auth-Token", None)
+    response = self.session.post("%s/mgmt/shared/authn/login" % self.hosturl,
+      data=json.dumps({"username": self.user, "password": self.password,
+        "loginProviderName": "tmos"}))
+    if response.status_code != requests.codes.ok:
+      # no token authentication on this version, bad credentials will
+      #  show up in the response to the actual request
+      self.basic_auth = True
+      self.session.auth = (self.user, self.password)
+      return
+
+    token = response.json()["token"]
+    self.session.headers["X-F5-Auth-Token"] = token["token"]
+    self.token_expires = time.time() + int(
+      token.get("timeout") or DEFAULT_TOKEN_TIMEOUT)
+
+  def request(self, method, uri, data=None):
+    if not self.basic_auth and time.time() > self.token_expires - TOKEN_REFRESH_MARGIN:
+      self.login()
+    url = "%s/%s" % (self.hosturl, uri)
+    # reads, e.g. existence checks, see the running configuration rather
+    #  than being queued
+    headers = {}
+    if self.transaction_id is not None and method.upper() != "GET":
+      headers["X-F5-REST-Coordination-Id"] = str(self.transaction_id)
+    token = self.session.headers.get("X-F5-Auth-Token")
+    response = self.session.request(method.upper(), url, data=data,
+      headers=headers)
+    if response.status_code == 401 and not self.basic_auth:
+      # the token was revoked, e.g. by a restart of restjavad
+      self.login(rejected_token=token)
+      response = self.session.request(method.upper(), url, data=data,
+        headers=headers)
+    return response
+
+  def is_listed(self, collection_path, resource_key):
+    return (collection_path, resource_key) in self.collections
+
+  def list_collection(self, collection_path, resource_key):
+    """
+      Returns {key: item} for the items of a collection, by their
+      resource_key.  Only the key, selfLink and fullPath of the items are
+      fetched, and each collection is listed once for all the resources
+      applied over this session.
+    """
+    with self.collections_lock:
+      if (collection_path, resource_key) not in self.collections:
+        response = self.request("get", "%s?$select=%s,selfLink,fullPath" % (
+          collection_path, resource_key))
+        if response.status_code != requests.codes.ok:
+          raise ValueError("Bad return code from HTTP GET %s: %s" % (
+            collection_path, response.text))
+        self.collections[(collection_path, resource_key)] = dict(
+          (item[resource_key], item) for item in response.json().get("items", [])
+          if resource_key in item)
+      return self.collections[(collection_path, resource_key)]
+
+  def update_collection(self, collection_path, resource_key, key, item):
+    """Adds a resource to the listing of its collection, or removes it if item is None"""
+    with self.collections_lock:
+      items = self.collections.get((collection_path, resource_key))
+      if items is None:
+        return
+      if item is None:
+        items.pop(key, None)
+      else:
+        items[key] = item
+
+  def begin_transaction(self):
+    """Queues the changes made from now on until commit_transaction()"""
+    response = self.request("post", "mgmt/tm/transaction", "{}")
+    response.raise_for_status()
+    self.transaction_id = response.json()["transId"]
+
+  def commit_transaction(self):
+    """
+      Commits the changes queued since begin_transaction(), returns None
+      once they are applied or the reason they were not.
+    """
+    uri = "mgmt/tm/transaction/%s" % self.transaction_id
+    self.transaction_id = None
+    try:
+      response = self.request("patch", uri, json.dumps({"state": "VALIDATING"}))
+      deadline = time.time() + TRANSACTION_TIMEOUT
+      while True:
+        if response.status_code != requests.codes.ok:
+          # the commands are validated as the commit is requested, an invalid
+          #  one fails the request
+          return "HTTP %s: %s" % (response.status_code, response.text)
+        transaction = response.json()
+        if transaction.get("state") == "COMPLETED":
+          return None
+        if transaction.get("state") == "FAILED":
+          return transaction.get("failureReason") or "transaction failed"
+        if time.time() > deadline:
+          return "transaction %s still %s after %ss" % (uri.split("/")[-1],
+            transaction.get("state"), TRANSACTION_TIMEOUT)
+        time.sleep(1)
+        response = self.request("get", uri)
+    except (ConnectionError, HTTPError, Timeout, TooManyRedirects), e:
+      return "transaction %s: %s" % (uri.split("/")[-1], e)
+
+  def abort_transaction(self):
+    """Drops the changes queued since begin_transaction()"""
+    uri = "mgmt/tm/transaction/%s" % self.transaction_id
+    self.transaction_id = None
+    # a transaction which is not committed expires anyway
+    try:
+      self.request("delete", uri)
+    except IOError:
+      pass
+
+# one session per BIG-IP and user for the lifetime of this module
+_sessions = {}
+
+def get_session(host, user, password):
+  if (host, user) not in _sessions:
+    _sessions[(host, user)] = BigipSession(host, user, password)
+  return _sessions[(host, user)]
+
+# the parameters of each item of `resources`
+RESOURCE_PARAMS = ["name", "state", "collection_path", "payload", "payload_file",
+  "resource_id", "resource_key"]
+
 class BigipConfig(object):
-  def __init__(self, module):
-    self.host = module.params["host"]
-    self.user = module.params["user"]
-    self.password = module.params["password"]
-    self.state = module.params["state"]
-    self.name = module.params["name"]
+  def __init__(self, params, check_mode=False):
+    self.host = params["host"]
+    self.user = params["user"]
+    self.password = params["password"]
+    self.state = params.get("state") or "present"
+    self.name = params.get("name") or ""
     #Need to parameterize partition
     self.partition = "Common"
 
     # use a file which includes the payload contents if 
     #  one was provided
-    if module.params["payload_file"]:
-      with open(os.path.expanduser(module.params["payload_file"]), "r") as f:
+    if params.get("payload_file"):
+      with open(os.path.expanduser(params["payload_file"]), "r") as f:
         self.payload = (json.load(f))
+    elif isinstance(params.get("payload"), (dict, list)):
+      # the items of `resources` may give the payload as yaml
+      self.payload = params["payload"]
     else:
       try: 
-        self.payload = json.loads(module.params.get("payload"))
+        self.payload = json.loads(params.get("payload"))
       except TypeError:
         self.payload = ""
 
-    self.resource_id = module.params.get("resource_id")
-    self.resource_key = module.params.get("resource_key")
-
-    self.collection_path = module.params["collection_path"]
+    self.resource_id = params.get("resource_id")
+    self.resource_key = params.get("resource_key")
+    self.resource_selfLink = None
+    self.resource_fullPath = None
+    # the resource as returned by the BIG-IP, see get_current_resource()
+    self.current_resource = None
+    # in check mode, changes are reported but not made
+    self.check_mode = check_mode
+    self.changed = False
+
+    self.collection_path = params["collection_path"]
     self.hosturl = "https://%s" % self.host
-    self.auth = (self.user, self.password)
+    self.session = get_session(self.host, self.user, self.password)
 
   def _get_full_resource_id(self):
     if self.resource_id is not None:
@@ -105,28 +380,51 @@ class BigipConfig(object):
 
     return safe_payload
 
+  def _get_resource_uri(self):
+    """
+      The uri of the resource, or None when it is not addressed by its
+      name, e.g. ASM objects, which are addressed by an id.
+    """
+    if (self.resource_key != "name" or not self.collection_path.startswith("mgmt/tm/")
+        or "mgmt/tm/asm/" in self.collection_path):
+      return None
+    if "application/" in self.collection_path:
+      return self._get_full_resource_path()
+    # e.g. /Common/Drafts/my-ltm-policy => ~Common~Drafts~my-ltm-policy
+    return "%s/%s" % (self.collection_path,
+      self.payload[self.resource_key].replace("/", "~"))
+
   def resource_exists(self):
     #for collections that we want to patch (for example sys/global-settings)
     # there is no resource_key which we can use to determine existance
     if self.resource_key is None:
       return False
 
-    exists = False
-    (rc, out, err) = self.http("get", self.collection_path)
-
-    if rc != 0:
-      raise ValueError("Bad return code from HTTP GET. %s " % err)
-
-    items = out.get("items", None)
-    if items is not None:
-      for i in items:
-        if self.resource_key in i:
-          if i[self.resource_key] == self.payload[self.resource_key]: 
-             exists = True
-             self.set_selfLink(i)
-             self.set_fullPath(i)
-             break
-    return exists
+    # fetch just this resource, rather than every item of its collection,
+    #  unless the collection was already listed
+    uri = self._get_resource_uri()
+    if uri is not None and not self.session.is_listed(self.collection_path,
+        self.resource_key):
+      response = self.session.request("get",
+        "%s?expandSubcollections=true" % uri)
+      if response.status_code == requests.codes.not_found:
+        return False
+      if response.status_code == requests.codes.ok:
+        item = response.json()
+        if item.get(self.resource_key) == self.payload[self.resource_key]:
+          self.set_selfLink(item)
+          self.set_fullPath(item)
+          self.current_resource = item
+          return True
+
+    item = self.session.list_collection(self.collection_path,
+      self.resource_key).get(self.payload[self.resource_key])
+    if item is None:
+      return False
+    if "selfLink" in item:
+      self.set_selfLink(item)
+    self.set_fullPath(item)
+    return True
 
   def set_selfLink(self, config_item):
     # self link looks like https://localhost/mgmt/tm/asm/policies/vsyrM5HMMpOHlSwDfs8mLA"
@@ -145,26 +443,57 @@ class BigipConfig(object):
      else: 
         return "/%s/%s" % ( self.partition, self.resource_key )
 
+  def get_current_resource(self, uri=None):
+    """
+      Returns the resource, with its subcollections, as it is configured on
+      the BIG-IP, or None if it cannot be read.  resource_exists() may
+      already have fetched it.
+    """
+    if uri is None and self.current_resource is not None:
+      return self.current_resource
+    uri = uri or self._get_full_resource_path()
+    (rc, out, err) = self.http("get", "%s%sexpandSubcollections=true" % (
+      uri, "&" if "?" in uri else "?"))
+    if rc != 0 or not isinstance(out, dict):
+      return None
+    self.current_resource = out
+    return out
+
+  def check_differences(self, payload, uri=None):
+    """Raises NoChangeError when the resource already matches payload"""
+    current = self.get_current_resource(uri)
+    if current is not None and not get_differences(payload, current):
+      raise NoChangeError("The resource already matches the payload")
+
   def create_or_update_resource(self):
-    # if it is a collection, we can just patch 
-    if "mgmt/tm/asm/tasks/" in self.collection_path:
-      return self.create_resource()
-    elif self.resource_key is None:
-      return self.http("patch", self.collection_path, self.payload)
-    else:
-      if self.resource_exists():
-        try:
-          return self.update_resource()
-        except NoChangeError, e:
-          rc = 0
-          out = 'No configuration changes necessary. {}'.format(e)
-          err = ''
-          return (rc, out, err)
-      else:
+    try:
+      # if it is a collection, we can just patch 
+      if "mgmt/tm/asm/tasks/" in self.collection_path:
         return self.create_resource()
+      elif self.resource_key is None:
+        self.check_differences(self.payload, self.collection_path)
+        return self.http("patch", self.collection_path, self.payload)
+      else:
+        if self.resource_exists():
+          return self.update_resource()
+        else:
+          return self.create_resource()
+    except NoChangeError, e:
+      rc = 0
+      # playbooks read e.g. the selfLink of the resource from out
+      out = self.current_resource or 'No configuration changes necessary. {}'.format(e)
+      err = ''
+      return (rc, out, err)
 
   def create_resource(self):
-    return self.http("post", self.collection_path, self.payload)
+    (rc, out, err) = self.http("post", self.collection_path, self.payload)
+    if rc == 0 and self.resource_key is not None:
+      # in a transaction, out describes the queued command
+      item = out if isinstance(out, dict) and "selfLink" in out else {
+        self.resource_key: self.payload[self.resource_key]}
+      self.session.update_collection(self.collection_path, self.resource_key,
+        self.payload[self.resource_key], item)
+    return (rc, out, err)
 
   def update_resource(self):
       if "mgmt/tm/ltm/policy" in self.collection_path and 'command' in self.payload:
@@ -177,23 +506,31 @@ class BigipConfig(object):
          draft_resource_path = "%s/~%s~Drafts~%s" % (self.collection_path, self.partition, self._get_full_resource_id())
          return self.http("patch", draft_resource_path, self.payload ) 
       else:
-         return self.http("patch", self._get_full_resource_path(),
-                self._get_safe_patch_payload())
+         safe_payload = self._get_safe_patch_payload()
+         self.check_differences(safe_payload)
+         return self.http("patch", self._get_full_resource_path(), safe_payload)
 
   def delete_resource(self):
-    return self.http("delete", self._get_full_resource_path())
+    (rc, out, err) = self.http("delete", self._get_full_resource_path())
+    if rc == 0:
+      self.session.update_collection(self.collection_path, self.resource_key,
+        self.payload[self.resource_key], None)
+    return (rc, out, err)
 
   def http(self, method, uri, payload=''):
     payload_str = json.dumps(payload)
-    methodfn = getattr(requests, method.lower(), None)
-    
-    if method is None:
-      raise NotImplementedError("requests module has not method %s " % method)
+    request = None
+
+    if method != "get" and self.check_mode:
+      # report the change without making it
+      self.changed = True
+      return (0, "", "")
+
     try:
       if payload:
-        request = methodfn(url='%s/%s' % (self.hosturl, uri), data=payload_str, auth=self.auth, verify=False)
+        request = self.session.request(method, uri, payload_str)
       else:
-        request = methodfn(url='%s/%s' % (self.hosturl, uri), auth=self.auth, verify=False)
+        request = self.session.request(method, uri)
 
       if request.status_code != requests.codes.ok:
         request.raise_for_status()
@@ -201,6 +538,8 @@ class BigipConfig(object):
       rc = 0
       out = json.loads(request.text)
       err = ''
+      if method != "get":
+        self.changed = True
     except (ConnectionError, HTTPError, Timeout, TooManyRedirects) as e:
       rc = 1
       out = ""
@@ -210,6 +549,139 @@ class BigipConfig(object):
 
     return (rc, out, err)
 
+def apply_resource(params, check_mode=False):
+  """
+    Brings one resource to the state asked for, returns the result of the
+    task (or of the item of `resources`).  The result has failed=True and
+    the error as msg when a request failed.
+  """
+  rc = None
+  out = ""
+  err = ""
+  bigip_config = None
+  result = {}
+  result["collection_path"] = params["collection_path"]
+  result["state"] = params.get("state") or "present"
+  if params.get("name"):
+    result["name"] = params["name"]
+
+  try:
+    bigip_config = BigipConfig(params, check_mode)
+    if bigip_config.state == "absent":
+      if bigip_config.resource_exists():
+        (rc, out, err) = bigip_config.delete_resource()
+    elif bigip_config.state == "present":
+      (rc, out, err) = bigip_config.create_or_update_resource()
+    elif bigip_config.state == "inspect":
+      (rc, out, err) = bigip_config.inspect()
+  except (IOError, ValueError), e:
+    # unreadable payload_file or payload, or a failed existence check
+    (rc, err) = (1, str(e))
+
+  if rc is not None and rc != 0:
+    result.update(failed=True, msg=err, rc=rc)
+
+  # only the requests which were sent and succeeded changed the BIG-IP
+  result["changed"] = bigip_config is not None and bigip_config.changed
+  if out:
+    result["out"] = out
+  if err:
+    result["err"] = err
+
+  return result
+
+def get_resources(params):
+  """The parameters of each item of `resources`, with those of the task"""
+  resources = []
+  for item in params["resources"]:
+    if not isinstance(item, dict):
+      raise ValueError("Each item of resources must be a dict, not %r" % (item,))
+    unknown = set(item) - set(RESOURCE_PARAMS)
+    if unknown:
+      raise ValueError("Unsupported parameters in resources: %s" % (
+        ", ".join(sorted(unknown))))
+    if item.get("resource_id") and item.get("resource_key"):
+      raise ValueError("parameters are mutually exclusive: resource_id|resource_key")
+    if not item.get("collection_path"):
+      raise ValueError("Each item of resources needs a collection_path")
+    if params.get("transaction") and any(path in item["collection_path"]
+        for path in NON_TRANSACTIONAL_PATHS):
+      raise ValueError("%s cannot be configured in a transaction" %
+        item["collection_path"])
+
+    resource = dict((k, params.get(k)) for k in ["host", "user", "password"])
+    resource.update(item)
+    resources.append(resource)
+  return resources
+
+def apply_resources(resources, parallel=1, check_mode=False):
+  """
+    Applies the items of `resources`, returns their results in order.  One
+    at a time, the items after a failure are skipped as they may depend
+    on it.  With parallel > 1 all items are applied.
+  """
+  if not resources:
+    return []
+  if parallel > 1:
+    pool = ThreadPool(min(parallel, len(resources)))
+    try:
+      return pool.map(lambda r: apply_resource(r, check_mode), resources)
+    finally:
+      pool.close()
+
+  results = []
+  for resource in resources:
+    if results and results[-1].get("failed"):
+      results.append({"collection_path": resource["collection_path"],
+        "skipped": True, "changed": False})
+    else:
+      results.append(apply_resource(resource, check_mode))
+  return results
+
+def apply_transaction(resources, check_mode=False):
+  """
+    Applies the items of `resources` one at a time in a transaction, see
+    the top of this file.  Returns their results, and the reason the
+    transaction failed or None.  Nothing is changed when an item or the
+    commit failed.
+  """
+  if check_mode or not resources:
+    # nothing is written, there is nothing to commit
+    return apply_resources(resources, 1, check_mode), None
+
+  session = get_session(resources[0]["host"], resources[0]["user"],
+    resources[0]["password"])
+  try:
+    session.begin_transaction()
+  except (IOError, ValueError, KeyError), e:
+    return [], "could not start a transaction: %s" % e
+
+  try:
+    results = apply_resources(resources, 1)
+  except:
+    session.abort_transaction()
+    raise
+
+  if any(r.get("failed") for r in results):
+    session.abort_transaction()
+    error = None
+  elif not any(r["changed"] for r in results):
+    # every item already matched its payload, nothing was queued and some
+    #  versions refuse to commit an empty transaction
+    session.abort_transaction()
+    return results, None
+  else:
+    error = session.commit_transaction()
+    if error is None:
+      return results, None
+
+  # the changes queued by the items were dropped, as were the resources
+  #  they added to the listings of their collections
+  session.collections.clear()
+  for result in results:
+    result["changed"] = False
+  return results, error
+
 def main():
 
   module = AnsibleModule(
@@ -225,51 +697,47 @@ def main():
       payload_file=dict(required=False, defualt=None, type="str"),
       resource_id=dict(required=False, default=None, type="str"),
       resource_key=dict(required=False, default=None, type="str"),
+      # several resources at once, see the top of this file
+      resources=dict(required=False, default=None, type="list"),
+      parallel=dict(required=False, default=1, type="int"),
+      transaction=dict(required=False, default=False, type="bool"),
     ),
-    mutually_exclusive = [["resource_id","resource_key"]],
+    mutually_exclusive = [["resource_id","resource_key"],
+      ["resources", "collection_path"]],
     supports_check_mode=True
   )
 
-  bigip_config = BigipConfig(module)
-
-  rc = None
-  out = ""
-  err = ""
-  result = {}
-  result["collection_path"] = bigip_config.collection_path
-  result["state"] = bigip_config.state
-  
-  if bigip_config.state == "absent":
-    if bigip_config.resource_exists():
-      if module.check_mode:
-        module.exit_json(changed=True)
-      (rc, out, err) = bigip_config.delete_resource()
-      if rc != 0:
-        module.fail_json(name=bigip_config.collection_path, msg=err, rc=rc)
-  elif bigip_config.state == "present":
-    (rc, out, err) = bigip_config.create_or_update_resource()
-    
-    if rc != 0:
-      module.fail_json(name=bigip_config.collection_path, msg=err, rc=rc)
-  elif bigip_config.state == "inspect":
-    (rc, out, err) = bigip_config.inspect()
-    
-    if rc != 0:
-      module.fail_json(name=bigip_config.collection_path, msg=err, rc=rc)
-
-  if rc is None:
-    result["changed"] = False
+  if module.params["resources"] is None:
+    if module.params["transaction"]:
+      module.fail_json(msg="transaction can only be used with resources")
+    result = apply_resource(module.params, module.check_mode)
+    if result.get("failed"):
+      module.fail_json(name=result["collection_path"], msg=result["msg"],
+        rc=result["rc"])
+    module.exit_json(**result)
+
+  try:
+    resources = get_resources(module.params)
+  except ValueError, e:
+    module.fail_json(msg=str(e))
+
+  error = None
+  if module.params["transaction"]:
+    results, error = apply_transaction(resources, module.check_mode)
   else:
-    result["changed"] = True
-  if out:
-    result["out"] = out
-  if err:
-    result["err"] = err
-
-  module.exit_json(**result)
+    results = apply_resources(resources, module.params["parallel"] or 1,
+      module.check_mode)
+  failed = ["%s: %s" % (r["collection_path"], r["msg"])
+    for r in results if r.get("failed")]
+  if error is not None:
+    failed.append("transaction: %s" % error)
+  changed = any(r["changed"] for r in results)
+  if failed:
+    module.fail_json(msg="; ".join(failed), results=results, changed=changed)
+  module.exit_json(changed=changed, results=results)
 
 # import module snippets
 from ansible.module_utils.basic import *
-main()
-
 
+if __name__ == '__main__':
+  main()
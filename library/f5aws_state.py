@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+"""
+Ansible module for recording the results of our deployment tasks in the
+SQLite state store of an environment (~/vars/f5aws/env/<env>/state.db).
+
+Each entry is keyed on the inventory host, the kind of entry (the result of
+a CloudFormation task, or facts collected from a BIG-IP) and an optional
+name (e.g. "vip-Vip1" for the EIP stacks of a host).  The store is read by
+src/f5_aws/state_store.py, the schema below must be the same as its own (see
+test_state_store.py).
+"""
+
+import os
+import json
+import time
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    host TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL DEFAULT '',
+    content TEXT, updated REAL,
+    PRIMARY KEY (host, kind, name));
+CREATE INDEX IF NOT EXISTS state_kind ON state (kind, host);
+"""
+
+def normalize_content(content):
+  """Ansible may hand us the templated content as a string or as a dict"""
+  if isinstance(content, basestring):
+    try:
+      return json.loads(content)
+    except ValueError:
+      return content
+  return content
+
+def main():
+
+  module = AnsibleModule(
+    argument_spec = dict(
+      path=dict(required=True, type="str"),
+      host=dict(required=True, type="str"),
+      kind=dict(required=True, choices=["result", "facts"], type="str"),
+      name=dict(required=False, default="", type="str"),
+      content=dict(required=True),
+    ),
+    supports_check_mode=True
+  )
+
+  path = os.path.expanduser(module.params["path"])
+  content = json.dumps(normalize_content(module.params["content"]),
+    sort_keys=True)
+
+  if module.check_mode:
+    module.exit_json(changed=True)
+
+  try:
+    db = sqlite3.connect(path, timeout=30)
+    db.executescript(SCHEMA)
+    with db:
+      db.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?)",
+        (module.params["host"], module.params["kind"], module.params["name"],
+         content, time.time()))
+    db.close()
+  except sqlite3.Error, e:
+    module.fail_json(msg="Failed to update %s: %s" % (path, e))
+
+  module.exit_json(changed=True, path=path)
+
+# import module snippets
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# catalog.py
+
+"""
+An index of all environments with the information shown by `list`: the
+overall status and the variables from the environment's inventory.  It is
+kept in ~/vars/f5aws/catalog.json and updated at the end of each init,
+deploy, teardown and remove, so that `list` does not need to parse the
+inventory and state of every environment.
+
+Several deploys may finish at the same time (see `deploy-many`), updates
+are made under an exclusive lock and the file is replaced atomically.
+"""
+
+import os
+import json
+import time
+import fcntl
+
+from f5_aws.config import Config
+
+
+def get_catalog_path():
+    return "{}/catalog.json".format(Config().config["vars_path"])
+
+
+class Catalog(object):
+
+    def __init__(self, path=None):
+        self.path = path or get_catalog_path()
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f).get("environments", {})
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, env_name):
+        """Returns {"status", "vars", "updated"} for the environment, or None"""
+        return self.entries.get(env_name)
+
+    def update(self, env_name, info):
+        info = dict(info, updated=time.time())
+        self._modify(lambda entries: entries.__setitem__(env_name, info))
+
+    def remove(self, env_name):
+        self._modify(lambda entries: entries.pop(env_name, None))
+
+    def _modify(self, change):
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # pick up the changes made by other processes
+            self.entries = self._load()
+            change(self.entries)
+            tmp_path = "{}.{}".format(self.path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump({"environments": self.entries}, f, sort_keys=True)
+            os.rename(tmp_path, self.path)
@@ -1,23 +1,84 @@
 import json
+import time
 import argparse
-
-import ansible.utils
-from ansible.callbacks import display
+import datetime
 
 from f5_aws.config import Config
-from f5_aws.exceptions import ExecutionError
-from f5_aws.environment_manager import EnvironmentManager, EnvironmentManagerFactory
+from f5_aws.display import display
+from f5_aws.exceptions import ValidationError, ExecutionError, LifecycleError
+from f5_aws.environment_manager import (EnvironmentManager,
+  EnvironmentManagerFactory, lock_environment)
+from f5_aws.deploy_graph import DEPLOY_PLAYBOOKS
+from f5_aws.catalog import Catalog
+from f5_aws.run_history import RunHistory, get_stage_percentiles, find_regressions
+from f5_aws.job_queue import JobQueue, JOB_COMMANDS, LEASE_TIMEOUT, run_workers
+
 
-# make our config global
-config = Config().config
+# these commands take the lock of the environment, see lock_environment()
+LOCKED_COMMANDS = ["init", "deploy", "teardown", "remove", "start_traffic",
+  "stop_traffic"]
 
 def print_playbook_results(exec_results):
   if 'playbook_results' in exec_results:
     exec_results['playbook_results'].print_playbook_results()
 
+def print_plan(plan, playbooks):
+  for playbook, changes in plan.get_summary(playbooks):
+    if not changes:
+      display(" {:<28} skip".format(playbook), stderr=False)
+      continue
+    display(" {:<28} run".format(playbook), color="yellow", stderr=False)
+    for host, reason in changes:
+      display("   {:<26} {}".format(host or "(all hosts)", reason),
+        color="yellow", stderr=False)
+
+def format_seconds(seconds):
+  return str(datetime.timedelta(seconds=int(seconds)))
+
 def pretty_print(to_print):
   print json.dumps(to_print, indent=4, sort_keys=True)
 
+def add_retry_arguments(parser):
+    parser.add_argument("--retries", required=False,
+      type=int, default=0,
+      help="number of times a playbook is re-run when some hosts failed or were unreachable (default: 0)")
+    parser.add_argument("--retry-delay", required=False,
+      dest="retry_delay", type=int, default=15,
+      help="seconds to wait before the first retry, doubled for each further retry")
+
+def add_fork_arguments(parser):
+    parser.add_argument("--forks", required=False,
+      type=int, default=None,
+      help="number of parallel processes used by each playbook, by default sized from the hosts it targets")
+    parser.add_argument("--max-forks", required=False,
+      dest="max_forks", type=int, default=None,
+      help="upper limit for the automatically sized number of forks (default: 8 per cpu)")
+
+def add_limit_argument(parser):
+    parser.add_argument("-l", "--limit", required=False,
+      default=None, metavar="PATTERN",
+      help="only run against the hosts matching the pattern, e.g. zone2, zone1-bigip1 or 'zone*-analyticshost*' (ansible host patterns)")
+
+def add_deploy_arguments(parser):
+    parser.add_argument("-e", "--extra-vars", required=False,
+     dest="extra_vars", action="append",
+     help="set additional variables as key=value or YAML/JSON", default=[])
+    parser.add_argument("-p", "--parallel", required=False,
+     type=int, default=4,
+     help="maximum number of independent playbooks to run at once, 1 runs them serially")
+    parser.add_argument("--pipeline", required=False,
+     action="store_true", default=False,
+     help="run the per-host playbooks (CloudFormation stacks, onboarding) for each host as soon as that host is ready, instead of waiting for every host")
+    parser.add_argument("--resume", required=False,
+     action="store_true", default=False,
+     help="skip playbooks which completed in a previous deploy, as long as the inventory, extra vars and templates are unchanged")
+    parser.add_argument("--full", required=False,
+     action="store_true", default=False,
+     help="run every playbook against every host, rather than only the hosts which are new or changed since the last deploy")
+    add_retry_arguments(parser)
+    add_fork_arguments(parser)
+    add_limit_argument(parser)
+
 def get_parser():
     """
       Define the various command line methods and arguments here. 
@@ -25,9 +86,12 @@ def get_parser():
       the corrosponding method (e.g. init -> cli_init) and pass the 
       corrosponding argument values. 
     """
-    parser = argparse.ArgumentParser(prog=config['prog'])
+    parser = argparse.ArgumentParser(prog=Config().config['prog'])
     parser.add_argument("-v", "--verbose", action="count", default=0,
       help="verbose mode (-vvv for more, -vvvv to enable connection debugging")
+    parser.add_argument("--event-stream", required=False,
+      dest="event_stream", default=None, metavar="TARGET",
+      help="write the events of each run as json lines to fd:N, unix:PATH or a file")
     subparsers = parser.add_subparsers(dest="cmd", help="sub-command help")
 
     parser_init = subparsers.add_parser("init",
@@ -46,18 +110,77 @@ def get_parser():
       help="Deploy EC2 resource and application services based on inventory files created using `init`.")
     parser_deploy.add_argument("env_name", metavar="ENVIRONMENT",
      type=str, help="Name of environment to be deployed/updated")
-    parser_deploy.add_argument("-e", "--extra-vars", required=False,
-     dest="extra_vars", action="append",
-     help="set additional variables as key=value or YAML/JSON", default=[])
+    add_deploy_arguments(parser_deploy)
+    parser_deploy.add_argument("--plan", required=False,
+     action="store_true", default=False,
+     help="show the playbooks and hosts the deploy would run, without running them")
+
+    parser_deploy_many = subparsers.add_parser("deploy-many",
+      help="Deploy several environments at once, e.g. one per trainee.")
+    parser_deploy_many.add_argument("env_names", metavar="ENVIRONMENT",
+     type=str, nargs="+", help="Names of environments to be deployed, or glob patterns such as 'lab-*'")
+    parser_deploy_many.add_argument("--max-envs", required=False,
+     dest="max_envs", type=int, default=4,
+     help="maximum number of environments to deploy at once")
+    add_deploy_arguments(parser_deploy_many)
 
     parser_teardown = subparsers.add_parser("teardown",
       help="De-provision all resources in AWS EC2 for an environment created using `init`.")
     parser_teardown.add_argument("env_name", metavar="ENVIRONMENT",
       type=str, help="Name of environment to be de-provisioned. ")
+    add_retry_arguments(parser_teardown)
+    add_fork_arguments(parser_teardown)
+    add_limit_argument(parser_teardown)
 
     parser_list = subparsers.add_parser("list",
       help="List all deployments and corrosponding resource statuses.")
 
+    parser_stats = subparsers.add_parser("stats",
+      help="Show how long each stage of past runs took per deployment model, and flag regressions.")
+    parser_stats.add_argument("-m", "--model", required=False,
+      default=None, help="only show runs of this deployment model, e.g. cluster-per-zone")
+    parser_stats.add_argument("--threshold", required=False,
+      type=float, default=1.5,
+      help="flag stages which took this many times longer than their baseline")
+    parser_stats.add_argument("--window", required=False,
+      type=int, default=10,
+      help="number of earlier runs the baseline (median) of a stage is taken from")
+
+    parser_submit = subparsers.add_parser("submit",
+      help="Queue an init, deploy, teardown or remove job, run by `worker`")
+    parser_submit.add_argument("job_cmd", metavar="COMMAND",
+      choices=JOB_COMMANDS, help="one of {}".format(", ".join(JOB_COMMANDS)))
+    parser_submit.add_argument("env_name", metavar="ENVIRONMENT",
+      type=str, help="Name of environment")
+    parser_submit.add_argument("-e", "--extra-vars", required=False,
+      dest="extra_vars", action="append", default=[],
+      help="variables for init or deploy jobs, as json or yaml")
+
+    parser_jobs = subparsers.add_parser("jobs",
+      help="Show the queued, running and finished jobs, or the events of a job")
+    parser_jobs.add_argument("env_name", metavar="ENVIRONMENT", nargs="?",
+      default=None, help="only show the jobs of this environment")
+    parser_jobs.add_argument("--status", required=False,
+      choices=["queued", "running", "succeeded", "failed"], default=None)
+    parser_jobs.add_argument("--events", required=False, dest="job_id",
+      type=int, default=None, help="show the events of this job")
+
+    parser_worker = subparsers.add_parser("worker",
+      help="Run the queued jobs, jobs of different environments run in parallel")
+    parser_worker.add_argument("-c", "--concurrency", required=False,
+      type=int, default=4, help="number of jobs running at the same time")
+    parser_worker.add_argument("--lease", required=False,
+      type=int, default=LEASE_TIMEOUT,
+      help="seconds after which the jobs of a worker which stopped responding are run again")
+    parser_worker.add_argument("--exit-when-idle", required=False,
+      dest="exit_when_idle", action="store_true", default=False,
+      help="return once the queue is empty")
+
+    parser_serve = subparsers.add_parser("serve",
+      help="Run in the background and execute the commands of bin/f5aws, which then start faster")
+    parser_serve.add_argument("--socket", required=False,
+      default=None, help="unix socket to listen on, ~/vars/f5aws/f5aws.sock by default")
+
     parser_remove = subparsers.add_parser("remove",
       help="Remove all inventory files for an environment created using `init`.")
     parser_remove.add_argument("env_name", metavar="ENVIRONMENT",
@@ -67,11 +190,13 @@ def get_parser():
       help="Begins jmeter client on client in a single availability zone")
     parser_start_traffic.add_argument("env_name", metavar="ENVIRONMENT",
       type=str, help="Name of environment to which jmeter client should run traffic")
+    add_limit_argument(parser_start_traffic)
 
     parser_stop_traffic = subparsers.add_parser("stop_traffic",
       help="Stops jmeter client ")
     parser_stop_traffic.add_argument("env_name", metavar="ENVIRONMENT",
       type=str, help="Name of environment")
+    add_limit_argument(parser_stop_traffic)
 
     parser_info = subparsers.add_parser("info",
       help="Show resource variables along with environment information.")
@@ -89,12 +214,24 @@ def get_parser():
       help="Shows hosts, associated resources and variables that are deployed via CloudFormation")
     parser_resources.add_argument("env_name", metavar="ENVIRONMENT",
       type=str, help="Name of environment")
+    parser_resources.add_argument("--live", required=False,
+      action="store_true", default=False,
+      help="query the current state of the stacks from CloudFormation")
 
     parser_login = info_subparsers.add_parser("login",
       help="Displays login information for deployed hosts (bigips, gtms, client, etc")
     parser_login.add_argument("env_name", metavar="ENVIRONMENT",
       type=str, help="Name of environment")
 
+    parser_timeline = info_subparsers.add_parser("timeline",
+      help="Shows the critical path and the slowest tasks of the last run against this environment")
+    parser_timeline.add_argument("env_name", metavar="ENVIRONMENT",
+      type=str, help="Name of environment")
+    parser_timeline.add_argument("-n", "--top", required=False,
+      type=int, default=10, help="number of slowest tasks to show")
+    parser_timeline.add_argument("--run", required=False,
+      dest="run_id", default=None, help="id of an earlier run to show")
+
     return parser
 
 class CLI(object):
@@ -123,6 +260,9 @@ class CLI(object):
       created by the 'init' command.
     """
     exec_results = EnvironmentManager(args).deploy()
+    if "plan" in exec_results:
+      print_plan(exec_results["plan"], exec_results["playbooks"])
+      return
     print_playbook_results(exec_results)
 
     try:
@@ -131,7 +271,7 @@ class CLI(object):
         print ""
         print "If you\'ve deployed a client, you can start traffic by \
   running:\n./bin/{} {} {}".format(
-          config["prog"], "start_traffic", args.env_name)
+          Config().config["prog"], "start_traffic", args.env_name)
 
         print "\nPrint login information along with the ansible \
   inventory using 'info' command, i.e. `info login`\n"
@@ -139,6 +279,23 @@ class CLI(object):
     except KeyError: 
       pass
 
+  @staticmethod
+  def deploy_many(args):
+    """
+      Deploy several environments, each based on the inventory
+      created by the 'init' command.
+    """
+    summary = EnvironmentManager.deploy_many(args)
+
+    print ""
+    for env_name in sorted(summary):
+      result = summary[env_name]
+      color = "green" if result["statuscode"] == 0 else "red"
+      display(" {:<30} {:<10} {}  {}".format(env_name,
+        "deployed" if result["statuscode"] == 0 else "failed",
+        datetime.timedelta(seconds=int(result["runtime"])),
+        result["error"] or result["log"]), color=color, stderr=False)
+
   @staticmethod
   def teardown(args):
     """
@@ -176,8 +333,110 @@ class CLI(object):
     if len(envs) == 0:
       display("(none)", color="red", stderr=False)
     else:
+      # environments are only inspected if they are missing from the catalog
+      catalog = Catalog()
       for env in envs:
-        EnvironmentManagerFactory(env_name=env, cmd='info').display_basic_info()
+        info = catalog.get(env)
+        if info is None:
+          info = EnvironmentManagerFactory(env_name=env, cmd='info').update_catalog(catalog)
+        if info is not None:
+          EnvironmentManager.display_env_info(env, info)
+
+  @staticmethod
+  def stats(args):
+    """
+      Implements a command line method to show the duration percentiles
+      of each stage, from the run history of all environments.
+    """
+    history = RunHistory()
+    durations = history.get_stage_durations(args.model)
+    history.close()
+
+    if len(durations) == 0:
+      display("(no runs recorded)", color="red", stderr=False)
+      return
+
+    def stage_order(playbook):
+      if playbook in DEPLOY_PLAYBOOKS:
+        return (DEPLOY_PLAYBOOKS.index(playbook), playbook)
+      return (len(DEPLOY_PLAYBOOKS), playbook)
+
+    percentiles = get_stage_percentiles(durations)
+    for model in sorted(set(m for m, pb in percentiles)):
+      print "{}:".format(model or "(unknown model)")
+      print "  {:<30} {:>5} {:>9} {:>9} {:>9}".format("stage", "runs", "p50", "p90", "p99")
+      for pb in sorted([pb for m, pb in percentiles if m == model], key=stage_order):
+        p = percentiles[(model, pb)]
+        print "  {:<30} {:>5} {:>9} {:>9} {:>9}".format(pb, p["runs"],
+          format_seconds(p[50]), format_seconds(p[90]), format_seconds(p[99]))
+      print ""
+
+    regressions = find_regressions(durations, args.threshold, args.window)
+    for model, pb, run_id, env_name, duration, baseline in regressions:
+      display("REGRESSION: {} took {} in run {} of {} ({}), baseline is {}".format(
+        pb, format_seconds(duration), run_id, env_name, model,
+        format_seconds(baseline)), color="red", stderr=False)
+
+  @staticmethod
+  def submit(args):
+    """
+      Implements a command line method to queue a job, see job_queue.py
+    """
+    import yaml
+
+    extra_vars = {}
+    for v in args.extra_vars:
+      extra_vars.update(yaml.safe_load(v) or {})
+
+    queue = JobQueue()
+    job_id = queue.submit(args.env_name, args.job_cmd, extra_vars)
+    queue.close()
+    print job_id
+
+  @staticmethod
+  def jobs(args):
+    """
+      Implements a command line method to show the jobs of the queue, or
+      the events of one job.
+    """
+    queue = JobQueue()
+    if args.job_id is not None:
+      for seq, event in queue.get_events(args.job_id):
+        print json.dumps(event, sort_keys=True)
+      queue.close()
+      return
+
+    jobs = queue.get_jobs(args.env_name, args.status)
+    queue.close()
+    if len(jobs) == 0:
+      display("(no jobs)", color="red", stderr=False)
+      return
+
+    colors = {"queued": None, "running": "yellow", "succeeded": "green",
+      "failed": "red"}
+    print " {:>5}  {:<30} {:<10} {:<10} {:<19} {}".format(
+      "id", "environment", "command", "status", "submitted", "runtime")
+    for job in jobs:
+      runtime = ""
+      if job["started"]:
+        runtime = format_seconds((job["finished"] or time.time()) - job["started"])
+      display(" {:>5}  {:<30} {:<10} {:<10} {:<19} {}  {}".format(
+        job["id"], job["env"], job["cmd"], job["status"],
+        datetime.datetime.fromtimestamp(job["submitted"]).strftime("%Y-%m-%d %H:%M:%S"),
+        runtime, job["error"] or ""), color=colors[job["status"]], stderr=False)
+
+  @staticmethod
+  def worker(args):
+    """
+      Implements a command line method to run the queued jobs.  The output
+      of each job goes to ~/vars/f5aws/jobs/<id>.log
+    """
+    queue = JobQueue()
+    try:
+      run_workers(queue, args.concurrency, args.lease,
+        exit_when_idle=args.exit_when_idle)
+    finally:
+      queue.close()
 
   @staticmethod
   def inventory(args):
@@ -190,7 +449,8 @@ class CLI(object):
       resources associated with a particular deployment.
       This includes vpc, subnets, bigip, app hosts, etc...
     """
-    resources, statuses = EnvironmentManagerFactory(env_name=args.env_name, cmd='info').resources()
+    resources, statuses = EnvironmentManagerFactory(env_name=args.env_name, cmd='info').resources(
+      live=args.live)
     for r in resources:
       print r
       pretty_print(statuses[r])
@@ -199,6 +459,28 @@ class CLI(object):
   def login(args):
     pretty_print(EnvironmentManagerFactory(env_name=args.env_name, cmd='info').login_info())
 
+  @staticmethod
+  def timeline(args):
+    """
+      Implements command line method to show where the time of the last
+      deploy (or teardown, etc) went.
+    """
+    timeline = EnvironmentManagerFactory(env_name=args.env_name, cmd='info').timeline(
+      args.top, args.run_id)
+
+    print "Run {}, total time was {}".format(timeline["run"],
+      datetime.timedelta(seconds=int(timeline["runtime"])))
+    print ""
+    print "Critical path:"
+    for job, start, end in timeline["critical_path"]:
+      print "  {:<60} {}".format(job, datetime.timedelta(seconds=int(end - start)))
+    print ""
+    print "Slowest tasks:"
+    for t in timeline["slowest_tasks"]:
+      print "  {:<10} {:<60} {} [{}] {}".format(
+        datetime.timedelta(seconds=int(t["duration"])), t["task"],
+        t["job"], t["host"], t["status"])
+
   @staticmethod
   def start_traffic(args):
     """
@@ -213,4 +495,85 @@ class CLI(object):
       Implements command line method to stop traffic through BIG-IP
     """
     exec_results = EnvironmentManagerFactory(env_name=args.env_name, cmd='info').stop_traffic()
-    print_playbook_results(exec_results)
\ No newline at end of file
+    print_playbook_results(exec_results)
+
+  @staticmethod
+  def serve(args):
+    """
+      Implements command line method to keep f5aws running, see server.py
+    """
+    from f5_aws import server
+    socket_path = args.socket or server.get_socket_path()
+    display("Listening on {}".format(socket_path), color="green", stderr=False)
+    server.serve(socket_path)
+
+def main(argv):
+  """
+    Runs the command line argv (without the program name) and returns the
+    exit status.  Called by bin/f5aws, or by `f5aws serve` for the commands
+    it forwards.
+  """
+  import ansible.errors
+
+  display(" ", log_only=True)
+  display(" ".join([Config().config["prog"]] + argv), log_only=True)
+  display(" ", log_only=True)
+
+  try:
+    cli = CLI()
+    handlers = {
+      'init': cli.init,
+      'list': cli.list,
+      'deploy': cli.deploy,
+      'deploy-many': cli.deploy_many,
+      'login': cli.login,
+      'resources': cli.resources,
+      'inventory': cli.inventory,
+      'timeline': cli.timeline,
+      'start_traffic': cli.start_traffic,
+      'stop_traffic': cli.stop_traffic,
+      'remove': cli.remove,
+      'serve': cli.serve,
+      'submit': cli.submit,
+      'jobs': cli.jobs,
+      'worker': cli.worker,
+      'stats': cli.stats,
+      'teardown': cli.teardown,
+    }
+
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    # leverage ansible debugging and logging
+    if args.verbose:
+      # ansible is otherwise only imported by the commands which need it
+      import ansible.utils
+    for i in range(args.verbose):
+      print 'Incrementing debug to level %s' % i
+      ansible.utils.increment_debug(False, False, False, False)
+
+    if args.cmd in LOCKED_COMMANDS:
+      with lock_environment(args.env_name):
+        handlers[args.cmd](args)
+    else:
+      handlers[args.cmd](args)
+
+  except ValidationError, e:
+    display("INPUT ERROR: %s" % e, color='red', stderr=True)
+  except ExecutionError, e:
+    display("RUNTIME ERROR: %s" % e, color='red', stderr=True)
+  except LifecycleError, e:
+    display("LIFECYCLE ERROR: %s" % e, color='red', stderr=True)
+  except ansible.errors.AnsibleError, e:
+    display("ANSIBLE ERROR: %s" % e, color='red', stderr=True)
+    return 1
+  except KeyboardInterrupt, e:
+    display("ERROR: interrupted", color='red', stderr=True)
+    return 1
+  except SystemExit, e:
+    # argparse errors and --help
+    return e.code
+  except Exception, e:
+    display("ERROR: %s" % e, color='red', stderr=True)
+    return 1
+  return 0
@@ -1,31 +1,56 @@
 # config.py
 
 import os
-import yaml
-  
+
 from configobj import ConfigObj
 
 class Config(object):
-  def __init__(self):
+  """
+    Config() always returns the same instance within a process, the config
+    files are read the first time .config is used.
+  """
+  _instance = None
+
+  def __new__(cls):
+    if cls._instance is None:
+      cls._instance = super(Config, cls).__new__(cls)
+      cls._instance._config = None
+    return cls._instance
+
+  def reset(self):
+    """The config files are read again the next time .config is used"""
+    self._config = None
+
+  @property
+  def config(self):
+    if self._config is None:
+      self._config = self.load()
+    return self._config
+
+  @staticmethod
+  def load():
     # our basic program variables
-    self.config = ConfigObj('./conf/config.ini')
-    
+    config = ConfigObj('./conf/config.ini')
+
     # get user supplied variables
-    self.config.merge(ConfigObj(os.path.expanduser(self.config['global_vars'])))
+    config.merge(ConfigObj(os.path.expanduser(config['global_vars'])))
 
     # check that we got everything we need
-    for v in self.config['required_vars']:
-      if not v in self.config:
+    for v in config['required_vars']:
+      if not v in config:
         raise Exception(
-          'Required variable "{}" not found in {}'.format(v, self.config['global_vars']))
-        
-    self.config['vars_path'] = os.path.expanduser(
-      '~/vars/{}'.format(self.config['prog']))
-    self.config['env_path'] = self.config['vars_path'] + '/env'
-    self.config['bin_path'] = self.config['install_path'] + '/bin'
+          'Required variable "{}" not found in {}'.format(v, config['global_vars']))
+
+    config['vars_path'] = os.path.expanduser(
+      '~/vars/{}'.format(config['prog']))
+    config['env_path'] = config['vars_path'] + '/env'
+    config['bin_path'] = config['install_path'] + '/bin'
 
     # make the /env/ directory if it does not exist
-    try:
-      os.makedirs(self.config['env_path'])
-    except OSError:
-      pass
\ No newline at end of file
+    if not os.path.isdir(config['env_path']):
+      try:
+        os.makedirs(config['env_path'])
+      except OSError:
+        pass
+
+    return config
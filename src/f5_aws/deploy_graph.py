@@ -0,0 +1,181 @@
+# deploy_graph.py
+
+"""
+Declares the order in which the deployment playbooks may be executed.
+
+Each playbook lists the playbooks whose results it consumes (typically the
+persisted CloudFormation outputs under ~/vars/f5aws/env/<env>/).  Playbooks
+which do not depend on each other can be executed concurrently by
+PlaybookRunner.
+"""
+
+import re
+
+from f5_aws.exceptions import ValidationError
+
+# the order of this list is the order in which playbooks were executed
+#  serially, it is still used to break ties when several playbooks are ready
+DEPLOY_PLAYBOOKS = [
+    'deploy_vpc_cft.yml',
+    'deploy_az_cft.yml',
+    'deploy_bigip_cft.yml',
+    'deploy_gtm_cft.yml',
+    'deploy_app_cft.yml',
+    'deploy_client_cft.yml',
+    'deploy_analytics_cft.yml',
+    'deploy_app.yml',
+    'deploy_bigip.yml',
+    'cluster_bigips.yml',
+    'deploy_apps_bigip.yml',
+    'deploy_gtm.yml',
+    'deploy_apps_gtm.yml',
+    'deploy_client.yml',
+    'deploy_analytics.yml'
+]
+
+DEPLOY_DEPENDENCIES = {
+    'deploy_vpc_cft.yml': [],
+    'deploy_az_cft.yml': ['deploy_vpc_cft.yml'],
+    'deploy_bigip_cft.yml': ['deploy_az_cft.yml'],
+    'deploy_gtm_cft.yml': ['deploy_az_cft.yml'],
+    'deploy_app_cft.yml': ['deploy_az_cft.yml'],
+    'deploy_client_cft.yml': ['deploy_az_cft.yml'],
+    'deploy_analytics_cft.yml': ['deploy_az_cft.yml'],
+    'deploy_app.yml': ['deploy_app_cft.yml'],
+    # loads the analytics host outputs to configure remote logging
+    'deploy_bigip.yml': ['deploy_bigip_cft.yml', 'deploy_analytics_cft.yml'],
+    'cluster_bigips.yml': ['deploy_bigip.yml'],
+    # pool members are built from the docker containers on the app hosts
+    'deploy_apps_bigip.yml': ['cluster_bigips.yml', 'deploy_app.yml',
+                              'deploy_analytics_cft.yml'],
+    # reads the <seed>_peer_info.yml files written when clustering
+    'deploy_gtm.yml': ['deploy_gtm_cft.yml', 'cluster_bigips.yml'],
+    # reads the <seed>-vip-Vip1.yml eip files written for app1
+    'deploy_apps_gtm.yml': ['deploy_gtm.yml', 'deploy_apps_bigip.yml'],
+    # points the client resolver at the gtm listeners
+    'deploy_client.yml': ['deploy_client_cft.yml', 'deploy_gtm_cft.yml'],
+    'deploy_analytics.yml': ['deploy_analytics_cft.yml'],
+}
+
+
+def get_dependencies(playbooks, dependencies=DEPLOY_DEPENDENCIES):
+    """
+      Returns the dependency graph restricted to the given playbooks.
+      Dependencies on playbooks which are not being run (e.g. when the user
+      passes run_only) are assumed to have been satisfied by a previous run.
+    """
+    selected = set(playbooks)
+    graph = {}
+    for pb in playbooks:
+        graph[pb] = [dep for dep in dependencies.get(pb, []) if dep in selected]
+    check_acyclic(graph)
+    return graph
+
+
+def check_acyclic(graph):
+    """Raises a ValidationError if the graph contains a cycle."""
+    visiting = set()
+    visited = set()
+
+    def visit(node, path):
+        if node in visited:
+            return
+        if node in visiting:
+            raise ValidationError(
+                'Cyclic playbook dependency: {}'.format(
+                    ' -> '.join(get_job_name(j) for j in path + [node])))
+        visiting.add(node)
+        for dep in graph.get(node, []):
+            visit(dep, path + [node])
+        visiting.remove(node)
+        visited.add(node)
+
+    for node in graph:
+        visit(node, [])
+
+
+def split_job(job):
+    """Returns the (playbook, limit) for a job, limit is None for whole inventory"""
+    if isinstance(job, tuple):
+        return job
+    return job, None
+
+
+def get_job_name(job):
+    """A printable name for a job, e.g. deploy_bigip.yml[zone1-bigip1]"""
+    playbook, limit = split_job(job)
+    if limit is None:
+        return playbook
+    return '{}[{}]'.format(playbook, limit)
+
+
+# Playbooks which only need the results of earlier playbooks for the same
+#  host (or the availability zone stack of the host's zone).  In pipeline
+#  mode these are run once per host of the given inventory group, all other
+#  playbooks join the results from every host and run against the whole
+#  inventory (clustering, GTM and application configuration).
+PER_HOST_PLAYBOOKS = {
+    'deploy_az_cft.yml': 'azs',
+    'deploy_bigip_cft.yml': 'bigips',
+    'deploy_gtm_cft.yml': 'gtms',
+    'deploy_app_cft.yml': 'apphosts',
+    'deploy_client_cft.yml': 'clienthosts',
+    'deploy_analytics_cft.yml': 'analyticshosts',
+    'deploy_app.yml': 'apphosts',
+    'deploy_bigip.yml': 'bigips',
+    'deploy_analytics.yml': 'analyticshosts',
+}
+
+
+def get_zone(host, groups):
+    """Returns the zone group (e.g. 'zone1') the host belongs to, if any"""
+    for group, hosts in groups.items():
+        if re.match('^zone[0-9]+$', group) and host in hosts:
+            return group
+    return None
+
+
+def get_pipeline(playbooks, groups, dependencies=DEPLOY_DEPENDENCIES,
+                 per_host=PER_HOST_PLAYBOOKS):
+    """
+      Expands the playbook dependency graph into a graph of jobs so that each
+      host advances through its own chain of playbooks.  A job is either a
+      playbook name (run against the whole inventory) or a
+      (playbook, host) tuple (run with the inventory limited to that host).
+
+      groups is the mapping of inventory group name => hosts, as returned
+      by ansible.inventory.Inventory.groups_list().
+    """
+    stage_graph = get_dependencies(playbooks, dependencies)
+
+    jobs = {}
+    for pb in playbooks:
+        if pb in per_host:
+            jobs[pb] = [(pb, h) for h in groups.get(per_host[pb], [])]
+        else:
+            jobs[pb] = [pb]
+
+    def host_deps(pb, host, dep):
+        # the availability zone stack of this host's zone
+        if per_host.get(dep) == 'azs':
+            zone = get_zone(host, groups)
+            zone_jobs = [j for j in jobs[dep] if get_zone(j[1], groups) == zone]
+            if zone is not None and zone_jobs:
+                return zone_jobs
+        # an earlier playbook for this same host
+        elif per_host.get(dep) == per_host[pb]:
+            return [(dep, host)]
+        return jobs[dep]
+
+    graph = {}
+    for pb in playbooks:
+        for job in jobs[pb]:
+            graph[job] = []
+            for dep in stage_graph[pb]:
+                if pb in per_host:
+                    graph[job].extend(host_deps(pb, job[1], dep))
+                else:
+                    graph[job].extend(jobs[dep])
+
+    check_acyclic(graph)
+    return graph
@@ -0,0 +1,154 @@
+# deploy_plan.py
+
+"""
+Works out which jobs a deploy has to run after the inventory or the
+extra_vars were changed, e.g. by adding a zone or raising
+apphosts_per_zone with `init --force`.
+
+The plan starts from the pipeline graph (see deploy_graph.get_pipeline), in
+which every per-host playbook is a job of its own.  A job has changed when
+
+  - one of its hosts is new, or its inputs differ from those recorded in the
+    deploy journal when the job last completed on it (see journal.HostInputs)
+  - it creates CloudFormation stacks and the recorded state of one of its
+    hosts' stacks is not "deployed" (never deployed, failed or torn down)
+  - for the playbooks which join the results of every host (clustering, GTM
+    and application configuration), a host it ran against was removed
+
+With --limit, the graph only holds the per-host jobs of the hosts matching
+the limit and only these hosts are compared.
+
+Every job which depends on a changed job is run as well, so that e.g. a new
+bigip is onboarded, clustered and given the applications.  All other jobs
+are skipped.
+"""
+
+from f5_aws.deploy_graph import (PER_HOST_PLAYBOOKS, split_job, get_job_name,
+                                 get_dependencies)
+
+
+def is_stack_playbook(playbook):
+    """The playbooks which create the CloudFormation stacks of their hosts"""
+    return playbook.endswith("_cft.yml")
+
+
+def get_dependents(graph, jobs):
+    """Returns the jobs of the graph which depend on any of jobs, transitively"""
+    dependents = {}
+    for job, deps in graph.items():
+        for dep in deps:
+            dependents.setdefault(dep, []).append(job)
+
+    found = set()
+    pending = list(jobs)
+    while pending:
+        for job in dependents.get(pending.pop(), []):
+            if job not in found:
+                found.add(job)
+                pending.append(job)
+    return found - set(jobs)
+
+
+class DeployPlan(object):
+    """
+      The jobs of graph (a pipeline graph) which need to run.  host_inputs is
+      a journal.HostInputs for the inventory and extra_vars of the deploy,
+      statuses the recorded state of each host (see
+      EnvironmentManager.get_latest_status).
+
+      reasons maps each job to run to why it runs, by host, e.g.
+      {"zone2-bigip1": "new"} or {None: "after deploy_bigip.yml[zone2-bigip1]"}
+      for a job which runs against the whole inventory.
+    """
+
+    def __init__(self, graph, journal, host_inputs, statuses):
+        self.graph = graph
+        self.reasons = {}
+
+        for job in graph:
+            reasons = self.get_changes(job, journal, host_inputs, statuses)
+            if reasons:
+                self.reasons[job] = reasons
+
+        changed = list(self.reasons)
+        for job in get_dependents(graph, changed):
+            after = sorted(get_job_name(dep) for dep in graph[job]
+                           if dep in self.reasons)
+            self.reasons[job] = {
+                split_job(job)[1]: "after %s" % ", ".join(after)}
+
+    @staticmethod
+    def get_changes(job, journal, host_inputs, statuses):
+        playbook, limit = split_job(job)
+        inputs = host_inputs.get(job)
+
+        reasons = journal.get_changed_hosts(playbook, inputs)
+        if is_stack_playbook(playbook):
+            for host in inputs:
+                state = statuses.get(host, {}).get("state")
+                if host not in reasons and state != "deployed":
+                    reasons[host] = "stack %s" % (state or "not deployed")
+        if playbook not in PER_HOST_PLAYBOOKS and host_inputs.limit is None:
+            for host in journal.get_removed_hosts(playbook, inputs):
+                reasons[host] = "removed"
+        return reasons
+
+    def get_jobs(self):
+        return list(self.reasons)
+
+    def get_playbooks(self, playbooks):
+        """The playbooks, in the order given, which have jobs to run"""
+        planned = set(split_job(job)[0] for job in self.reasons)
+        return [pb for pb in playbooks if pb in planned]
+
+    def get_dependencies(self, pipeline=False):
+        """
+          The dependency graph to hand to PlaybookRunner.  With pipeline,
+          each host runs its own job as in get_pipeline().  Otherwise the jobs
+          of each playbook are run together, limited to the planned hosts
+          unless every host of the playbook is planned.
+        """
+        if pipeline:
+            return get_dependencies(self.get_jobs(), self.graph)
+
+        all_jobs = {}
+        for job in self.graph:
+            all_jobs.setdefault(split_job(job)[0], []).append(job)
+
+        stages = {}
+        for job in self.reasons:
+            stages.setdefault(split_job(job)[0], []).append(job)
+
+        stage_jobs = {}
+        for playbook, jobs in stages.items():
+            if len(jobs) == len(all_jobs[playbook]) or None in [
+                    split_job(job)[1] for job in jobs]:
+                stage_jobs[playbook] = playbook
+            else:
+                stage_jobs[playbook] = (playbook, ":".join(
+                    sorted(split_job(job)[1] for job in jobs)))
+
+        graph = {}
+        for playbook, jobs in stages.items():
+            deps = set()
+            for job in jobs:
+                deps.update(split_job(dep)[0] for dep in self.graph[job]
+                            if dep in self.reasons)
+            deps.discard(playbook)
+            graph[stage_jobs[playbook]] = sorted(stage_jobs[dep] for dep in deps)
+        return graph
+
+    def get_summary(self, playbooks):
+        """
+          Returns [(playbook, [(host, reason)])] for every playbook, in the
+          order given.  The list is empty for the playbooks which are skipped,
+          host is None for those which run against the whole inventory.
+        """
+        summary = []
+        for playbook in playbooks:
+            changes = []
+            for job, reasons in self.reasons.items():
+                if split_job(job)[0] == playbook:
+                    changes.extend(reasons.items())
+            summary.append((playbook, sorted(changes)))
+        return summary
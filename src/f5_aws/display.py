@@ -0,0 +1,38 @@
+# display.py
+
+"""
+display() for the commands which only read the state of environments (list,
+info inventory, info login), so that they do not import ansible.callbacks,
+which pulls in most of ansible.  ansible.color only needs
+ansible.constants.
+
+Once ansible.callbacks has been imported (a playbook is being run), or when
+ansible logs to a file (log_path in ansible.cfg or ANSIBLE_LOG_PATH), the
+message is handed to ansible's display() as before.
+"""
+
+import sys
+
+from ansible import constants
+from ansible.color import stringc
+
+
+def display(msg, color=None, stderr=False, screen_only=False, log_only=False,
+            runner=None):
+    if constants.DEFAULT_LOG_PATH != "" or "ansible.callbacks" in sys.modules:
+        # ansible.callbacks needs ansible.utils to be imported first
+        import ansible.utils
+        from ansible.callbacks import display as ansible_display
+        return ansible_display(msg, color=color, stderr=stderr,
+                               screen_only=screen_only, log_only=log_only,
+                               runner=runner)
+
+    if log_only:
+        return
+    if color:
+        msg = stringc(msg, color)
+    stream = sys.stderr if stderr else sys.stdout
+    try:
+        print >>stream, msg
+    except UnicodeEncodeError:
+        print >>stream, msg.encode("utf-8")
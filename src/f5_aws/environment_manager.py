@@ -1,28 +1,45 @@
 import re
 import os
+import sys
+import copy
 import json
-import yaml
-
-import ansible.utils
+import time
+import fcntl
+import fnmatch
+import contextlib
+import multiprocessing
+from Queue import Empty
 
 from f5_aws.config import Config
 from f5_aws.utils import convert_str
-from f5_aws.playbook_runner import PlaybookRunner, display
+from f5_aws.deploy_graph import DEPLOY_PLAYBOOKS, get_dependencies, get_pipeline
+from f5_aws.journal import DeployJournal, HostInputs
+from f5_aws.inventory_cache import inventory_cache
+from f5_aws.state_store import StateStore
+from f5_aws.environment_snapshot import EnvironmentSnapshot
+from f5_aws.catalog import Catalog
+from f5_aws.display import display
 from f5_aws.exceptions import ExecutionError, ValidationError, LifecycleError
 
-# make our config global
-config = Config().config
+# seconds deploy_many() waits for a result before checking on its workers
+WORKER_POLL_INTERVAL = 5
 
 
-def EnvironmentManagerFactory(env_name="", cmd="", extra_vars=""):
+def EnvironmentManagerFactory(env_name="", cmd="", extra_vars="",
+                              event_stream=""):
     """
       This method is an entry point for instantiations of this class 
       which do not occur through the command line (i.e. tests, and
         the worker processes for our service catalog app)
+
+      event_stream is passed on to PlaybookRunner, see events.py
     """
     from f5_aws import cli
 
     arg_list = []
+    if event_stream:
+        arg_list.append("--event-stream")
+        arg_list.append(event_stream)
     arg_list.append(cmd)
     if cmd == "info":
         # nasty stuff here because of http://bugs.python.org/issue9253
@@ -42,25 +59,183 @@ def EnvironmentManagerFactory(env_name="", cmd="", extra_vars=""):
     return EnvironmentManager(args)
 
 
+@contextlib.contextmanager
+def lock_environment(env_name):
+    """
+      Held by the commands which change an environment, so that two of them
+      (e.g. sent to `f5aws serve` at the same time) do not run against the
+      same environment at once.  The lock files are kept outside of the
+      environment's directory, which `remove` deletes.
+    """
+    lock_path = "%s/locks" % Config().config["vars_path"]
+    if not os.path.isdir(lock_path):
+        try:
+            os.makedirs(lock_path)
+        except OSError:
+            pass
+
+    with open("%s/%s.lock" % (lock_path, env_name), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            display("Waiting for another command on environment '%s' to finish" %
+                    env_name, color="yellow")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _deploy_worker(args, log_path, results):
+    """
+      Entry point for the processes started by EnvironmentManager.deploy_many(),
+      deploys a single environment with its output going to log_path.
+    """
+    statuscode = 1
+    error = None
+    tstart = time.time()
+    try:
+        log = open(log_path, "a")
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+
+        with lock_environment(args.env_name):
+            exec_results = EnvironmentManager(args).deploy()
+        exec_results["playbook_results"].print_playbook_results()
+        statuscode = exec_results["playbook_results"].statuscode
+    except Exception, e:
+        error = str(e)
+        display("ERROR: %s" % e, color="red")
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        results.put((args.env_name, statuscode, error, time.time() - tstart))
+
+
+def _wait_for_workers(running, results):
+    """
+      Waits for the next results of the _deploy_worker() processes in
+      running, {env: (process, log_path, start time)}.  A worker which
+      exited without putting its result in the queue (e.g. it was killed)
+      is reported as failed with its exit code.
+    """
+    try:
+        return [results.get(timeout=WORKER_POLL_INTERVAL)]
+    except Empty:
+        pass
+
+    dead = [env_name for env_name, (worker, log_path, tstart)
+            in running.items() if not worker.is_alive()]
+    finished = []
+    if dead:
+        # a result put just before the worker exited is already in the pipe
+        try:
+            while True:
+                finished.append(results.get(timeout=1))
+        except Empty:
+            pass
+    reported = [result[0] for result in finished]
+    for env_name in dead:
+        if env_name not in reported:
+            worker, log_path, tstart = running[env_name]
+            finished.append((env_name, worker.exitcode or 1,
+                             "deploy process exited with code %s" %
+                             worker.exitcode, time.time() - tstart))
+    return finished
+
+
 class EnvironmentManager(object):
-    config = config
 
     @staticmethod
     def get_envs():
         """Gets a list of all deployments"""
-        return os.listdir(config['env_path'])
+        return os.listdir(Config().config['env_path'])
+
+    @staticmethod
+    def get_matching_envs(patterns):
+        """
+          Returns the environments matching any of the names or glob
+          patterns (e.g. 'trainee-*'), in the order the patterns were given
+        """
+        envs = sorted(EnvironmentManager.get_envs())
+        matching = []
+        for pattern in patterns:
+            matches = fnmatch.filter(envs, pattern)
+            if not matches:
+                raise ValidationError(
+                    "No environment matches '{}'".format(pattern))
+            matching.extend(e for e in matches if e not in matching)
+        return matching
 
     @staticmethod
-    def host_to_az(resource_name, ansible_inventory):
-        """Traverse the ansible inventory to get the availability zone"""
-        # for this host
+    def deploy_many(args):
+        """
+          Deploys several environments at once, each in its own process
+          with at most args.max_envs running at the same time.  The
+          inventories are parsed and the BIG-IP images of each region are
+          looked up once, before the processes are started.
+
+          The output of each deploy goes to ~/vars/f5aws/env/<env>/deploy.log,
+          returns {env: {"statuscode", "error", "runtime", "log"}}
+        """
+        env_names = EnvironmentManager.get_matching_envs(args.env_names)
+
+        regions = set()
+        for env_name in env_names:
+            inventory = inventory_cache.get("%s/%s/inventory/hosts" % (
+                Config().config["env_path"], env_name))
+            if inventory.list_hosts("bigips:gtms"):
+                regions.add(inventory.get_group("all").vars.get("region"))
+
+        from f5_aws.image_finder import BigIpImageFinder
+        image_finder = BigIpImageFinder()
+        for region in sorted(r for r in regions if r):
+            display("Looking up BIG-IP images for %s" % region,
+                    color="green", stderr=False)
+            try:
+                image_finder.getImagesForRegion(region)
+            except Exception, e:
+                # each deploy will try again
+                display("WARNING: image lookup for %s failed: %s" % (region, e),
+                        color="yellow")
+
+        pending = list(env_names)
+        running = {}
+        summary = {}
+        results = multiprocessing.Queue()
+        max_envs = max(1, getattr(args, "max_envs", 1) or 1)
+
         try:
-            hostname = resource_name
-            az = ansible_inventory.get_host(
-                hostname).get_variables()["availability_zone"]
-            return "{}/{}".format(az, resource_name)
-        except:
-            return ""
+            while pending or running:
+                while pending and len(running) < max_envs:
+                    env_args = copy.copy(args)
+                    env_args.env_name = pending.pop(0)
+                    log_path = "%s/%s/deploy.log" % (
+                        Config().config["env_path"], env_args.env_name)
+                    worker = multiprocessing.Process(
+                        target=_deploy_worker, args=(env_args, log_path, results))
+                    worker.start()
+                    running[env_args.env_name] = (worker, log_path, time.time())
+                    display("[%s/%s] Deploying %s, see %s" % (
+                        len(env_names) - len(pending), len(env_names),
+                        env_args.env_name, log_path), stderr=False)
+
+                for env_name, statuscode, error, runtime in \
+                        _wait_for_workers(running, results):
+                    worker, log_path, tstart = running.pop(env_name)
+                    worker.join()
+                    summary[env_name] = {"statuscode": statuscode,
+                                         "error": error, "runtime": runtime,
+                                         "log": log_path}
+                    display("[%s/%s] %s %s" % (
+                        len(summary), len(env_names), env_name,
+                        "deployed" if statuscode == 0 else "failed"),
+                        color="green" if statuscode == 0 else "red",
+                        stderr=False)
+        except KeyboardInterrupt:
+            for worker, log_path, tstart in running.values():
+                worker.terminate()
+            raise
+
+        return summary
 
     @staticmethod
     def get_matching_playbooks(playbooks, match_exprs):
@@ -92,7 +267,7 @@ class EnvironmentManager(object):
 
             #1
             options - This set of variables tells ansible 
-            how to behave (e.g. self.options.forks in playbook_runner.py). 
+            how to behave (e.g. self.options.timeout in playbook_runner.py). 
             We use default values for most of these, stolen mostly from
             the out-of-the-box `ansible-playbook` executable.
 
@@ -112,6 +287,7 @@ class EnvironmentManager(object):
         self.options = args
         self.extra_vars = {}
 
+        config = Config().config
         for v in config["required_vars"]:
             self.extra_vars[v] = config[v]
         self.extra_vars["env_path"] = config["env_path"]
@@ -125,6 +301,8 @@ class EnvironmentManager(object):
             self.extra_vars["env_name"] = getattr(self.options, "env_name")
 
         for extra_vars_opt in getattr(self.options, "extra_vars", []):
+            # ansible is only imported when it is needed, see cli.py
+            import ansible.utils
             self.extra_vars = ansible.utils.combine_vars(self.extra_vars,
                                                          ansible.utils.parse_yaml(extra_vars_opt))
 
@@ -143,6 +321,8 @@ class EnvironmentManager(object):
         See individual playbooks for more info. 
         """
 
+        config = Config().config
+
         # basic string checking to prevent failures later in playbook
         if not re.match("^[a-zA-z]{1}[a-zA-Z0-9-]*", self.options.env_name):
             raise ValidationError(
@@ -167,16 +347,26 @@ availability of the ECS-optimized images used to run the Docker app: {}'.format(
         # acceptance?
 
         playbooks = ["init.yml"]
+        from f5_aws.playbook_runner import PlaybookRunner
         playbook_context = PlaybookRunner(
             playbooks, config, self.proj_inventory_path, self.options, self.extra_vars)
         playbook_context.run()
 
+        # the inventory files for this environment have been rewritten
+        inventory_cache.invalidate(self.env_inventory_path)
+        self.update_catalog()
+
         return {"playbook_results": playbook_context, "env": self}
 
     def deploy(self):
         """
         Run ansible playbooks for deployment, given the ansible
         inventory created via 'init'
+
+        Unless options.full is set or the user picked the playbooks with
+        run_only, only the jobs which are new or changed since the last
+        deploy are run, see plan_deploy().  With options.plan the plan is
+        returned without running anything.
         """
         # make sure the environment has been initialized
         envs = EnvironmentManager.get_envs()
@@ -184,23 +374,8 @@ availability of the ECS-optimized images used to run the Docker app: {}'.format(
             raise LifecycleError("Environment '{}' does not exist.  Has it been initialized?".format(
                 self.options.env_name))
 
-        playbooks = [
-            'deploy_vpc_cft.yml',
-            'deploy_az_cft.yml',
-            'deploy_bigip_cft.yml',
-            'deploy_gtm_cft.yml',
-            'deploy_app_cft.yml',
-            'deploy_client_cft.yml',
-            'deploy_analytics_cft.yml',
-            'deploy_app.yml',
-            'deploy_bigip.yml',
-            'cluster_bigips.yml',
-            'deploy_apps_bigip.yml',
-            'deploy_gtm.yml',
-            'deploy_apps_gtm.yml',
-            'deploy_client.yml',
-            'deploy_analytics.yml'
-        ]
+        self.resolve_limit()
+        playbooks = DEPLOY_PLAYBOOKS
 
         if self.extra_vars.get("run_only"):
             print 'User specified subset of playbooks to run specified by {}'.format(
@@ -210,63 +385,156 @@ availability of the ECS-optimized images used to run the Docker app: {}'.format(
         else:
             matching_playbooks = playbooks
 
+        pipeline = getattr(self.options, "pipeline", False)
+        if getattr(self.options, "plan", False):
+            return {"plan": self.plan_deploy(matching_playbooks),
+                    "playbooks": matching_playbooks, "env": self}
+
+        if not (getattr(self.options, "full", False) or
+                self.extra_vars.get("run_only")):
+            plan = self.plan_deploy(matching_playbooks)
+            if not plan.get_jobs():
+                display("Nothing to deploy, every host is up to date with the "
+                        "inventory and extra vars", color="green", stderr=False)
+            matching_playbooks = plan.get_playbooks(matching_playbooks)
+            dependencies = plan.get_dependencies(pipeline)
+        elif pipeline:
+            # each host advances through its own chain of playbooks
+            dependencies = get_pipeline(matching_playbooks, self.get_groups())
+        else:
+            dependencies = get_dependencies(matching_playbooks)
+
         print 'Running playbooks {}'.format(matching_playbooks)
 
+        from f5_aws.playbook_runner import PlaybookRunner
         playbook_context = PlaybookRunner(
-            matching_playbooks, config, self.env_inventory_path,
-            self.options, self.extra_vars)
+            matching_playbooks, Config().config, self.env_inventory_path,
+            self.options, self.extra_vars, dependencies=dependencies,
+            journal=DeployJournal(self.options.env_name),
+            resume=getattr(self.options, "resume", False))
         playbook_context.run()
+        self.update_catalog()
 
         return {"playbook_results": playbook_context, "env": self}
 
+    def plan_deploy(self, playbooks=DEPLOY_PLAYBOOKS):
+        """
+          Compares the inventory and extra vars with those of the previous
+          deploys and with the recorded state of the stacks, returns the
+          deploy_plan.DeployPlan of the jobs which need to run.
+        """
+        from f5_aws.deploy_plan import DeployPlan
+
+        snapshot = self.get_snapshot()
+        return DeployPlan(get_pipeline(playbooks, self.get_groups()),
+                          DeployJournal(self.options.env_name),
+                          HostInputs(self.env_inventory_path, self.extra_vars,
+                                     getattr(self.options, "limit", None)),
+                          snapshot.statuses)
+
+    def get_groups(self):
+        """
+          The groups of the inventory (group => hosts), without the hosts
+          which do not match --limit
+        """
+        inventory = inventory_cache.get(self.env_inventory_path)
+        groups = inventory.groups_list()
+        limit = getattr(self.options, "limit", None)
+        if limit is None:
+            return groups
+
+        hosts = set(inventory.list_hosts(limit))
+        return dict((group, [h for h in group_hosts if h in hosts])
+                    for group, group_hosts in groups.items())
+
+    def resolve_limit(self):
+        """
+          Checks that --limit matches some of the hosts.  The clustering plays
+          run against the <zone>-bigip-cluster hosts, these are added to the
+          limit when it covers every bigip of their cluster.
+        """
+        limit = getattr(self.options, "limit", None)
+        if limit is None:
+            return
+
+        inventory = inventory_cache.get(self.env_inventory_path)
+        hosts = set(inventory.list_hosts(limit))
+        if not hosts:
+            raise ValidationError(
+                "--limit '%s' does not match any host of environment '%s'" % (
+                    limit, self.options.env_name))
+
+        clusters = []
+        for cluster in inventory.list_hosts("bigip-clusters"):
+            group = inventory.get_group(cluster)
+            members = set(h.name for h in group.get_hosts()) if group else set()
+            if cluster not in hosts and members and members <= hosts:
+                clusters.append(cluster)
+        if clusters:
+            self.options.limit = ":".join([limit] + sorted(clusters))
+
     def teardown(self):
+        self.resolve_limit()
         playbooks = ["teardown_all.yml"]
 
+        from f5_aws.playbook_runner import PlaybookRunner
         playbook_context = PlaybookRunner(
-            playbooks, config, self.env_inventory_path,
+            playbooks, Config().config, self.env_inventory_path,
             self.options, self.extra_vars)
         playbook_context.run()
+        self.update_catalog()
 
         return {"playbook_results": playbook_context, "env": self}
 
     def start_traffic(self):
+        self.resolve_limit()
         playbooks = ["start_traffic.yml"]
 
+        from f5_aws.playbook_runner import PlaybookRunner
         playbook_context = PlaybookRunner(
-            playbooks, config, self.env_inventory_path,
+            playbooks, Config().config, self.env_inventory_path,
             self.options, self.extra_vars)
         playbook_context.run()
 
         return {"playbook_results": playbook_context, "env": self}
 
     def stop_traffic(self):
+        self.resolve_limit()
         playbooks = ["stop_traffic.yml"]
 
+        from f5_aws.playbook_runner import PlaybookRunner
         playbook_context = PlaybookRunner(
-            playbooks, config, self.env_inventory_path,
+            playbooks, Config().config, self.env_inventory_path,
             self.options, self.extra_vars)
         playbook_context.run()
 
         return {"playbook_results": playbook_context, "env": self}
 
     def remove(self):
-        inventory, resources, statuses = self.get_environment_info()
+        snapshot = self.get_snapshot()
 
         okToRemove = True
         stillExists = []
-        for r in resources:
-            if statuses[r]["state"] == "deployed":
+        for host in snapshot.hosts:
+            if host.is_cluster:
+                continue
+            if snapshot.get_status(host.name)["state"] == "deployed":
                 okToRemove = False
-                stillExists.append(r)
+                stillExists.append(host.name)
 
         if okToRemove is True:
             # uses the inventory included in this repository
             playbooks = ["remove.yml"]
             print "running {}".format(playbooks)
+            config = Config().config
             inventory_path = config["install_path"] + "/inventory/hosts"
+            from f5_aws.playbook_runner import PlaybookRunner
             playbook_context = PlaybookRunner(
                 playbooks, config, inventory_path, self.options, self.extra_vars)
             playbook_context.run()
+            inventory_cache.invalidate(self.env_inventory_path)
+            if not os.path.isdir(os.path.dirname(self.env_inventory_path)):
+                Catalog().remove(self.options.env_name)
             return {"playbook_results": playbook_context, "env": self}
         else:
             raise LifecycleError("""Cannot remove environment '%s' until all resources have been de-provisioned.
@@ -275,13 +543,65 @@ Hint: Try tearing down the environment first.""" % (
                 self.options.env_name, stillExists))
 
     def inventory(self):
-        inventory, resources, statuses = self.get_environment_info()
-        return inventory
+        return self.get_snapshot().inventory
 
-    def resources(self):
-        inventory, resources, statuses = self.get_environment_info()
+    def resources(self, live=False):
+        inventory, resources, statuses = self.get_snapshot().copy()
+        if live:
+            self.merge_live_status(inventory, resources, statuses)
         return resources, statuses
 
+    def merge_live_status(self, inventory, resources, statuses, live_status=None):
+        """
+          Replaces the state recorded by the last run with the current state
+          of the <env>-<host> stacks in CloudFormation (see live_status.py).
+          The recorded state is kept as "recorded_state".  The outputs of the
+          stack replace the recorded ones, those of a stack which is still
+          being created are empty and the recorded ones are kept.
+        """
+        from f5_aws.live_status import LiveStatus, get_stack_state
+
+        env_name = self.options.env_name
+        region = inventory["all"]["vars"]["region"]
+        live_status = live_status or LiveStatus()
+        stacks = live_status.get_env_stacks({env_name: region})[env_name]
+
+        for r in resources:
+            stack = stacks.get(r)
+            status = statuses[r]
+            status["recorded_state"] = status.get("state")
+            status["stack_name"] = "%s-%s" % (env_name, r)
+            if stack is None:
+                status["state"] = get_stack_state(None)
+                status.pop("resource_vars", None)
+                continue
+            status["state"] = get_stack_state(stack["stack_status"])
+            status["stack_status"] = stack["stack_status"]
+            if stack["outputs"]:
+                status["resource_vars"] = stack["outputs"]
+
+    def timeline(self, top=10, run_id=None):
+        """
+          Returns the critical path and the slowest tasks of the most recent
+          run recorded for this environment (or of the run run_id).
+        """
+        from f5_aws.timeline import (get_timeline_path, load_timeline,
+                                     get_critical_path, get_slowest_tasks)
+
+        events = load_timeline(
+            get_timeline_path(self.options.env_name), run_id)
+        if not events:
+            raise ValidationError(
+                "No timeline has been recorded for environment '%s'" %
+                self.options.env_name)
+
+        return {
+            "run": events[0]["run"],
+            "runtime": events[-1]["time"] - events[0]["time"],
+            "critical_path": get_critical_path(events),
+            "slowest_tasks": get_slowest_tasks(events, top)
+        }
+
     def login_info(self):
         """
           Returns login information for each of the deployed host types.
@@ -290,10 +610,7 @@ Hint: Try tearing down the environment first.""" % (
         """
 
         login_info = {}
-        inventory, resources, statuses = self.get_environment_info()
-
-        ansible_inventory = ansible.inventory.Inventory(
-            self.env_inventory_path, vault_password=None)
+        snapshot = self.get_snapshot()
 
         # login is a bit more custom - we want to show the login
         # information for a dynamic set of hosts - bigips, gtms, app hosts, and the client host
@@ -308,54 +625,46 @@ Hint: Try tearing down the environment first.""" % (
         }
 
         for host_type in ip_map.keys():
-            try:
-                group_name = host_type + "s"
-                if inventory[group_name]:
-                    group_info = inventory[group_name]
-                    login_info[host_type] = {}
-
-                    # not very efficient...
-                    for resource_name, status in statuses.items():
-                        match = re.match(
-                            "^zone[0-9]+[/-]{}[0-9]+".format(host_type), resource_name)
-
-                        if match:
-                            try:
-                                resources = {}
-                                key = group_info["vars"][
-                                    "ansible_ssh_private_key_file"]
-                                user = group_info["vars"]["ansible_ssh_user"]
-                                ip = status["resource_vars"][ip_map[host_type]]
-                                resources["ssh"] = "ssh -i {} {}@{}".format(
-                                    key, user, ip)
-
-                                if "app" in resource_name:
-                                    resources["http"] = "http://{}".format(ip)
-
-                                if "bigip" in resource_name:
-                                    resources["virtual_servers"] = self.collect_virtual_servers(
-                                        resource_name)
-                                    resources["elastic_ips"] = self.collect_elastic_ips(
-                                        resource_name)
-                                    resources["https"] = "https://{}".format(ip)
-                                
-                                if "gtm" in resource_name:
-                                    resources["wideips"] = self.collect_wideips(
-                                        resource_name)
-                                    resources["elastic_ips"] = self.collect_elastic_ips(
-                                        resource_name)
-                                    resources["https"] = "https://{}".format(ip)
-                                
-                                if 'analyticshost' in resource_name:
-                                    resources['http_username'] = 'admin'
-                                    resources['http'] = 'http://{}:8000'.format(ip)
-
-                                login_info[host_type][self.host_to_az(
-                                    resource_name, ansible_inventory)] = resources
-                            except KeyError, e:
-                                pass
-            except KeyError, e:
-                pass
+            group_info = snapshot.inventory.get(host_type + "s")
+            if not group_info:
+                continue
+            login_info[host_type] = {}
+
+            for host in snapshot.hosts.of_type(host_type):
+                resource_name = host.name
+                try:
+                    resources = {}
+                    status = snapshot.get_status(resource_name)
+                    key = group_info["vars"]["ansible_ssh_private_key_file"]
+                    user = group_info["vars"]["ansible_ssh_user"]
+                    ip = status["resource_vars"][ip_map[host_type]]
+                    resources["ssh"] = "ssh -i {} {}@{}".format(key, user, ip)
+
+                    if host_type == "apphost":
+                        resources["http"] = "http://{}".format(ip)
+
+                    if host_type == "bigip":
+                        resources["virtual_servers"] = snapshot.get_virtual_servers(
+                            resource_name)
+                        resources["elastic_ips"] = snapshot.get_elastic_ips(
+                            resource_name)
+                        resources["https"] = "https://{}".format(ip)
+
+                    if host_type == "gtm":
+                        resources["wideips"] = snapshot.get_wideips(
+                            resource_name)
+                        resources["elastic_ips"] = snapshot.get_elastic_ips(
+                            resource_name)
+                        resources["https"] = "https://{}".format(ip)
+
+                    if host_type == "analyticshost":
+                        resources['http_username'] = 'admin'
+                        resources['http'] = 'http://{}:8000'.format(ip)
+
+                    login_info[host_type][snapshot.get_az_name(
+                        resource_name)] = resources
+                except (KeyError, TypeError), e:
+                    pass
 
         return login_info
 
@@ -363,33 +672,58 @@ Hint: Try tearing down the environment first.""" % (
 #### all over the below needs to get refactored....very ugly ####
 #################################################################
 
-    def display_basic_info(self):
-        inventory, resources, statuses = self.get_environment_info()
+    def get_basic_info(self):
+        """The overall status and the inventory variables shown by `list`"""
+        snapshot = self.get_snapshot()
 
-        color = 'green'
         status = 'deployed'
-        for k, v in statuses.items():
-            try:
-                if v['state'] != 'deployed':
-                    color = 'red'
-                    status = 'not deployed/error'
-            except KeyError:
-                color = 'red'
+        for host in snapshot.hosts:
+            if host.is_cluster:
+                continue
+            if snapshot.get_status(host.name).get('state') != 'deployed':
                 status = 'not deployed/error'
+                break
+
+        env_info = dict(snapshot.inventory['all']['vars'])
+        env_info.pop('env_name', None)
+        return {"status": status, "vars": env_info}
+
+    @staticmethod
+    def display_env_info(env_name, info):
+        color = 'green'
+        if info['status'] != 'deployed':
+            color = 'red'
 
-        env_info = inventory['all']['vars']
-    	del env_info['env_name']	
-        display(" - %s (%s)" % (self.options.env_name, status),
+        display(" - %s (%s)" % (env_name, info['status']),
                 color=color, stderr=False)
-        for k in sorted(env_info, key=lambda key: key):
+        for k in sorted(info['vars'], key=lambda key: key):
             display("  %s: %s" %
-                    (k, env_info[k]), color=color, stderr=False)
+                    (k, info['vars'][k]), color=color, stderr=False)
 
-    def get_environment_info(self):
+    def display_basic_info(self):
+        self.display_env_info(self.options.env_name, self.get_basic_info())
+
+    def update_catalog(self, catalog=None):
+        """
+          Records the status of this environment in the catalog read by
+          `list`, see catalog.py.  Returns the recorded information.
+        """
+        if not os.path.isfile(self.env_inventory_path):
+            return None
+        try:
+            info = self.get_basic_info()
+            (catalog or Catalog()).update(self.options.env_name, info)
+            return info
+        except Exception, e:
+            display("WARNING: could not update the catalog for %s: %s" % (
+                self.options.env_name, e), color="yellow")
+            return None
+
+    @staticmethod
+    def summarize_inventory(ansible_inventory):
+        """The groups and variables of the inventory used by get_snapshot()"""
 
         # collect the ansible inventory in a nice format
-        ansible_inventory = ansible.inventory.Inventory(
-            self.env_inventory_path, vault_password=None)
         inventory = {}
         for group, hosts in ansible_inventory.groups_list().items():
             inventory[group] = {
@@ -397,79 +731,66 @@ Hint: Try tearing down the environment first.""" % (
                 "vars": ansible_inventory.get_group(group).vars
             }
 
-        resources, statuses = self.get_latest_status(inventory)
-
-        # clusters also show up in the statuses section, but we cannot
-        #  print their status now, this causes them to show up under
-        #  state = 'not deployed/error' for all models.  Avoiding this
-        #  for now by removing them from the objects below
-        for i, r in enumerate(resources):
-            if 'cluster' in r:
-                del statuses[r]
-                del resources[i]
-
-        return inventory, resources, statuses
-
-    def collect_elastic_ips(self, resource_name):
-        return self.collect_resources(resource_name, "{}-vip-Vip[0-9]+.json",
-                                     ["eipAddress", "privateIpAddress"], False)
+        availability_zones = {}
+        for host in ansible_inventory.get_hosts():
+            az = host.get_variables().get("availability_zone")
+            if az is not None:
+                availability_zones[host.name] = az
 
-    def collect_virtual_servers(self, resource_name):
-        return self.collect_resources(resource_name, "facts_{}.json",
-                                     ["name", "destination"], True)
-    def collect_wideips(self, resource_name):
-        return self.collect_resources(resource_name, "facts_{}.json",
-                                     ["name"], True)
+        return {"inventory": inventory,
+                "availability_zones": availability_zones}
 
-    def collect_resources(self, resource_name, fregex, fields, nested):
-        r = []
-        try:
-            searchDir = "%s/%s/" % (config["env_path"], self.options.env_name)
-            files = os.listdir(searchDir)
-            for fname in files:
-                if re.match(fregex.format(resource_name), fname):
-                    with open(searchDir + fname) as data_file:
-                        content = json.load(data_file)
-                        if nested == False:
-                            r.append(
-                                dict(zip(fields, [content[x] for x in fields])))
-                        else:
-                            for i in content["items"]:
-                                r.append(
-                                    dict(zip(fields, [i[x] for x in fields])))
-        except KeyError, e:
-            print "WARN: %s" % e
-        return r
-
-    def get_latest_status(self, inventory):
+    def get_snapshot(self):
+        """
+          Reads the inventory and the recorded state of this environment,
+          see environment_snapshot.py
+        """
+        summary = inventory_cache.get_summary(
+            self.env_inventory_path, self.summarize_inventory,
+            "%s/%s/inventory_summary.json" % (
+                Config().config["env_path"], self.options.env_name))
+        inventory = summary["inventory"]
+        availability_zones = summary["availability_zones"]
+
+        state = self.get_state()
+        statuses = self.get_latest_status(inventory, state.get_all("result"))
+
+        return EnvironmentSnapshot(
+            self.options.env_name, inventory, statuses, availability_zones,
+            facts=state.get_all("facts"),
+            elastic_ips=dict(
+                (host, [r.get("stack_outputs", {}) for r in results])
+                for host, results in state.find_all("result", "vip-").items()))
+
+    def get_state(self):
+        """The state store of this environment, see state_store.py"""
+        if getattr(self, "_state", None) is None:
+            self._state = StateStore(self.options.env_name)
+        return self._state
+
+    def get_latest_status(self, inventory, results):
         """
           Attempts to read the output from executed tasks.
         """
 
         hosts = [h for h in inventory["all"]["hosts"]]
         statuses = {}
-        resources = []
         for m in hosts:
             # for each resource, we will get the results from
             #  most recent manager execution for that resource
-            #resource_name = m[:-8]
             resource_name = m[:]
 
-            resources.append(resource_name)
             try:
-                fname = "{}/{}/{}.yml".format(
-                    config["env_path"], self.options.env_name, m)
-                with open(fname) as f:
-                    latest = yaml.load(f)
-                    statuses[resource_name] = getattr(self,
-                                                      "state_" +
-                                                      latest["invocation"][
-                                                          "module_name"])(latest, True)
+                latest = results[m]
+                statuses[resource_name] = getattr(self,
+                                                  "state_" +
+                                                  latest["invocation"][
+                                                      "module_name"])(latest, True)
 
             except Exception as e:
                 statuses[resource_name] = {"state": "not deployed/error"}
 
-        return resources, statuses
+        return statuses
 
     def state_cloudformation(self, latest_result, show_resource_vars):
         """
@@ -0,0 +1,100 @@
+# environment_snapshot.py
+
+"""
+Everything the `info` commands show about an environment, read once: the
+inventory, the status of each host, the availability zone of each host,
+the facts collected from the BIG-IPs and GTMs and the outputs of their EIP
+stacks.  See EnvironmentManager.get_snapshot().
+
+A snapshot is not modified once built, callers which need to change its
+contents (e.g. `info resources --live`) work on a copy.
+"""
+
+import copy
+
+from f5_aws.host_registry import HostRegistry
+
+
+def collect_resources(contents, fields, nested):
+    """
+      Picks fields out of each content, or out of each of the "items" of
+      each content when nested.
+    """
+    r = []
+    try:
+        for content in contents:
+            if content is None:
+                continue
+            if nested == False:
+                r.append(
+                    dict(zip(fields, [content[x] for x in fields])))
+            else:
+                for i in content["items"]:
+                    r.append(
+                        dict(zip(fields, [i[x] for x in fields])))
+    except KeyError, e:
+        print "WARN: %s" % e
+    return r
+
+
+class EnvironmentSnapshot(object):
+    """
+      inventory            {group: {"hosts": [...], "vars": {...}}}
+      resources            hosts shown by `info resources`, in inventory order
+      statuses             {host: status}, see EnvironmentManager.state_*
+      availability_zones   {host: availability zone}
+      facts                {host: facts collected from the device}
+      elastic_ips          {host: [outputs of each EIP stack]}
+      hosts                the hosts of the inventory by name, type and zone,
+                           see host_registry.py
+    """
+
+    def __init__(self, env_name, inventory, statuses, availability_zones,
+                 facts, elastic_ips):
+        set_attr = super(EnvironmentSnapshot, self).__setattr__
+        set_attr("env_name", env_name)
+        set_attr("inventory", inventory)
+        set_attr("availability_zones", availability_zones)
+        set_attr("facts", facts)
+        set_attr("elastic_ips", elastic_ips)
+
+        hosts = HostRegistry(inventory["all"]["hosts"])
+        set_attr("hosts", hosts)
+
+        # clusters also show up in the inventory, but we cannot print their
+        #  status now, this causes them to show up under
+        #  state = 'not deployed/error' for all models
+        resources = [h.name for h in hosts if not h.is_cluster]
+        set_attr("resources", resources)
+        set_attr("statuses", dict((h, statuses[h]) for h in resources))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("EnvironmentSnapshot is read-only")
+
+    def get_status(self, resource_name):
+        return self.statuses.get(resource_name)
+
+    def get_az_name(self, resource_name):
+        """us-east-1a/zone1-bigip1, or "" if the zone is not known"""
+        az = self.availability_zones.get(resource_name)
+        if az is None:
+            return ""
+        return "{}/{}".format(az, resource_name)
+
+    def get_elastic_ips(self, resource_name):
+        return collect_resources(
+            self.elastic_ips.get(resource_name, []),
+            ["eipAddress", "privateIpAddress"], False)
+
+    def get_virtual_servers(self, resource_name):
+        return collect_resources(
+            [self.facts.get(resource_name)], ["name", "destination"], True)
+
+    def get_wideips(self, resource_name):
+        return collect_resources(
+            [self.facts.get(resource_name)], ["name"], True)
+
+    def copy(self):
+        """A deep copy of inventory, resources and statuses for callers to modify"""
+        return (copy.deepcopy(self.inventory), list(self.resources),
+                copy.deepcopy(self.statuses))
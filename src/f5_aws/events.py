@@ -0,0 +1,77 @@
+# events.py
+
+"""
+A machine readable stream of the events of a run, for callers such as the
+worker processes of our service catalog app which need to follow the
+progress of a deploy without scraping the output of `display()`.
+
+Each event is written as a single line of json, see timeline.py for the
+events recorded (run_start, playbook_start, play_start, task_start,
+host_result, task_end, stats, playbook_end, run_end).  The target is one
+of:
+
+  fd:N         an open file descriptor inherited from the caller (e.g. a pipe)
+  unix:PATH    a unix stream socket the caller is listening on
+  PATH         a file, events are appended to it
+"""
+
+import os
+import sys
+import json
+import socket
+
+from f5_aws.exceptions import ValidationError
+
+
+class EventStream(object):
+    """
+      Host results are reported from the processes ansible forks for each
+      task, so every event is sent with a single write.  Each process opens
+      its own connection to a unix socket.
+
+      A target which can no longer be written to (e.g. the caller closed
+      its end of the pipe) is dropped after a warning, the run goes on
+      without it.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self._socket = None
+        self._pid = None
+        self.broken = False
+
+        if target.startswith("fd:"):
+            try:
+                self.fd = int(target[3:])
+            except ValueError:
+                raise ValidationError(
+                    "Invalid event stream file descriptor '%s'" % target)
+        else:
+            self.fd = None
+
+    def write(self, event):
+        if self.broken:
+            return
+        line = json.dumps(event, sort_keys=True, default=str) + "\n"
+        try:
+            if self.fd is not None:
+                os.write(self.fd, line)
+            elif self.target.startswith("unix:"):
+                self._connect().sendall(line)
+            else:
+                with open(self.target, "a") as f:
+                    f.write(line)
+        except (OSError, IOError, socket.error) as e:
+            self.broken = True
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+            sys.stderr.write("WARNING: no longer writing events to %s: %s\n"
+                             % (self.target, e))
+
+    def _connect(self):
+        if self._socket is None or self._pid != os.getpid():
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.target[5:])
+            self._pid = os.getpid()
+        return self._socket
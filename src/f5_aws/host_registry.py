@@ -0,0 +1,75 @@
+# host_registry.py
+
+"""
+The hosts of an environment's inventory, with each hostname parsed once into
+its zone, host type and index:
+
+  zone1-bigip2          zone1, bigip, 2
+  zone2-bigip-cluster   zone2, bigip-cluster, None
+  zone1-az              zone1, az, None
+  vpc-manager           None, vpc-manager, None
+
+The registry is indexed by name, host type and zone.
+"""
+
+import re
+
+HOST_NAME = re.compile(r"^(?:(zone[0-9]+)[/-])?([a-z-]+?)([0-9]+)?$")
+
+
+class HostRecord(object):
+    __slots__ = ("name", "zone", "host_type", "index")
+
+    def __init__(self, name, zone, host_type, index):
+        self.name = name
+        self.zone = zone
+        self.host_type = host_type
+        self.index = index
+
+    @classmethod
+    def parse(cls, name):
+        match = HOST_NAME.match(name)
+        if match is None:
+            return cls(name, None, None, None)
+        zone, host_type, index = match.groups()
+        return cls(name, zone, host_type,
+                   int(index) if index is not None else None)
+
+    @property
+    def is_cluster(self):
+        return self.host_type is not None and \
+            self.host_type.endswith("cluster")
+
+    def __repr__(self):
+        return "HostRecord(%r, %r, %r, %r)" % (
+            self.name, self.zone, self.host_type, self.index)
+
+
+class HostRegistry(object):
+    """Iterates over the records in inventory order"""
+
+    def __init__(self, hostnames):
+        self.records = [HostRecord.parse(name) for name in hostnames]
+        self.by_name = {}
+        self.by_type = {}
+        self.by_zone = {}
+        for record in self.records:
+            self.by_name[record.name] = record
+            self.by_type.setdefault(record.host_type, []).append(record)
+            self.by_zone.setdefault(record.zone, []).append(record)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def of_type(self, host_type):
+        """e.g. of_type("bigip") => [zone1-bigip1, zone1-bigip2, ...]"""
+        return self.by_type.get(host_type, [])
+
+    def in_zone(self, zone):
+        return self.by_zone.get(zone, [])
@@ -1,11 +1,20 @@
 import re
+import os
+import json
+import time
 import boto
 import boto.ec2
 import collections
 
+# the images found for each region are kept here, so that environments
+#  deployed at the same time (see `deploy-many`) share a single lookup
+IMAGE_CACHE_PATH = os.path.expanduser('~/vars/f5aws/image_cache')
+IMAGE_CACHE_TTL = 3600  # seconds
+
 class BigIpImageFinder(object):
-    def __init__(self):
-        pass
+    def __init__(self, cache_path=IMAGE_CACHE_PATH, cache_ttl=IMAGE_CACHE_TTL):
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
 
     def searchitem(self, keys, name):
         value = None
@@ -17,6 +26,37 @@ class BigIpImageFinder(object):
         return value
 
     def getImagesForRegion(self, region):
+        """
+            Returns the images published by F5 for this region, from the
+            cache if it was filled less than cache_ttl seconds ago.
+        """
+        if self.cache_path is None:
+            return self.searchImagesForRegion(region)
+
+        cache_file = os.path.join(self.cache_path, '{}.json'.format(region))
+        try:
+            if time.time() - os.path.getmtime(cache_file) < self.cache_ttl:
+                with open(cache_file) as f:
+                    return json.load(f)
+        except (OSError, IOError, ValueError):
+            pass
+
+        images = self.searchImagesForRegion(region)
+
+        # write to a temporary file first, other processes may be reading
+        try:
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            tmp_file = '{}.{}'.format(cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(images, f)
+            os.rename(tmp_file, cache_file)
+        except (OSError, IOError):
+            pass
+
+        return images
+
+    def searchImagesForRegion(self, region):
         """
             Takes the name of an amazon region and retrieves a list of all
             images published by F5 for this region. 
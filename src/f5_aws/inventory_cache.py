@@ -0,0 +1,118 @@
+# inventory_cache.py
+
+"""
+Keeps parsed ansible inventories in memory so that running a list of
+playbooks (or several EnvironmentManager commands within one process)
+does not re-read and re-parse the hosts, group_vars and host_vars files
+every time.
+
+Entries are keyed on the contents of the inventory files, so an inventory
+rewritten by `init` or by a playbook (e.g. deploy_az_cft.yml writes
+group_vars for each zone) is parsed again on the next lookup.
+
+Commands which only need the groups and variables of an inventory (list,
+info) use get_summary(), which keeps them on disk with the same key and does
+not import ansible at all when the inventory has not changed.
+"""
+
+import re
+import os
+import copy
+import json
+import hashlib
+
+
+def get_inventory_files(inventory_path):
+    """Lists the hosts file along with the group_vars and host_vars files"""
+    files = [inventory_path]
+    inventory_dir = os.path.dirname(os.path.abspath(inventory_path))
+    for vars_dir in ["group_vars", "host_vars"]:
+        path = os.path.join(inventory_dir, vars_dir)
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, f) for f in sorted(os.listdir(path)))
+    return files
+
+
+def get_inventory_digest(inventory_path, exclude=None):
+    """
+      Returns a hash over the paths and contents of all the files making up
+      the inventory.  Files whose name matches the regular expression
+      `exclude` are left out.
+    """
+    digest = hashlib.sha1()
+    for fname in get_inventory_files(inventory_path):
+        if exclude is not None and re.match(exclude, os.path.basename(fname)):
+            continue
+        digest.update(fname)
+        if os.path.isfile(fname):
+            with open(fname) as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+class InventoryCache(object):
+    """
+      Parsed inventories keyed on inventory path.  Playbooks modify the
+      inventory they are given (add_host, restrictions, vars from the
+      playbook directory) so callers always get their own copy.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, inventory_path, vault_password=None):
+        digest = get_inventory_digest(inventory_path)
+        entry = self._entries.get(inventory_path)
+
+        if entry is not None and entry[0] == digest:
+            self.hits += 1
+        else:
+            # ansible.inventory pulls in most of ansible, see get_summary()
+            import ansible.inventory
+
+            self.misses += 1
+            entry = (digest, ansible.inventory.Inventory(
+                inventory_path, vault_password=vault_password))
+            self._entries[inventory_path] = entry
+
+        return copy.deepcopy(entry[1])
+
+    def get_summary(self, inventory_path, summarize, summary_path):
+        """
+          Returns summarize(inventory), which must be json serializable.  It
+          is read from summary_path if the inventory files have not changed
+          since it was written.
+        """
+        digest = get_inventory_digest(inventory_path)
+        try:
+            with open(summary_path) as f:
+                cached = json.load(f)
+            if cached["digest"] == digest:
+                return cached["summary"]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+        # the summary goes through json either way, so that callers get
+        #  the same types from the cache
+        summary = json.loads(json.dumps(summarize(self.get(inventory_path))))
+        try:
+            tmp_path = "{}.{}".format(summary_path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump({"digest": digest, "summary": summary}, f)
+            os.rename(tmp_path, summary_path)
+        except (OSError, IOError):
+            pass
+        return summary
+
+    def invalidate(self, inventory_path=None):
+        """Drops the entry for inventory_path, or all entries"""
+        if inventory_path is None:
+            self._entries = {}
+        else:
+            self._entries.pop(inventory_path, None)
+
+
+# shared by all PlaybookRunner and EnvironmentManager instances in this process
+inventory_cache = InventoryCache()
@@ -0,0 +1,333 @@
+# job_queue.py
+
+"""
+A queue of init, deploy, teardown and remove jobs kept in a local SQLite
+database (~/vars/f5aws/job_queue.db), and the worker pool which runs them.
+This is what the worker processes of our service catalog app use instead of
+calling EnvironmentManagerFactory themselves: the app submits a job and
+follows its events.
+
+  jobs     one row per job: environment, command, extra vars, status
+           (queued, running, succeeded, failed), the worker running it and
+           the time its lease expires
+  events   the events of each job (see events.py), in order
+
+Jobs of the same environment run one at a time in the order they were
+submitted, jobs of different environments run in parallel up to the
+concurrency of the pool.  Several pools may share the database.
+
+A pool renews the lease of its running jobs every LEASE_TIMEOUT / 3
+seconds.  When a pool dies, its jobs are queued again once their lease has
+expired, up to MAX_ATTEMPTS times.  If the job's process outlived its pool,
+the new run waits for it on the environment's lock (see lock_environment).
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import socket
+import sqlite3
+import contextlib
+import multiprocessing
+
+from f5_aws.config import Config
+from f5_aws.exceptions import ValidationError
+
+
+JOB_COMMANDS = ["init", "deploy", "teardown", "remove"]
+LEASE_TIMEOUT = 300  # seconds
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, env TEXT NOT NULL,
+    cmd TEXT NOT NULL, extra_vars TEXT, status TEXT NOT NULL,
+    submitted REAL, started REAL, finished REAL, worker TEXT,
+    lease_expires REAL, attempts INTEGER DEFAULT 0, statuscode INTEGER,
+    error TEXT);
+CREATE TABLE IF NOT EXISTS events (
+    job_id INTEGER NOT NULL, time REAL, event TEXT);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, env);
+CREATE INDEX IF NOT EXISTS events_job ON events (job_id);
+"""
+
+JOB_FIELDS = ["id", "env", "cmd", "extra_vars", "status", "submitted",
+              "started", "finished", "worker", "lease_expires", "attempts",
+              "statuscode", "error"]
+
+
+def get_queue_path():
+    return "{}/job_queue.db".format(Config().config["vars_path"])
+
+
+def get_job_log_path(job_id):
+    return "{}/jobs/{}.log".format(Config().config["vars_path"], job_id)
+
+
+def get_worker_id():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class JobQueue(object):
+
+    def __init__(self, path=None):
+        self.path = path or get_queue_path()
+        # transactions are started explicitly, see _transaction()
+        self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Takes the write lock up front, so two pools cannot claim one job"""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def _to_job(self, row):
+        job = dict(zip(JOB_FIELDS, row))
+        job["extra_vars"] = json.loads(job["extra_vars"] or "{}")
+        return job
+
+    def submit(self, env_name, cmd, extra_vars=None):
+        """Queues a job, returns its id"""
+        if cmd not in JOB_COMMANDS:
+            raise ValidationError("Jobs must be one of %s, not '%s'" % (
+                ", ".join(JOB_COMMANDS), cmd))
+        if extra_vars and cmd not in ["init", "deploy"]:
+            raise ValidationError(
+                "Extra vars can only be given to init and deploy jobs")
+
+        with self._transaction():
+            cursor = self.db.execute(
+                "INSERT INTO jobs (env, cmd, extra_vars, status, submitted) "
+                "VALUES (?, ?, ?, 'queued', ?)",
+                (env_name, cmd, json.dumps(extra_vars or {}), time.time()))
+            return cursor.lastrowid
+
+    def get_job(self, job_id):
+        row = self.db.execute(
+            "SELECT %s FROM jobs WHERE id = ?" % ", ".join(JOB_FIELDS),
+            (job_id,)).fetchone()
+        return self._to_job(row) if row else None
+
+    def get_jobs(self, env_name=None, status=None, limit=50):
+        """The most recent jobs first"""
+        query = "SELECT %s FROM jobs WHERE 1" % ", ".join(JOB_FIELDS)
+        params = []
+        if env_name is not None:
+            query += " AND env = ?"
+            params.append(env_name)
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        return [self._to_job(row) for row in self.db.execute(query, params)]
+
+    def claim(self, worker_id, lease=LEASE_TIMEOUT):
+        """
+          Marks the next job which can run as running on worker_id and
+          returns it, or returns None.  A job can run when it is the oldest
+          queued job of its environment and no job of that environment is
+          running.  Expired leases are reclaimed first.
+        """
+        now = time.time()
+        with self._transaction():
+            self.db.execute(
+                "UPDATE jobs SET status = 'failed', finished = ?, "
+                "error = 'the worker running this job stopped responding' "
+                "WHERE status = 'running' AND lease_expires < ? "
+                "AND attempts >= ?", (now, now, MAX_ATTEMPTS))
+            self.db.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL "
+                "WHERE status = 'running' AND lease_expires < ?", (now,))
+
+            row = self.db.execute("""
+                SELECT id FROM jobs j WHERE status = 'queued'
+                AND NOT EXISTS (SELECT 1 FROM jobs o WHERE o.env = j.env
+                    AND (o.status = 'running' OR
+                         (o.status = 'queued' AND o.id < j.id)))
+                ORDER BY id LIMIT 1""").fetchone()
+            if row is None:
+                return None
+
+            self.db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started = ?, "
+                "lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker_id, now, now + lease, row[0]))
+        return self.get_job(row[0])
+
+    def renew(self, job_id, worker_id, lease=LEASE_TIMEOUT):
+        """Extends the lease of a job, returns False if it was reclaimed"""
+        with self._transaction():
+            cursor = self.db.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND "
+                "worker = ? AND status = 'running'",
+                (time.time() + lease, job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def release(self, job_id, worker_id):
+        """Queues a job again, e.g. when its pool is stopped"""
+        with self._transaction():
+            self.db.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, "
+                "attempts = attempts - 1 WHERE id = ? AND worker = ? AND "
+                "status = 'running'", (job_id, worker_id))
+
+    def finish(self, job_id, worker_id, statuscode, error=None):
+        with self._transaction():
+            self.db.execute(
+                "UPDATE jobs SET status = ?, statuscode = ?, error = ?, "
+                "finished = ? WHERE id = ? AND worker = ?",
+                ("succeeded" if statuscode == 0 else "failed", statuscode,
+                 error, time.time(), job_id, worker_id))
+
+    def add_events(self, job_id, events):
+        with self._transaction():
+            self.db.executemany(
+                "INSERT INTO events VALUES (?, ?, ?)",
+                [(job_id, e.get("time", time.time()),
+                  json.dumps(e, sort_keys=True)) for e in events])
+
+    def get_events(self, job_id, after=0):
+        """
+          Returns [(seq, event)] for the events of a job, after the event
+          seq `after`, so that callers can follow a running job.
+        """
+        rows = self.db.execute(
+            "SELECT rowid, event FROM events WHERE job_id = ? AND rowid > ? "
+            "ORDER BY rowid", (job_id, after))
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+
+def run_job(job, event_fd):
+    """
+      Entry point of the process running a job.  The events of the run are
+      written to event_fd as json lines, see events.py.  Exits with the
+      status of the playbooks.
+    """
+    from f5_aws.environment_manager import (EnvironmentManagerFactory,
+                                            lock_environment)
+    from f5_aws.events import EventStream
+
+    events = EventStream("fd:%d" % event_fd)
+    statuscode = 1
+    try:
+        log_path = get_job_log_path(job["id"])
+        log = open(log_path, "a")
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+
+        with lock_environment(job["env"]):
+            em = EnvironmentManagerFactory(
+                env_name=job["env"], cmd=job["cmd"],
+                extra_vars=job["extra_vars"],
+                event_stream="fd:%d" % event_fd)
+            exec_results = getattr(em, job["cmd"])()
+        exec_results["playbook_results"].print_playbook_results()
+        statuscode = exec_results["playbook_results"].statuscode
+    except BaseException, e:
+        error = str(e) or e.__class__.__name__
+        print >>sys.stderr, "ERROR: %s" % error
+        events.write({"event": "job_error", "time": time.time(),
+                      "error": error})
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(statuscode)
+
+
+def run_workers(queue, concurrency=4, lease=LEASE_TIMEOUT, run=run_job,
+                exit_when_idle=False, poll_interval=2):
+    """
+      Runs the jobs of the queue, each in its own process with at most
+      `concurrency` running at once.  The events of each job are read here
+      and stored in the queue.  Returns when interrupted, or when the queue
+      is empty if exit_when_idle.
+    """
+    worker_id = get_worker_id()
+    job_dir = os.path.dirname(get_job_log_path(0))
+    if not os.path.isdir(job_dir):
+        os.makedirs(job_dir)
+
+    # job id => (process, pipe, partial line, error)
+    running = {}
+    renewed = time.time()
+
+    try:
+        while True:
+            while len(running) < concurrency:
+                job = queue.claim(worker_id, lease)
+                if job is None:
+                    break
+                read_fd, write_fd = os.pipe()
+                process = multiprocessing.Process(
+                    target=run, args=(job, write_fd))
+                process.start()
+                os.close(write_fd)
+                running[job["id"]] = [process, read_fd, "", None]
+
+            if not running:
+                if exit_when_idle:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            pipes = dict((r[1], job_id) for job_id, r in running.items())
+            try:
+                readable = select.select(list(pipes), [], [], poll_interval)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+
+            for fd in readable:
+                job_id = pipes[fd]
+                data = os.read(fd, 65536)
+                if data:
+                    _store_events(queue, job_id, running[job_id], data)
+                    continue
+
+                # the job's process (and the processes it forked) are done
+                process, read_fd, partial, error = running.pop(job_id)
+                os.close(read_fd)
+                process.join()
+                queue.finish(job_id, worker_id, process.exitcode, error)
+
+            if time.time() - renewed > lease / 3.0:
+                for job_id in running:
+                    queue.renew(job_id, worker_id, lease)
+                renewed = time.time()
+    finally:
+        # interrupted, the jobs will be picked up by the next pool
+        for job_id, (process, read_fd, partial, error) in running.items():
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            queue.release(job_id, worker_id)
+
+
+def _store_events(queue, job_id, entry, data):
+    lines = (entry[2] + data).split("\n")
+    entry[2] = lines.pop()
+    events = []
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if event.get("event") == "job_error":
+            entry[3] = event["error"]
+        events.append(event)
+    if events:
+        queue.add_events(job_id, events)
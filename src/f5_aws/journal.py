@@ -0,0 +1,263 @@
+# journal.py
+
+"""
+Keeps track of the deploy playbooks which completed successfully for an
+environment, so that `deploy --resume` can skip them after a failure.
+
+For every job (a playbook, or a playbook limited to one host) we record a
+hash of its inputs: the inventory written by `init`, the extra_vars, the
+playbook itself and the CloudFormation templates.  A job is only skipped
+if these are unchanged since it last succeeded.
+
+The journal also keeps, for every playbook, a hash of the inputs of each
+host it completed on (see HostInputs).  Incremental deploys compare these
+with the current inventory to find the hosts which are new or changed, see
+deploy_plan.py.
+"""
+
+import re
+import os
+import json
+import time
+import hashlib
+
+from f5_aws.config import Config
+from f5_aws.deploy_graph import split_job, get_job_name
+from f5_aws.inventory_cache import inventory_cache, get_inventory_digest
+
+
+# group_vars files written by the CloudFormation playbooks themselves
+#  (see roles/infra/tasks/deploy_vpc_cft.yml, deploy_az_cft.yml).  These
+#  are outputs of earlier jobs rather than inputs chosen by the user.
+GENERATED_VARS_FILES = "^(vpc|managers|zone[0-9]+|zone[0-9]+-az-managers)$"
+
+# extra_vars which select what to run, but do not change what is deployed
+IGNORED_EXTRA_VARS = ["run_only"]
+
+
+def get_templates_digest():
+    """Hash of the CloudFormation templates used by the deploy playbooks"""
+    digest = hashlib.sha1()
+    templates_dir = "{}/roles/infra/files".format(Config().config["install_path"])
+    for fname in sorted(os.listdir(templates_dir)):
+        with open(os.path.join(templates_dir, fname)) as f:
+            digest.update(fname)
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_job_inputs(playbook_path, inventory_path, extra_vars, limit=None):
+    """
+      Returns a hash of everything a deploy job depends on.  A job run with
+      --limit (limit) only completed on some of its hosts, so it has other
+      inputs than the same job run against the whole inventory.
+    """
+    digest = hashlib.sha1()
+    if limit is not None:
+        digest.update("limit:%s" % limit)
+    digest.update(get_inventory_digest(inventory_path,
+                                       exclude=GENERATED_VARS_FILES))
+    digest.update(json.dumps(
+        dict((k, v) for k, v in extra_vars.items() if k not in IGNORED_EXTRA_VARS),
+        sort_keys=True, default=str))
+    with open(playbook_path) as f:
+        digest.update(f.read())
+    digest.update(get_templates_digest())
+    return digest.hexdigest()
+
+
+def get_playbook_path(playbook):
+    return "{}/playbooks/{}".format(Config().config["install_path"], playbook)
+
+
+class HostInputs(object):
+    """
+      Hashes of what a job depends on for each of the hosts it runs against:
+      the variables of the host as rendered from the inventory, the
+      extra_vars, the playbook and the CloudFormation templates.  Variables
+      written by the CloudFormation playbooks themselves (subnet ids etc, see
+      GENERATED_VARS_FILES) are left out.
+
+      Unlike get_job_inputs(), a change to one host (or a new host) does
+      not change the inputs of the others.  With a limit (--limit), only the
+      hosts matching it are considered.
+    """
+
+    def __init__(self, inventory_path, extra_vars, limit=None):
+        self.inventory_path = inventory_path
+        self.extra_vars = extra_vars
+        self.limit = limit
+        self._inventory = None
+        self._generated_vars = None
+        self._host_vars = {}
+        self._playbooks = {}
+
+    def get_inventory(self):
+        if self._inventory is None:
+            self._inventory = inventory_cache.get(self.inventory_path)
+        return self._inventory
+
+    def get_generated_vars(self):
+        """Names of the variables defined in generated group_vars files"""
+        if self._generated_vars is None:
+            import yaml
+
+            self._generated_vars = set()
+            group_vars = os.path.join(os.path.dirname(
+                os.path.abspath(self.inventory_path)), "group_vars")
+            if os.path.isdir(group_vars):
+                for fname in os.listdir(group_vars):
+                    if not re.match(GENERATED_VARS_FILES, fname):
+                        continue
+                    with open(os.path.join(group_vars, fname)) as f:
+                        data = yaml.safe_load(f)
+                    if isinstance(data, dict):
+                        self._generated_vars.update(data)
+        return self._generated_vars
+
+    def get_host_digest(self, host):
+        if host not in self._host_vars:
+            generated = self.get_generated_vars()
+            variables = dict(
+                (k, v) for k, v in self.get_inventory().get_variables(host).items()
+                if k not in generated)
+            self._host_vars[host] = hashlib.sha1(json.dumps(
+                variables, sort_keys=True, default=str)).hexdigest()
+        return self._host_vars[host]
+
+    def get_playbook_digest(self, playbook):
+        if playbook not in self._playbooks:
+            digest = hashlib.sha1()
+            digest.update(json.dumps(
+                dict((k, v) for k, v in self.extra_vars.items()
+                     if k not in IGNORED_EXTRA_VARS),
+                sort_keys=True, default=str))
+            with open(get_playbook_path(playbook)) as f:
+                digest.update(f.read())
+            digest.update(get_templates_digest())
+            self._playbooks[playbook] = digest.hexdigest()
+        return self._playbooks[playbook]
+
+    def get_job_hosts(self, job):
+        """The hosts targeted by the plays of the job's playbook, within its limit"""
+        # ansible is only imported when it is needed, see cli.py
+        from f5_aws.playbook_runner import get_play_host_patterns
+
+        playbook, limit = split_job(job)
+        inventory = self.get_inventory()
+        hosts = set()
+        for pattern in get_play_host_patterns(get_playbook_path(playbook)):
+            # groups created while the playbook runs (group_by, add_host)
+            if "{{" not in pattern:
+                hosts.update(inventory.list_hosts(pattern))
+        for pattern in [limit, self.limit]:
+            if pattern is not None:
+                hosts.intersection_update(inventory.list_hosts(pattern))
+        return sorted(hosts)
+
+    def get(self, job):
+        """Returns {host: inputs} for the hosts the job runs against"""
+        playbook, limit = split_job(job)
+        playbook_digest = self.get_playbook_digest(playbook)
+        return dict(
+            (host, hashlib.sha1(playbook_digest + self.get_host_digest(host)).hexdigest())
+            for host in self.get_job_hosts(job))
+
+
+class DeployJournal(object):
+    """
+      Journal of completed jobs, persisted as json in
+      ~/vars/f5aws/env/<env>/deploy_journal.json
+    """
+
+    def __init__(self, env_name, path=None):
+        self.path = path or "{}/{}/deploy_journal.json".format(
+            Config().config["env_path"], env_name)
+        self.jobs = {}
+        # playbook => {host: inputs}, for the hosts it last completed on
+        self.host_inputs = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            self.jobs = data.get("jobs", {})
+            self.host_inputs = data.get("host_inputs", {})
+
+    def is_complete(self, job, inputs):
+        entry = self.jobs.get(get_job_name(job))
+        return (entry is not None and entry["status"] == "ok" and
+                entry["inputs"] == inputs)
+
+    def get_completed_hosts(self, job, inputs):
+        """Hosts which completed this job, when it was last run with these inputs"""
+        entry = self.jobs.get(get_job_name(job))
+        if entry is None or entry["inputs"] != inputs:
+            return []
+        return sorted(h for h, status in entry["hosts"].items() if status == "ok")
+
+    def get_changed_hosts(self, playbook, host_inputs):
+        """
+          Hosts of host_inputs which did not complete the playbook with these
+          inputs, mapped to "new" or "changed"
+        """
+        recorded = self.host_inputs.get(playbook, {})
+        changed = {}
+        for host, inputs in host_inputs.items():
+            if host not in recorded:
+                changed[host] = "new"
+            elif recorded[host] != inputs:
+                changed[host] = "changed"
+        return changed
+
+    def get_removed_hosts(self, playbook, host_inputs):
+        """Hosts the playbook completed on which are no longer in host_inputs"""
+        return sorted(set(self.host_inputs.get(playbook, {})) - set(host_inputs))
+
+    def record(self, job, inputs, statuscode, host_stats, completed_hosts=[],
+               host_inputs=None, limited=False):
+        """
+          Records the outcome of a job.  host_stats maps each host to the
+          summary returned by ansible's AggregateStats.summarize(),
+          completed_hosts were skipped as they completed in a previous run.
+          host_inputs are the inputs of each host the job ran against (see
+          HostInputs), kept for the hosts on which it succeeded.  limited
+          is True if the run was limited to some of the hosts (--limit).
+        """
+        hosts = dict((h, "ok") for h in completed_hosts)
+        for h, t in host_stats.items():
+            if t["failures"] > 0 or t["unreachable"] > 0:
+                hosts[h] = "failed"
+            else:
+                hosts[h] = "ok"
+
+        if host_inputs is not None:
+            playbook, limit = split_job(job)
+            recorded = self.host_inputs.setdefault(playbook, {})
+            if limit is None and not limited:
+                # forget the hosts which were removed from the inventory
+                for h in set(recorded) - set(host_inputs):
+                    del recorded[h]
+            for h, host_input in host_inputs.items():
+                if statuscode == 0 or hosts.get(h) == "ok":
+                    recorded[h] = host_input
+                else:
+                    recorded.pop(h, None)
+
+        self.jobs[get_job_name(job)] = {
+            "inputs": inputs,
+            "status": "ok" if statuscode == 0 else "failed",
+            "statuscode": statuscode,
+            "hosts": hosts,
+            "completed": time.time()
+        }
+        self.save()
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return
+        # an interrupted write must not leave a truncated journal behind,
+        #  --resume and the deploy plan depend on it
+        tmp_path = "{}.{}".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"jobs": self.jobs, "host_inputs": self.host_inputs},
+                      f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,148 @@
+# live_status.py
+
+"""
+The live state of the CloudFormation stacks of our environments, for
+`info resources --live`.  The state otherwise shown is the one recorded by
+the last deploy or teardown, which does not tell us about stacks deleted or
+rolled back outside of this tool.
+
+All the stacks of a region are listed with a few paginated describe_stacks
+calls rather than one call per host, the regions are queried concurrently.
+The stacks found are kept in ~/vars/f5aws/live_status/<region>.json for
+LIVE_STATUS_TTL seconds, so that several info commands in a row (or several
+environments in the same region) share a single listing.
+"""
+
+import os
+import json
+import time
+import threading
+
+import boto.cloudformation
+
+from f5_aws.config import Config
+from f5_aws.exceptions import ExecutionError
+
+
+LIVE_STATUS_TTL = 30  # seconds
+
+
+def get_live_status_path():
+    return "{}/live_status".format(Config().config["vars_path"])
+
+
+def get_stack_state(stack_status):
+    """Maps the status of a CloudFormation stack to the states we display"""
+    if stack_status is None:
+        return "absent"
+    if stack_status in ("CREATE_COMPLETE", "UPDATE_COMPLETE"):
+        return "deployed"
+    if stack_status.endswith("_IN_PROGRESS"):
+        return "in progress"
+    if stack_status == "DELETE_FAILED":
+        return "teardown-error"
+    # ROLLBACK_COMPLETE, CREATE_FAILED, UPDATE_ROLLBACK_COMPLETE, ...
+    return "deploy-error"
+
+
+def describe_region_stacks(conn):
+    """
+      Returns {stack_name: {"stack_status", "outputs"}} for all the stacks of
+      the region conn is connected to, following the pagination tokens.
+    """
+    stacks = {}
+    next_token = None
+    while True:
+        page = conn.describe_stacks(next_token=next_token)
+        for stack in page:
+            stacks[stack.stack_name] = {
+                "stack_status": stack.stack_status,
+                "outputs": dict((o.key, o.value) for o in stack.outputs)
+            }
+        next_token = getattr(page, "next_token", None)
+        if not next_token:
+            return stacks
+
+
+class LiveStatus(object):
+    """
+      connect(region) returns a boto CloudFormationConnection, it may be
+      replaced to point at another endpoint (e.g. a local moto server).
+    """
+
+    def __init__(self, cache_path=None, cache_ttl=LIVE_STATUS_TTL,
+                 connect=boto.cloudformation.connect_to_region):
+        self.cache_path = get_live_status_path() if cache_path is None \
+            else cache_path
+        self.cache_ttl = cache_ttl
+        self.connect = connect
+
+    def get_region_stacks(self, region):
+        """The stacks of a region, from the cache if it is recent enough"""
+        cache_file = os.path.join(self.cache_path, "{}.json".format(region))
+        try:
+            if time.time() - os.path.getmtime(cache_file) < self.cache_ttl:
+                with open(cache_file) as f:
+                    return json.load(f)
+        except (OSError, IOError, ValueError):
+            pass
+
+        conn = self.connect(region)
+        if conn is None:
+            raise ExecutionError(
+                "Could not connect to CloudFormation in region %s" % region)
+        stacks = describe_region_stacks(conn)
+
+        # write to a temporary file first, other processes may be reading
+        try:
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            tmp_file = "{}.{}".format(cache_file, os.getpid())
+            with open(tmp_file, "w") as f:
+                json.dump(stacks, f)
+            os.rename(tmp_file, cache_file)
+        except (OSError, IOError):
+            pass
+
+        return stacks
+
+    def get_stacks(self, regions):
+        """
+          Returns {region: {stack_name: ...}}, one thread per region.  Raises
+          ExecutionError if any of the regions could not be listed.
+        """
+        stacks = {}
+        errors = {}
+
+        def worker(region):
+            try:
+                stacks[region] = self.get_region_stacks(region)
+            except Exception, e:
+                errors[region] = e
+
+        threads = [threading.Thread(target=worker, args=(region,))
+                   for region in set(regions)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise ExecutionError("Failed to describe stacks: %s" % ", ".join(
+                "%s: %s" % (r, e) for r, e in sorted(errors.items())))
+        return stacks
+
+    def get_env_stacks(self, env_regions):
+        """
+          Takes {env_name: region} and returns {env_name: {host: stack}} for
+          the stacks named <env_name>-<host>.
+        """
+        stacks = self.get_stacks(env_regions.values())
+        env_stacks = {}
+        for env_name, region in env_regions.items():
+            prefix = env_name + "-"
+            env_stacks[env_name] = dict(
+                (name[len(prefix):], stack)
+                for name, stack in stacks[region].items()
+                if name.startswith(prefix))
+        return env_stacks
@@ -6,7 +6,9 @@ import re
 import os
 import stat
 import time
+import sqlite3
 import datetime
+import multiprocessing
 
 # ansible stuff
 import ansible.playbook
@@ -18,9 +20,19 @@ from ansible.color import ANSIBLE_COLOR, stringc
 from ansible.callbacks import display
 
 from f5_aws.config import Config
+from f5_aws.deploy_graph import split_job, get_job_name, PER_HOST_PLAYBOOKS
+from f5_aws.inventory_cache import inventory_cache
+from f5_aws.journal import get_job_inputs, HostInputs
+from f5_aws.timeline import (TimelineFile, TimelineRecorder,
+                             TimelinePlaybookCallbacks, TimelineRunnerCallbacks,
+                             get_timeline_path, new_run_id, load_timeline)
+from f5_aws.run_history import RunHistory
+from f5_aws.events import EventStream
 
-# make our config global
-config = Config().config
+
+# most tasks are REST calls delegated to localhost or CloudFormation waits,
+#  which spend their time blocked on I/O rather than using the CPU
+FORKS_PER_CPU = 8
 
 
 def hostcolor(host, stats, color=True):
@@ -43,6 +55,52 @@ def colorize(lead, num, color):
         return "%s=%-4s" % (lead, str(num))
 
 
+def get_play_host_patterns(playbook_path):
+    """Returns the `hosts:` pattern of each play in the playbook"""
+    patterns = []
+    for play in utils.parse_yaml_from_file(playbook_path) or []:
+        if isinstance(play, dict) and "hosts" in play:
+            hosts = play["hosts"]
+            if isinstance(hosts, list):
+                hosts = ":".join(hosts)
+            patterns.append(hosts)
+    return patterns
+
+
+def get_forks(playbook_path, inventory, max_forks):
+    """
+      Returns enough forks to run each task of the playbook on all of its
+      hosts at once, but at most max_forks.  Groups which are only created
+      while the playbook runs (group_by, add_host) are not counted.
+    """
+    hosts = 1
+    for pattern in get_play_host_patterns(playbook_path):
+        if "{{" in pattern:
+            continue
+        try:
+            hosts = max(hosts, len(inventory.list_hosts(pattern)))
+        except errors.AnsibleError:
+            continue
+    return max(1, min(hosts, max_forks))
+
+
+def _playbook_worker(runner, job, results):
+    """
+      Entry point for the worker processes started by
+      PlaybookRunner._run_scheduled().  Reports the status code of the
+      playbook back to the scheduler, even if the playbook blew up.
+    """
+    statuscode = 1
+    hits, misses = inventory_cache.hits, inventory_cache.misses
+    try:
+        statuscode = runner._run_playbook(job)
+    except errors.AnsibleError, e:
+        display("ERROR: %s" % e, color="red")
+    finally:
+        results.put((job, statuscode, runner.host_stats.get(job, {}),
+                     inventory_cache.hits - hits, inventory_cache.misses - misses))
+
+
 class PlaybookRunner(object):
     """
       This class is used to execute a set of ansible playbooks
@@ -50,20 +108,69 @@ class PlaybookRunner(object):
       Playbooks are executed using the run method, which reloads the
       inventory between each playbook.  This is slightly different than the
       way that ansible-playbook command typically handles things.  It only loads
-      the inventory once for a set of playbooks. 
+      the inventory once for a set of playbooks. A cached copy is used when
+      the inventory files have not changed, see inventory_cache.py.
+
+      When a dependency graph is provided (see deploy_graph.py), playbooks
+      are executed as soon as the playbooks they depend on have completed.
+      Each playbook runs in its own worker process, with at most
+      options.parallel playbooks running at once.  The graph may also hold
+      (playbook, host) jobs, see deploy_graph.get_pipeline().
+
+      If a journal is given (see journal.py), the outcome of every job is
+      recorded in it, along with the inputs of each host it ran against.
+      With resume=True, jobs which already completed with the same inputs
+      are skipped, as long as everything they depend on was skipped too.
+
+      Runs for an environment (extra_vars contains env_name) record the
+      start and end of every playbook, play, task and host result in the
+      environment's timeline, see timeline.py.  The same events are
+      written to options.event_stream if given, see events.py, and the
+      timings are added to the run history once the run is over, see
+      run_history.py.
+
+      The number of forks for each playbook is sized from the hosts its
+      plays target, capped at options.max_forks (by default FORKS_PER_CPU
+      per cpu).  options.forks overrides this for every playbook.
+
+      options.limit (--limit) restricts every playbook of the run to the
+      hosts matching it, as ansible-playbook --limit does.  Playbooks with
+      no host left are skipped.
     """
-    config = config
 
-    def __init__(self, playbooks, settings, inventory_path, options, extra_vars):
+    def __init__(self, playbooks, settings, inventory_path, options, extra_vars,
+                 dependencies=None, journal=None, resume=False):
 
         self.inventory_path = inventory_path
         self.extra_vars = extra_vars
         self.playbooks = playbooks
+        self.dependencies = dependencies
+        self.max_parallel = max(1, getattr(options, "parallel", 1) or 1)
+        self.limit = getattr(options, "limit", None)
         self.runtime = 0  # seconds
+        self.inventory_cache_hits = 0
+        self.inventory_cache_misses = 0
+        self.journal = journal
+        self.resume = resume
+        self.job_inputs = {}
+        self.job_host_inputs = {}
+        self.host_inputs = None
+        self.host_stats = {}
+        self.skipped = []
+        self.run_id = new_run_id()
+        self.event_sinks = []
+        self.timeline_path = None
+        if extra_vars.get("env_name"):
+            self.timeline_path = get_timeline_path(extra_vars["env_name"])
+            self.event_sinks.append(TimelineFile(self.timeline_path))
+        if getattr(options, "event_stream", None):
+            self.event_sinks.append(EventStream(options.event_stream))
 
         # Ansible defaults carried over from `ansible-playbook`.
         self.options = options
-        self.options.forks = ansible.constants.DEFAULT_FORKS
+        self.forks = getattr(options, "forks", None)
+        self.max_forks = (getattr(options, "max_forks", None) or
+                          multiprocessing.cpu_count() * FORKS_PER_CPU)
         self.options.module_path = ansible.constants.DEFAULT_MODULE_PATH
         self.options.remote_user = ansible.constants.DEFAULT_REMOTE_USER
         self.options.timeout = ansible.constants.DEFAULT_TIMEOUT
@@ -87,6 +194,14 @@ class PlaybookRunner(object):
           display_color = 'red'
         display("Ran playbooks {}. \n Total time was {}".format(self.playbooks,
           datetime.timedelta(seconds=self.runtime)), color=display_color)
+        display(" Inventory cache: {} hits, {} misses".format(
+          self.inventory_cache_hits, self.inventory_cache_misses), color=display_color)
+        if self.skipped:
+          display(" Skipped (completed in a previous run): {}".format(
+            [get_job_name(job) for job in self.skipped]), color=display_color)
+
+    def get_playbook_path(self, playbook):
+        return "{}/playbooks/{}".format(Config().config["install_path"], playbook)
 
     def run(self):
         """
@@ -96,14 +211,7 @@ class PlaybookRunner(object):
         tstart = time.time()
 
         # get the absolute path for the playbooks
-        self.playbooks = [
-            "{}/playbooks/{}".format(config["install_path"], pb) for pb in self.playbooks]
-
-        # Ansible defaults carried over from `ansible-playbook`.
-        sshpass = None
-        sudopass = None
-        su_pass = None
-        vault_pass = None
+        self.playbooks = [self.get_playbook_path(pb) for pb in self.playbooks]
 
         for playbook in self.playbooks:
             if not os.path.exists(playbook):
@@ -113,108 +221,385 @@ class PlaybookRunner(object):
                 raise errors.AnsibleError(
                     "the playbook: %s does not appear to be a file" % playbook)
 
-        for playbook in self.playbooks:
+        hits, misses = inventory_cache.hits, inventory_cache.misses
+        self._record_event("run_start", playbooks=[
+            os.path.basename(pb) for pb in self.playbooks])
+
+        self.statuscode = 0
+        if self.dependencies is None:
+            for playbook in self.playbooks:
+                job = os.path.basename(playbook)
+                # skip only while every earlier playbook was skipped as well
+                run_job = self._prepare_job(
+                    job, len(self.skipped) == self.playbooks.index(playbook))
+                if run_job is None:
+                    continue
+                self.statuscode = self._run_playbook(run_job)
+                self._finish_job(job, run_job, self.statuscode,
+                                 self.host_stats.get(run_job, {}))
+                if self.statuscode != 0:
+                    break
+        else:
+            # parse the inventory before forking, so the workers share it
+            inventory_cache.get(self.inventory_path)
+            self.statuscode = self._run_scheduled()
+
+        self.inventory_cache_hits += inventory_cache.hits - hits
+        self.inventory_cache_misses += inventory_cache.misses - misses
+        self.runtime = time.time() - tstart
+        self._record_event("run_end", statuscode=self.statuscode,
+                           runtime=self.runtime,
+                           skipped=[get_job_name(j) for j in self.skipped])
+        if self.timeline_path is not None:
+            self._record_history()
+
+    def _record_history(self):
+        events = load_timeline(self.timeline_path, self.run_id)
+        if not events:
+            return
+        # init passes the deployment model as extra vars, later commands
+        #  find it in the inventory it wrote
+        env_vars = dict(self.extra_vars)
+        if os.path.isfile(self.inventory_path):
+            env_vars.update(inventory_cache.get(
+                self.inventory_path).get_group("all").vars)
+        try:
+            history = RunHistory()
+            history.record_run(self.run_id, self.extra_vars["env_name"],
+                               env_vars.get("deployment_model"),
+                               env_vars.get("region"), events, self.statuscode)
+            history.close()
+        except sqlite3.Error, e:
+            display("WARNING: could not update the run history: %s" % e,
+                    color="yellow")
+
+    def _record_event(self, event, job=None, **fields):
+        if self.event_sinks:
+            TimelineRecorder(self.event_sinks, self.run_id, job).record(
+                event, **fields)
+
+    def _prepare_job(self, job, may_skip=True):
+        """
+          Returns the job to run, or None if the journal shows that the job
+          completed in a previous run with the same inputs.  Per-host playbooks
+          which previously completed on some of their hosts are resumed on
+          the remaining hosts only.
+        """
+        if self.journal is None:
+            return job
+
+        playbook, limit = split_job(job)
+        inputs = get_job_inputs(self.get_playbook_path(playbook),
+                                self.inventory_path, self.extra_vars,
+                                self.limit)
+        self.job_inputs[job] = inputs
+        if self.host_inputs is None:
+            self.host_inputs = HostInputs(self.inventory_path, self.extra_vars,
+                                          self.limit)
+        self.job_host_inputs[job] = self.host_inputs.get(job)
+
+        if not (self.resume and may_skip):
+            return job
+
+        if self.journal.is_complete(job, inputs):
+            display("Skipping %s, it completed in a previous run with the same inputs" %
+                    get_job_name(job), color="green", stderr=False)
+            self.skipped.append(job)
+            self._record_event("playbook_skipped", get_job_name(job))
+            return None
+
+        completed = self.journal.get_completed_hosts(job, inputs)
+        if limit is None and completed and playbook in PER_HOST_PLAYBOOKS:
+            display("Resuming %s, skipping hosts %s" % (playbook, completed),
+                    color="green", stderr=False)
+            return (playbook, ":".join(["all"] + ["!" + h for h in completed]))
+
+        return job
+
+    def _finish_job(self, job, run_job, statuscode, host_stats):
+        self.host_stats[job] = host_stats
+        if self.journal is not None:
+            completed = []
+            if run_job != job:
+                completed = self.journal.get_completed_hosts(
+                    job, self.job_inputs[job])
+            self.journal.record(job, self.job_inputs[job], statuscode,
+                                host_stats, completed,
+                                host_inputs=self.job_host_inputs.get(job),
+                                limited=self.limit is not None)
+
+    def _run_scheduled(self):
+        """
+          Executes the playbooks in self.dependencies, starting each one in a
+          new worker process once all of its dependencies have succeeded.
+          Ansible forks its own workers for each task, so we cannot use a
+          multiprocessing.Pool here (its daemonic workers may not have children).
+
+          After the first failure no new playbooks are started, the playbooks
+          which are already running are allowed to finish.
+        """
+        pending = [job for job in self.dependencies]
+        # keep the order in which the playbooks were handed to us
+        order = dict((pb, i) for i, pb in enumerate(
+            [os.path.basename(p) for p in self.playbooks]))
+        pending.sort(key=lambda job: (order.get(split_job(job)[0], len(order)),
+                                      get_job_name(job)))
+
+        done = set()
+        running = {}
+        results = multiprocessing.Queue()
+        statuscode = 0
+
+        try:
+            while pending or running:
+                progress = statuscode == 0
+                while progress:
+                    progress = False
+                    for job in list(pending):
+                        if len(running) >= self.max_parallel:
+                            break
+                        deps = self.dependencies[job]
+                        if not all(dep in done for dep in deps):
+                            continue
+
+                        pending.remove(job)
+                        run_job = self._prepare_job(
+                            job, all(dep in self.skipped for dep in deps))
+                        if run_job is None:
+                            done.add(job)
+                            progress = True
+                            continue
+
+                        worker = multiprocessing.Process(
+                            target=_playbook_worker, args=(self, run_job, results))
+                        worker.start()
+                        running[run_job] = (job, worker)
+
+                if not running:
+                    if not pending:
+                        break
+                    if statuscode == 0:
+                        raise errors.AnsibleError(
+                            "unable to schedule playbooks %s, their dependencies "
+                            "can never be satisfied" % [get_job_name(j) for j in pending])
+                    break
+
+                run_job, code, host_stats, hits, misses = results.get()
+                job, worker = running.pop(run_job)
+                worker.join()
+                self.inventory_cache_hits += hits
+                self.inventory_cache_misses += misses
+                self._finish_job(job, run_job, code, host_stats)
+                if code == 0:
+                    done.add(job)
+                elif statuscode == 0:
+                    statuscode = code
+        except KeyboardInterrupt:
+            for job, worker in running.values():
+                worker.terminate()
+            raise
+
+        return statuscode
+
+    def _run_playbook(self, job):
+        """
+          Runs a single playbook against the inventory, returns the status code.
+          The job is either a playbook or a (playbook, limit) tuple, in which
+          case the inventory is limited to the hosts matching the limit.
+
+          If some hosts fail or are unreachable, the playbook is run again,
+          up to options.retries times.  The wait before each retry starts at
+          options.retry_delay seconds and doubles with every attempt.  The
+          per-host playbooks are run again against only those hosts.  The
+          other playbooks join the results of every host (e.g. the seeds of
+          cluster_bigips.yml are gathered with add_host), they are run again
+          as a whole.
+        """
+        playbook, limit = split_job(job)
+        retries = getattr(self.options, "retries", 0) or 0
+        retry_delay = getattr(self.options, "retry_delay", 0) or 0
+
+        recorder = None
+        if self.event_sinks:
+            name, requires = self._get_timeline_job(job)
+            recorder = TimelineRecorder(self.event_sinks, self.run_id, name)
+            recorder.record("playbook_start", requires=requires)
+
+        attempt = 0
+        while True:
+            statuscode, retry_hosts, pb = self._run_playbook_once(
+                job, playbook, limit, recorder)
+            if not retry_hosts or attempt >= retries:
+                break
+
+            attempt += 1
+            delay = retry_delay * 2 ** (attempt - 1)
+            per_host = playbook in PER_HOST_PLAYBOOKS
+            display("Retrying %s on %s in %s seconds (retry %s of %s)" % (
+                playbook, retry_hosts if per_host else "all hosts", delay,
+                attempt, retries), color="yellow")
+            time.sleep(delay)
+            if per_host:
+                limit = ":".join(retry_hosts)
+
+        if retry_hosts and pb is not None:
+            filename = pb.generate_retry_inventory(retry_hosts)
+            if filename:
+                display(
+                    "     to retry, use: --limit @%s\n" % filename)
+
+        if recorder is not None:
+            recorder.record("playbook_end", statuscode=statuscode)
+
+        return statuscode
+
+    def _get_timeline_job(self, job):
+        """Returns the name of the job and of the jobs it had to wait for"""
+        playbook, limit = split_job(job)
+        if self.dependencies is None:
+            # serial run, each playbook waits for the one before it
+            names = [os.path.basename(p) for p in self.playbooks]
+            i = names.index(playbook)
+            return playbook, names[max(0, i - 1):i]
+        if job not in self.dependencies:
+            # resumed on the remaining hosts, see _prepare_job()
+            job = playbook
+        return get_job_name(job), [get_job_name(dep) for dep in
+                                   self.dependencies.get(job, [])]
+
+    def _run_playbook_once(self, job, playbook, limit, recorder=None):
+        """
+          Returns the status code, the hosts which failed or were unreachable
+          and the ansible PlayBook object (None if --limit left no hosts).
+        """
+
+        # Ansible defaults carried over from `ansible-playbook`.
+        sshpass = None
+        sudopass = None
+        su_pass = None
+        vault_pass = None
+
+        playbook = self.get_playbook_path(os.path.basename(playbook))
+        if limit is None:
             display("Running playbook: %s" %
                     playbook, color="green", stderr=False)
+        else:
+            display("Running playbook: %s (limit: %s)" %
+                    (playbook, limit), color="green", stderr=False)
 
-            stats = callbacks.AggregateStats()
+        stats = callbacks.AggregateStats()
+        if recorder is None:
             playbook_cb = callbacks.PlaybookCallbacks(verbose=utils.VERBOSITY)
             runner_cb = callbacks.PlaybookRunnerCallbacks(
                 stats, verbose=utils.VERBOSITY)
-            inventory = ansible.inventory.Inventory(
-                self.inventory_path, vault_password=vault_pass)
-
-            if len(inventory.list_hosts()) == 0:
-                raise errors.AnsibleError("provided hosts list is empty")
-
-            pb = ansible.playbook.PlayBook(
-                playbook=playbook,
-                module_path=self.options.module_path,
-                inventory=inventory,
-                forks=self.options.forks,
-                remote_user=self.options.remote_user,
-                remote_pass=sshpass,
-                callbacks=playbook_cb,
-                runner_callbacks=runner_cb,
-                stats=stats,
-                timeout=self.options.timeout,
-                transport=self.options.connection,
-                sudo=self.options.sudo,
-                sudo_user=self.options.sudo_user,
-                sudo_pass=sudopass,
-                extra_vars=self.extra_vars,
-                check=self.options.check,
-                diff=self.options.diff,
-                su=self.options.su,
-                su_pass=su_pass,
-                su_user=self.options.su_user,
-                vault_password=vault_pass,
-                force_handlers=self.options.force_handlers
-            )
-
-            failed_hosts = []
-            unreachable_hosts = []
-
-            try:
-                pb.run()
-
-                hosts = sorted(pb.stats.processed.keys())
-                display(callbacks.banner("PLAY RECAP"))
-                playbook_cb.on_stats(pb.stats)
-
-                for h in hosts:
-                    t = pb.stats.summarize(h)
-                    if t["failures"] > 0:
-                        failed_hosts.append(h)
-                    if t["unreachable"] > 0:
-                        unreachable_hosts.append(h)
-
-                retries = failed_hosts + unreachable_hosts
-
-                if len(retries) > 0:
-                    filename = pb.generate_retry_inventory(retries)
-                    if filename:
-                        display(
-                            "     to retry, use: --limit @%s\n" % filename)
-
-                for h in hosts:
-                    t = pb.stats.summarize(h)
-
-                    display("%s : %s %s %s %s" % (
-                        hostcolor(h, t),
-                        colorize("ok", t["ok"], "green"),
-                        colorize("changed", t["changed"], "yellow"),
-                        colorize("unreachable", t["unreachable"], "red"),
-                        colorize("failed", t["failures"], "red")),
-                        screen_only=True
-                    )
-
-                    display("%s : %s %s %s %s" % (
-                        hostcolor(h, t, False),
-                        colorize("ok", t["ok"], None),
-                        colorize("changed", t["changed"], None),
-                        colorize("unreachable", t["unreachable"], None),
-                        colorize("failed", t["failures"], None)),
-                        log_only=True
-                    )
-
-                print ""
-                tend = time.time()
-                self.runtime = tend - tstart
-
-                if len(failed_hosts) > 0:
-                    self.statuscode = 2
-                    return
-
-                if len(unreachable_hosts) > 0:
-                    self.statuscode = 3
-                    return
-
-                self.statuscode = 0
-
-            except errors.AnsibleError, e:
-                display("ERROR: %s" % e, color="red")
-                self.statuscode = 1
-                return
-
-        self.statuscode = 0
+        else:
+            playbook_cb = TimelinePlaybookCallbacks(
+                recorder, verbose=utils.VERBOSITY)
+            runner_cb = TimelineRunnerCallbacks(
+                recorder, stats, verbose=utils.VERBOSITY)
+        inventory = inventory_cache.get(
+            self.inventory_path, vault_password=vault_pass)
+        inventory.subset(limit)
+
+        if self.limit is not None:
+            # the hosts of this job which also match --limit.  The job's own
+            #  limit may be a list of hosts, so the two are not combined into
+            #  one pattern.
+            hosts = inventory.list_hosts(self.limit)
+            patterns = get_play_host_patterns(playbook)
+            if not any("{{" in pattern for pattern in patterns):
+                played = set()
+                for pattern in patterns:
+                    played.update(inventory.list_hosts(pattern))
+                hosts = [h for h in hosts if h in played]
+            if not hosts:
+                display("Skipping %s, none of its hosts match --limit %s" % (
+                    os.path.basename(playbook), self.limit),
+                    color="green", stderr=False)
+                return 0, [], None
+            inventory.subset(":".join(hosts))
+
+        if len(inventory.list_hosts()) == 0:
+            raise errors.AnsibleError("provided hosts list is empty")
+
+        forks = self.forks or get_forks(playbook, inventory, self.max_forks)
+
+        pb = ansible.playbook.PlayBook(
+            playbook=playbook,
+            module_path=self.options.module_path,
+            inventory=inventory,
+            forks=forks,
+            remote_user=self.options.remote_user,
+            remote_pass=sshpass,
+            callbacks=playbook_cb,
+            runner_callbacks=runner_cb,
+            stats=stats,
+            timeout=self.options.timeout,
+            transport=self.options.connection,
+            sudo=self.options.sudo,
+            sudo_user=self.options.sudo_user,
+            sudo_pass=sudopass,
+            extra_vars=self.extra_vars,
+            check=self.options.check,
+            diff=self.options.diff,
+            su=self.options.su,
+            su_pass=su_pass,
+            su_user=self.options.su_user,
+            vault_password=vault_pass,
+            force_handlers=self.options.force_handlers
+        )
+
+        failed_hosts = []
+        unreachable_hosts = []
+
+        try:
+            pb.run()
+
+            hosts = sorted(pb.stats.processed.keys())
+            display(callbacks.banner("PLAY RECAP"))
+            playbook_cb.on_stats(pb.stats)
+
+            for h in hosts:
+                t = pb.stats.summarize(h)
+                self.host_stats.setdefault(job, {})[h] = t
+                if t["failures"] > 0:
+                    failed_hosts.append(h)
+                if t["unreachable"] > 0:
+                    unreachable_hosts.append(h)
+
+            retries = failed_hosts + unreachable_hosts
+
+            for h in hosts:
+                t = pb.stats.summarize(h)
+
+                display("%s : %s %s %s %s" % (
+                    hostcolor(h, t),
+                    colorize("ok", t["ok"], "green"),
+                    colorize("changed", t["changed"], "yellow"),
+                    colorize("unreachable", t["unreachable"], "red"),
+                    colorize("failed", t["failures"], "red")),
+                    screen_only=True
+                )
+
+                display("%s : %s %s %s %s" % (
+                    hostcolor(h, t, False),
+                    colorize("ok", t["ok"], None),
+                    colorize("changed", t["changed"], None),
+                    colorize("unreachable", t["unreachable"], None),
+                    colorize("failed", t["failures"], None)),
+                    log_only=True
+                )
+
+            print ""
+
+            if len(failed_hosts) > 0:
+                return 2, retries, pb
+
+            if len(unreachable_hosts) > 0:
+                return 3, retries, pb
+
+            return 0, retries, pb
+
+        except errors.AnsibleError, e:
+            display("ERROR: %s" % e, color="red")
+            return 1, [], pb
@@ -0,0 +1,163 @@
+# run_history.py
+
+"""
+Keeps the timings of every run in a local SQLite database
+(~/vars/f5aws/run_history.db), so that we can see how long each stage of a
+deploy usually takes for a deployment model, and notice when a stage got
+slower.
+
+Each run is recorded from its timeline (see timeline.py) once it has
+finished:
+
+  runs    one row per PlaybookRunner.run(): env, model, region, status
+  stages  one row per job: the playbook, and the host for pipeline jobs
+  tasks   one row per task result on a host
+"""
+
+import re
+import json
+import math
+import sqlite3
+
+from f5_aws.config import Config
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY, env TEXT, model TEXT, region TEXT,
+    playbooks TEXT, started REAL, runtime REAL, statuscode INTEGER);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id TEXT, playbook TEXT, host TEXT, started REAL, ended REAL,
+    statuscode INTEGER);
+CREATE TABLE IF NOT EXISTS tasks (
+    run_id TEXT, playbook TEXT, host TEXT, task TEXT, duration REAL,
+    status TEXT);
+CREATE INDEX IF NOT EXISTS runs_model ON runs (model, started);
+CREATE INDEX IF NOT EXISTS stages_run ON stages (run_id);
+CREATE INDEX IF NOT EXISTS tasks_run ON tasks (run_id);
+"""
+
+
+def get_history_path():
+    return "{}/run_history.db".format(Config().config["vars_path"])
+
+
+def split_job_name(name):
+    """'deploy_bigip.yml[zone1-bigip1]' => ('deploy_bigip.yml', 'zone1-bigip1')"""
+    match = re.match(r"^(.*?)(?:\[(.*)\])?$", name)
+    return match.group(1), match.group(2)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class RunHistory(object):
+
+    def __init__(self, path=None):
+        self.path = path or get_history_path()
+        # several environments may finish at once (deploy-many)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record_run(self, run_id, env, model, region, events, statuscode):
+        """Records a run from its timeline events"""
+        # timeline.py imports ansible, which `stats` does not need
+        from f5_aws.timeline import get_jobs
+
+        if not events:
+            return
+        started = events[0]["time"]
+        runtime = events[-1]["time"] - started
+        playbooks = []
+        for e in events:
+            if e["event"] == "run_start":
+                playbooks = e.get("playbooks", [])
+
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, env, model, region, json.dumps(playbooks), started,
+                 runtime, statuscode))
+            self.db.execute("DELETE FROM stages WHERE run_id = ?", (run_id,))
+            self.db.execute("DELETE FROM tasks WHERE run_id = ?", (run_id,))
+
+            for name, job in get_jobs(events).items():
+                if job["end"] is None:
+                    continue
+                playbook, host = split_job_name(name)
+                self.db.execute(
+                    "INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?)",
+                    (run_id, playbook, host, job["start"], job["end"],
+                     job["status"]))
+
+            for e in events:
+                if e["event"] != "host_result" or e.get("start") is None:
+                    continue
+                self.db.execute(
+                    "INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?)",
+                    (run_id, split_job_name(e["job"])[0], e["host"], e["task"],
+                     e["time"] - e["start"], e["status"]))
+
+    def get_stage_durations(self, model=None):
+        """
+          Returns {(model, playbook): [(run_id, env, duration), ...]} oldest
+          run first.  The duration of a stage is the time from its first job
+          starting to its last job finishing, only successful stages count.
+        """
+        query = """
+            SELECT r.model, s.playbook, r.run_id, r.env,
+                   MAX(s.ended) - MIN(s.started)
+            FROM stages s JOIN runs r ON r.run_id = s.run_id
+            {}
+            GROUP BY s.run_id, s.playbook
+            HAVING MAX(s.statuscode) = 0 AND MIN(s.statuscode) = 0
+            ORDER BY r.started"""
+        if model is None:
+            rows = self.db.execute(query.format(""))
+        else:
+            rows = self.db.execute(query.format("WHERE r.model = ?"), (model,))
+
+        durations = {}
+        for model, playbook, run_id, env, duration in rows:
+            durations.setdefault((model, playbook), []).append(
+                (run_id, env, duration))
+        return durations
+
+
+def get_stage_percentiles(durations, percentiles=(50, 90, 99)):
+    """Returns {(model, playbook): {"runs": n, 50: p50, ...}}"""
+    stats = {}
+    for key, runs in durations.items():
+        values = [d for run_id, env, d in runs]
+        stats[key] = dict((p, percentile(values, p)) for p in percentiles)
+        stats[key]["runs"] = len(values)
+    return stats
+
+
+def find_regressions(durations, threshold=1.5, window=10, min_runs=3):
+    """
+      Compares each stage duration with the median of the previous `window`
+      runs of the same stage and deployment model.  Returns a list of
+      (model, playbook, run_id, env, duration, baseline) for the stages which
+      took more than threshold times the baseline.
+    """
+    regressions = []
+    for (model, playbook), runs in sorted(durations.items()):
+        for i, (run_id, env, duration) in enumerate(runs):
+            previous = [d for r, e, d in runs[max(0, i - window):i]]
+            if len(previous) < min_runs:
+                continue
+            baseline = percentile(previous, 50)
+            if duration > baseline * threshold:
+                regressions.append(
+                    (model, playbook, run_id, env, duration, baseline))
+    return regressions
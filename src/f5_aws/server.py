@@ -0,0 +1,318 @@
+# server.py
+
+"""
+`f5aws serve` keeps a process running with ansible, boto and our modules
+imported and the inventories of all environments parsed.  bin/f5aws sends
+its command line to it over a unix socket (~/vars/f5aws/f5aws.sock) and
+runs the command in-process when no server is listening.
+
+Each command runs in a process forked from the server, so commands run
+concurrently and start warm.  Commands which change an environment take its
+lock (see environment_manager.lock_environment), so two deploys of the same
+environment run one after the other.
+
+The command runs with the environment variables and in the working
+directory of the client, and reads the config files again.  ansible and boto
+read some settings when they are imported, which the server did once: when
+the client's differ (see get_import_time_settings), the server refuses the
+command and the client runs it in-process.  The output of the command is
+sent back in frames:
+
+  one byte   "o" (stdout), "e" (stderr), "x" (exit status) or "r" (refused)
+  4 bytes    length of the data, network byte order
+  data
+
+The inventories of all environments are parsed again in the background
+when they change, every REFRESH_INTERVAL seconds.
+
+This module is imported by bin/f5aws for every command, anything heavier
+than the standard library is imported by the server only.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import struct
+import threading
+import SocketServer
+
+from f5_aws.config import Config
+
+# how often the server checks the inventories for changes, in seconds
+REFRESH_INTERVAL = 30
+
+# the variables read by ansible and boto when they are imported
+IMPORT_TIME_VARIABLES = ["HOME", "BOTO_CONFIG", "BOTO_PATH"]
+IMPORT_TIME_PREFIXES = ("ANSIBLE_",)
+
+
+def get_socket_path():
+    return "{}/f5aws.sock".format(Config().config["vars_path"])
+
+
+def send_frame(sock, kind, data):
+    sock.sendall(kind + struct.pack("!I", len(data)) + data)
+
+
+def read_frame(f):
+    """Returns (kind, data), or (None, None) if the connection was closed"""
+    header = f.read(5)
+    if len(header) < 5:
+        return None, None
+    length = struct.unpack("!I", header[1:])[0]
+    data = f.read(length)
+    if len(data) < length:
+        return None, None
+    return header[0], data
+
+
+def get_import_time_settings(environ, cwd):
+    """
+      The settings ansible and boto read when they are imported, for a
+      process with the environment variables environ started in cwd: the
+      variables of IMPORT_TIME_VARIABLES and IMPORT_TIME_PREFIXES, and the
+      ansible.cfg ansible would use.
+    """
+    settings = dict((k, v) for k, v in environ.items()
+                    if k in IMPORT_TIME_VARIABLES or
+                    k.startswith(IMPORT_TIME_PREFIXES))
+    # after ANSIBLE_CONFIG, which is compared above
+    settings["ansible.cfg"] = None
+    for path in [os.path.join(cwd, "ansible.cfg"),
+                 os.path.join(environ.get("HOME", ""), ".ansible.cfg")]:
+        if os.path.exists(path):
+            settings["ansible.cfg"] = path
+            break
+    return settings
+
+
+def forward(argv, socket_path=None):
+    """
+      Runs the command line argv on the server and copies its output to our
+      stdout and stderr.  Returns the exit status of the command, or None if
+      it must be run in-process: no server is listening, F5AWS_NO_SERVER is
+      set, the command refers to our own file descriptors (--event-stream
+      fd:N) or the server refused it.
+    """
+    if (os.environ.get("F5AWS_NO_SERVER") or "serve" in argv or
+            any(arg.startswith("fd:") for arg in argv)):
+        return None
+
+    socket_path = socket_path or get_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+
+    try:
+        sock.sendall(json.dumps({"argv": argv, "cwd": os.getcwd(),
+                                 "env": dict(os.environ)}) + "\n")
+        f = sock.makefile("rb")
+        while True:
+            kind, data = read_frame(f)
+            if kind is None:
+                sys.stderr.write("ERROR: lost the connection to f5aws serve\n")
+                return 1
+            elif kind == "o":
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            elif kind == "e":
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            elif kind == "x":
+                return int(data)
+            elif kind == "r":
+                return None
+    finally:
+        # closing the connection stops the command, e.g. on ctrl-c
+        sock.close()
+
+
+def run_command(request):
+    """Runs a command forwarded by bin/f5aws, returns its exit status"""
+    from f5_aws import cli
+
+    # config.ini is read from the working directory of the client
+    Config().reset()
+    return cli.main([arg.encode("utf-8") for arg in request["argv"]])
+
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+
+        if "env" in request and get_import_time_settings(
+                request["env"], request.get("cwd", ".")) != \
+                get_import_time_settings(os.environ, os.getcwd()):
+            send_frame(self.request, "r", "the settings of ansible or boto "
+                       "differ from those of the server")
+            return
+
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(out_r)
+                os.close(err_r)
+                self.request.close()
+                self.server.socket.close()
+                os.dup2(out_w, 1)
+                os.dup2(err_w, 2)
+                sys.stdout = sys.__stdout__
+                sys.stderr = sys.__stderr__
+                os.chdir(request.get("cwd", "."))
+                if "env" in request:
+                    # e.g. the AWS credentials and profile boto reads when
+                    #  it connects
+                    os.environ.clear()
+                    os.environ.update(
+                        (k.encode("utf-8"), v.encode("utf-8"))
+                        for k, v in request["env"].items())
+                status = self.server.run(request)
+            except BaseException, e:
+                sys.stderr.write("ERROR: %s\n" % e)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status or 0)
+
+        os.close(out_w)
+        os.close(err_w)
+        self.relay(pid, {out_r: "o", err_r: "e"})
+
+    def relay(self, pid, pipes):
+        """Sends the output of the command until it exits or the client leaves"""
+        try:
+            while pipes:
+                readable = select.select(list(pipes) + [self.request], [], [])[0]
+                if self.request in readable and not self.request.recv(1):
+                    raise socket.error(errno.EPIPE, "client disconnected")
+                for fd in readable:
+                    if fd not in pipes:
+                        continue
+                    data = os.read(fd, 65536)
+                    if data:
+                        send_frame(self.request, pipes[fd], data)
+                    else:
+                        os.close(fd)
+                        del pipes[fd]
+        except socket.error:
+            # the client went away (e.g. ctrl-c), stop the command as the
+            #  terminal would have
+            os.kill(pid, signal.SIGINT)
+            os.waitpid(pid, 0)
+            return
+
+        status = os.waitpid(pid, 0)[1]
+        if os.WIFEXITED(status):
+            status = os.WEXITSTATUS(status)
+        else:
+            status = 1
+        send_frame(self.request, "x", str(status))
+
+
+class CommandServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    """
+      run(request) runs a command in the forked process and returns its
+      exit status, see run_command().
+    """
+    # a deploy can run for an hour, do not refuse commands because of them
+    max_children = 256
+
+    def __init__(self, socket_path, run=run_command):
+        self.socket_path = socket_path
+        self.run = run
+
+        # a server which exited without cleaning up leaves its socket behind
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                os.remove(socket_path)
+            else:
+                raise socket.error(
+                    errno.EADDRINUSE, "f5aws serve is already running on %s" %
+                    socket_path)
+            finally:
+                probe.close()
+
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(
+                self, socket_path, CommandHandler)
+        finally:
+            os.umask(umask)
+
+    def start_refresh(self, interval=REFRESH_INTERVAL):
+        """
+          Refreshes the inventories every interval seconds in a thread of
+          its own, so that clients are not kept waiting while they are
+          parsed.  A parsed inventory is only added to the cache once it is
+          complete, the commands forked meanwhile parse it themselves.
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception:
+                    continue
+
+        thread = threading.Thread(target=run, name="refresh")
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self):
+        """Parses the inventories which changed since the last refresh"""
+        from f5_aws.inventory_cache import inventory_cache
+        from f5_aws.environment_manager import EnvironmentManager
+
+        config = Config().config
+        for env_name in EnvironmentManager.get_envs():
+            inventory_path = "%s/%s/inventory/hosts" % (
+                config["env_path"], env_name)
+            if not os.path.isfile(inventory_path):
+                continue
+            try:
+                inventory_cache.get(inventory_path)
+            except Exception:
+                # reported by the commands which use the inventory
+                continue
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def serve(socket_path=None):
+    """Runs the server until it is interrupted"""
+    # imported once here rather than in every command
+    import ansible.utils
+    import ansible.inventory
+    import f5_aws.cli
+    import f5_aws.playbook_runner
+    import f5_aws.image_finder
+    import f5_aws.live_status
+
+    server = CommandServer(socket_path or get_socket_path())
+    server.refresh()
+    server.start_refresh()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
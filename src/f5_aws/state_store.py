@@ -0,0 +1,159 @@
+# state_store.py
+
+"""
+Reads the state of an environment: the results of the CloudFormation tasks
+for each host (stack status and outputs) and the facts collected from the
+BIG-IPs and GTMs.  The deploy and teardown tasks record these in
+~/vars/f5aws/env/<env>/state.db through library/f5aws_state.py.
+
+The tasks still persist their results as YAML/JSON files next to the store,
+as the playbooks load them with vars_files.  Environments deployed before
+the store existed are imported from those files the first time they are
+read.  Once imported, the store is opened read-only: reading the state of
+an environment never changes it.
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+
+from f5_aws.config import Config
+
+
+# the same as in library/f5aws_state.py, see test_state_store.py
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    host TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL DEFAULT '',
+    content TEXT, updated REAL,
+    PRIMARY KEY (host, kind, name));
+CREATE INDEX IF NOT EXISTS state_kind ON state (kind, host);
+"""
+
+
+def get_state_path(env_name):
+    return "{}/{}/state.db".format(Config().config["env_path"], env_name)
+
+
+def load_content(content):
+    content = json.loads(content)
+    # facts which were handed to the module as a json string
+    if isinstance(content, basestring):
+        try:
+            content = json.loads(content)
+        except ValueError:
+            pass
+    return content
+
+
+class StateStore(object):
+
+    def __init__(self, env_name, path=None):
+        self.env_name = env_name
+        self.path = path or get_state_path(env_name)
+        self.env_dir = os.path.dirname(self.path)
+
+        exists = os.path.isfile(self.path)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        if exists and self.is_imported():
+            self.db.execute("PRAGMA query_only = 1")
+            return
+
+        # the store is missing, or was created by a task before it was
+        #  first read
+        self.db.executescript(SCHEMA)
+        self.import_files()
+        self.put("", "meta", True, name="imported")
+
+    def is_imported(self):
+        try:
+            return self.get("", "meta", "imported") is not None
+        except sqlite3.OperationalError:
+            # no state table yet
+            return False
+
+    def close(self):
+        self.db.close()
+
+    def put(self, host, kind, content, name="", updated=None, replace=True):
+        with self.db:
+            self.db.execute(
+                "INSERT OR {} INTO state VALUES (?, ?, ?, ?, ?)".format(
+                    "REPLACE" if replace else "IGNORE"),
+                (host, kind, name, json.dumps(content, sort_keys=True),
+                 updated or time.time()))
+
+    def get(self, host, kind, name=""):
+        row = self.db.execute(
+            "SELECT content FROM state WHERE host = ? AND kind = ? AND name = ?",
+            (host, kind, name)).fetchone()
+        if row is None:
+            return None
+        return load_content(row[0])
+
+    def find(self, host, kind, prefix=""):
+        """Returns the entries of a host whose name starts with prefix, by name"""
+        rows = self.db.execute(
+            "SELECT content FROM state WHERE host = ? AND kind = ? AND "
+            "name LIKE ? ORDER BY name", (host, kind, prefix + "%"))
+        return [load_content(content) for content, in rows]
+
+    def get_all(self, kind, name=""):
+        """Returns {host: content} for all hosts"""
+        rows = self.db.execute(
+            "SELECT host, content FROM state WHERE kind = ? AND name = ?",
+            (kind, name))
+        return dict((host, load_content(content)) for host, content in rows)
+
+    def find_all(self, kind, prefix=""):
+        """Returns {host: [content, ...]} for the names starting with prefix"""
+        rows = self.db.execute(
+            "SELECT host, content FROM state WHERE kind = ? AND name LIKE ? "
+            "AND name != '' ORDER BY host, name", (kind, prefix + "%"))
+        found = {}
+        for host, content in rows:
+            found.setdefault(host, []).append(load_content(content))
+        return found
+
+    def import_files(self):
+        """
+          Imports the results and facts from the YAML/JSON files persisted
+          by earlier deploys:
+            <host>.yml              the result of the host's stack
+            <host>-vip-<vip>.yml    the result of an EIP stack
+            facts_<host>.json       facts collected from a BIG-IP or GTM
+          Entries already recorded by the tasks are kept.
+        """
+        if not os.path.isdir(self.env_dir):
+            return
+
+        # only needed once per environment, see cli.py
+        import yaml
+
+        for fname in sorted(os.listdir(self.env_dir)):
+            path = os.path.join(self.env_dir, fname)
+            updated = os.path.getmtime(path)
+            try:
+                facts = re.match("^facts_(.+)\.json$", fname)
+                vip = re.match("^(.+)-(vip-.+)\.yml$", fname)
+                result = re.match("^(.+)\.yml$", fname)
+                if facts:
+                    with open(path) as f:
+                        self.put(facts.group(1), "facts", json.load(f),
+                                 updated=updated, replace=False)
+                elif vip or result:
+                    with open(path) as f:
+                        content = yaml.safe_load(f)
+                    # e.g. <seed>_peer_info.yml are not task results
+                    if not (isinstance(content, dict) and "invocation" in content):
+                        continue
+                    if vip:
+                        self.put(vip.group(1), "result", content,
+                                 name=vip.group(2), updated=updated,
+                                 replace=False)
+                    else:
+                        self.put(result.group(1), "result", content,
+                                 updated=updated, replace=False)
+            except (ValueError, yaml.YAMLError):
+                continue
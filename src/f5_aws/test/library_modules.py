@@ -0,0 +1,33 @@
+"""
+library_modules.py
+
+Imports our ansible modules (library/*.py) so that their helpers can be
+tested, with a stand-in for the module snippets of ansible.
+"""
+
+import os
+import imp
+import sys
+
+LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "../../../library")
+
+
+class AnsibleModule(object):
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("library modules are only run by ansible")
+
+
+def load_library_module(name):
+    stub = imp.new_module("ansible.module_utils.basic")
+    stub.AnsibleModule = AnsibleModule
+    saved = sys.modules.get("ansible.module_utils.basic")
+    sys.modules["ansible.module_utils.basic"] = stub
+    try:
+        return imp.load_source("library_%s" % name,
+                               os.path.join(LIBRARY_PATH, name + ".py"))
+    finally:
+        if saved is None:
+            del sys.modules["ansible.module_utils.basic"]
+        else:
+            sys.modules["ansible.module_utils.basic"] = saved
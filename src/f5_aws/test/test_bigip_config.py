@@ -0,0 +1,488 @@
+"""
+test_bigip_config.py
+
+Checks how library/bigip_config.py validates the items of `resources` and
+applies them: in order, skipping the items after a failure, or several at
+a time or in a transaction, how they are looked up, and how the session to
+the BIG-IP logs in and commits transactions.  The requests to the
+BIG-IP are replaced by a stub.
+"""
+
+import json
+import time
+import pytest
+
+from library_modules import load_library_module
+
+bigip_config = load_library_module("bigip_config")
+
+PARAMS = {"host": "10.0.0.1", "user": "admin", "password": "secret"}
+
+
+def resources(*items):
+    return bigip_config.get_resources(dict(PARAMS, resources=list(items)))
+
+
+@pytest.fixture
+def applied(monkeypatch):
+    """Stands in for apply_resource(), fails the items named 'bad'"""
+    applied = []
+
+    def apply_resource(params, check_mode=False):
+        time.sleep(0.2)
+        applied.append(params["name"])
+        result = {"collection_path": params["collection_path"],
+                  "name": params["name"], "changed": True}
+        if params["name"] == "bad":
+            result.update(failed=True, msg="HTTP 400", changed=False)
+        return result
+
+    monkeypatch.setattr(bigip_config, "apply_resource", apply_resource)
+    return applied
+
+
+def test_get_resources():
+    items = resources({"name": "pool", "collection_path": "mgmt/tm/ltm/pool",
+                       "resource_key": "name", "payload": {"name": "p1"}})
+    assert items == [dict(PARAMS, name="pool",
+                          collection_path="mgmt/tm/ltm/pool",
+                          resource_key="name", payload={"name": "p1"})]
+
+
+@pytest.mark.parametrize("item", [
+    "mgmt/tm/ltm/pool",
+    {"collection_path": "mgmt/tm/ltm/pool", "monitor": "http"},
+    {"collection_path": "mgmt/tm/ltm/pool", "resource_id": "p1",
+     "resource_key": "name"},
+    {"name": "no collection"},
+])
+def test_get_resources_validation(item):
+    with pytest.raises(ValueError):
+        resources(item)
+
+
+def test_stop_after_failure(applied):
+    results = bigip_config.apply_resources(resources(
+        {"name": "ok", "collection_path": "mgmt/tm/sys/ntp"},
+        {"name": "bad", "collection_path": "mgmt/tm/ltm/pool"},
+        {"name": "after", "collection_path": "mgmt/tm/ltm/rule"}))
+
+    assert applied == ["ok", "bad"]
+    assert [(r["collection_path"], r["changed"], r.get("failed"),
+             r.get("skipped")) for r in results] == [
+        ("mgmt/tm/sys/ntp", True, None, None),
+        ("mgmt/tm/ltm/pool", False, True, None),
+        ("mgmt/tm/ltm/rule", False, None, True)]
+
+
+def test_parallel(applied):
+    items = resources(*[{"name": name, "collection_path": "mgmt/tm/ltm/pool"}
+                        for name in ["a", "bad", "c", "d"]])
+    start = time.time()
+    results = bigip_config.apply_resources(items, parallel=4)
+
+    assert time.time() - start < 0.6
+    # every item is applied, the results are in the order of the items
+    assert sorted(applied) == ["a", "bad", "c", "d"]
+    assert [r["name"] for r in results] == ["a", "bad", "c", "d"]
+    assert [bool(r.get("failed")) for r in results] == [False, True, False, False]
+
+
+def test_no_resources(applied):
+    assert bigip_config.apply_resources([], parallel=4) == []
+
+
+def test_normalize():
+    assert bigip_config.normalize("/Common/http ") == "http"
+    assert bigip_config.normalize(5) == "5"
+    assert bigip_config.normalize(True) == "true"
+    assert bigip_config.normalize(["/Common/http"]) == ["/Common/http"]
+
+
+def test_matches():
+    assert bigip_config.matches("/Common/tcp", "tcp")
+    assert bigip_config.matches("5", 5)
+    assert bigip_config.matches(
+        [{"name": "a"}, {"name": "b"}],
+        [{"name": "b", "partition": "Common"}, {"name": "a"}])
+    assert not bigip_config.matches([{"name": "a"}],
+                                    [{"name": "a"}, {"name": "b"}])
+    assert not bigip_config.matches({"name": "a"}, "a")
+
+
+def test_get_differences():
+    current = {
+        "kind": "tm:ltm:pool:poolstate", "name": "web_pool",
+        "fullPath": "/Common/web_pool", "generation": 12,
+        "monitor": "/Common/http ", "slowRampTime": 10,
+        "membersReference": {"link": "https://localhost/mgmt/tm/ltm/pool/"
+                                     "~Common~web_pool/members",
+                             "items": [{"name": "10.0.0.2:80",
+                                        "address": "10.0.0.2"},
+                                       {"name": "10.0.0.1:80",
+                                        "address": "10.0.0.1",
+                                        "state": "up"}]}}
+    payload = {
+        "name": "web_pool", "kind": "ignored", "monitor": "http",
+        "slowRampTime": "10", "description": "", "loadBalancingMode": "none",
+        "members": [{"name": "10.0.0.1:80", "address": "10.0.0.1"},
+                    {"name": "10.0.0.2:80", "address": "10.0.0.2"}]}
+    assert bigip_config.get_differences(payload, current) == []
+
+    payload.update(monitor="tcp", description="web servers",
+                   members=[{"name": "10.0.0.1:80", "address": "10.0.0.1"}])
+    assert bigip_config.get_differences(payload, current) == [
+        "description", "members", "monitor"]
+
+
+class StubSession(object):
+    def __init__(self, commit_error=None):
+        self.calls = []
+        self.collections = {}
+        self.commit_error = commit_error
+
+    def begin_transaction(self):
+        self.calls.append("begin")
+
+    def commit_transaction(self):
+        self.calls.append("commit")
+        return self.commit_error
+
+    def abort_transaction(self):
+        self.calls.append("abort")
+
+
+@pytest.mark.parametrize("changed,calls", [
+    (False, ["begin", "abort"]),
+    (True, ["begin", "commit"]),
+])
+def test_transaction_commits_changes(monkeypatch, changed, calls):
+    session = StubSession()
+    monkeypatch.setattr(bigip_config, "get_session", lambda *args: session)
+    monkeypatch.setattr(bigip_config, "apply_resource",
+                        lambda params, check_mode=False: {
+                            "collection_path": params["collection_path"],
+                            "changed": changed})
+
+    results, error = bigip_config.apply_transaction(resources(
+        {"collection_path": "mgmt/tm/ltm/pool"},
+        {"collection_path": "mgmt/tm/ltm/rule"}))
+    assert error is None
+    assert session.calls == calls
+    assert [r["changed"] for r in results] == [changed, changed]
+
+
+class StubResponse(object):
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.text = json.dumps(self.body)
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise bigip_config.requests.HTTPError(self.text)
+
+
+class StubHttp(object):
+    """
+    Stands in for requests.Session, records the requests made and answers
+    logins with a new token each time, other requests with handler()
+    """
+    def __init__(self):
+        self.headers = {}
+        self.auth = None
+        self.verify = True
+        self.requests = []
+        self.logins = 0
+        self.login_status = 200
+        self.handler = lambda method, uri, headers: StubResponse(200)
+
+    def post(self, url, data=None):
+        return self.request("POST", url, data)
+
+    def request(self, method, url, data=None, headers=None):
+        headers = dict(self.headers, **(headers or {}))
+        uri = url.split("/", 3)[3]
+        self.requests.append((method, uri, headers))
+        if uri == "mgmt/shared/authn/login":
+            self.logins += 1
+            return StubResponse(self.login_status, {"token": {
+                "token": "token-%s" % self.logins, "timeout": 1200}})
+        return self.handler(method, uri, headers)
+
+
+@pytest.fixture
+def http(monkeypatch):
+    http = StubHttp()
+    monkeypatch.setattr(bigip_config.requests, "Session", lambda: http)
+    monkeypatch.setattr(bigip_config, "_sessions", {})
+    return http
+
+
+def test_token_login(http):
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+    session.request("get", "mgmt/tm/sys/version")
+    session.request("get", "mgmt/tm/sys/version")
+
+    assert [(method, uri) for method, uri, headers in http.requests] == [
+        ("POST", "mgmt/shared/authn/login"),
+        ("GET", "mgmt/tm/sys/version"),
+        ("GET", "mgmt/tm/sys/version")]
+    assert http.requests[1][2]["X-F5-Auth-Token"] == "token-1"
+    assert http.auth is None
+    assert abs(session.token_expires - (time.time() + 1200)) < 5
+
+
+def test_token_refresh(http):
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+    session.request("get", "mgmt/tm/sys/version")
+
+    session.token_expires = time.time() + bigip_config.TOKEN_REFRESH_MARGIN + 10
+    session.request("get", "mgmt/tm/sys/version")
+    assert http.logins == 1
+
+    session.token_expires = time.time() + bigip_config.TOKEN_REFRESH_MARGIN - 10
+    session.request("get", "mgmt/tm/sys/version")
+    assert http.logins == 2
+    assert http.requests[-1][2]["X-F5-Auth-Token"] == "token-2"
+
+
+def test_token_rejected(http):
+    # the first token is revoked, e.g. by a restart of restjavad
+    http.handler = lambda method, uri, headers: StubResponse(
+        401 if headers["X-F5-Auth-Token"] == "token-1" else 200)
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+
+    assert session.request("get", "mgmt/tm/sys/version").status_code == 200
+    assert [(method, headers.get("X-F5-Auth-Token"))
+            for method, uri, headers in http.requests] == [
+        ("POST", None), ("GET", "token-1"), ("POST", None), ("GET", "token-2")]
+
+
+def test_token_replaced_by_another_thread(http):
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+
+    def handler(method, uri, headers):
+        if headers["X-F5-Auth-Token"] == "token-1":
+            # another thread logged in while this request was rejected
+            http.headers["X-F5-Auth-Token"] = "token-other"
+            return StubResponse(401)
+        return StubResponse(200)
+
+    http.handler = handler
+    assert session.request("get", "mgmt/tm/sys/version").status_code == 200
+    assert http.logins == 1
+    assert http.requests[-1][2]["X-F5-Auth-Token"] == "token-other"
+
+
+def test_basic_auth_fallback(http):
+    # no token authentication on this version
+    http.login_status = 404
+    http.handler = lambda method, uri, headers: StubResponse(401)
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+
+    assert session.request("get", "mgmt/tm/sys/version").status_code == 401
+    session.request("get", "mgmt/tm/sys/version")
+
+    assert session.basic_auth
+    assert http.auth == ("admin", "secret")
+    assert http.logins == 1
+    assert "X-F5-Auth-Token" not in http.requests[-1][2]
+
+
+def test_transaction_failed_item(monkeypatch, applied):
+    session = StubSession()
+    monkeypatch.setattr(bigip_config, "get_session", lambda *args: session)
+
+    results, error = bigip_config.apply_transaction(resources(
+        {"name": "ok", "collection_path": "mgmt/tm/ltm/pool"},
+        {"name": "bad", "collection_path": "mgmt/tm/ltm/pool"},
+        {"name": "after", "collection_path": "mgmt/tm/ltm/rule"}))
+
+    assert error is None
+    assert session.calls == ["begin", "abort"]
+    assert [r["changed"] for r in results] == [False, False, False]
+    assert [bool(r.get("failed")) for r in results] == [False, True, False]
+
+
+def test_transaction_failed_commit(monkeypatch, applied):
+    session = StubSession(commit_error="01070734:3: Configuration error")
+    session.collections[("mgmt/tm/ltm/pool", "name")] = {"ok": {"name": "ok"}}
+    monkeypatch.setattr(bigip_config, "get_session", lambda *args: session)
+
+    results, error = bigip_config.apply_transaction(resources(
+        {"name": "ok", "collection_path": "mgmt/tm/ltm/pool"},
+        {"name": "other", "collection_path": "mgmt/tm/ltm/rule"}))
+
+    assert error == "01070734:3: Configuration error"
+    assert session.calls == ["begin", "commit"]
+    assert session.collections == {}
+    assert [r["changed"] for r in results] == [False, False]
+
+
+def transaction_handler(states):
+    """Answers the commit and each poll with the next of states"""
+    states = list(states)
+
+    def handler(method, uri, headers):
+        assert uri == "mgmt/tm/transaction/42"
+        state = states.pop(0)
+        return StubResponse(200, {"transId": 42, "state": state,
+                                  "failureReason": "01020036:3: not found"
+                                  if state == "FAILED" else None})
+    return handler
+
+
+@pytest.mark.parametrize("states,error", [
+    (["VALIDATING", "VALIDATING", "COMPLETED"], None),
+    (["VALIDATING", "FAILED"], "01020036:3: not found"),
+])
+def test_commit_polls(http, monkeypatch, states, error):
+    monkeypatch.setattr(bigip_config.time, "sleep", lambda seconds: None)
+    http.handler = transaction_handler(states)
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+    session.transaction_id = 42
+
+    assert session.commit_transaction() == error
+    assert session.transaction_id is None
+    assert [method for method, uri, headers in http.requests[1:]] == (
+        ["PATCH"] + ["GET"] * (len(states) - 1))
+
+
+def test_commit_timeout(http, monkeypatch):
+    monkeypatch.setattr(bigip_config.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(bigip_config, "TRANSACTION_TIMEOUT", -1)
+    http.handler = transaction_handler(["VALIDATING"])
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+    session.transaction_id = 42
+
+    assert session.commit_transaction() == (
+        "transaction 42 still VALIDATING after -1s")
+
+
+def test_commit_connection_error(http, monkeypatch):
+    monkeypatch.setattr(bigip_config.time, "sleep", lambda seconds: None)
+
+    def handler(method, uri, headers):
+        if method == "GET":
+            raise bigip_config.ConnectionError("connection reset by peer")
+        return StubResponse(200, {"transId": 42, "state": "VALIDATING"})
+
+    http.handler = handler
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+    session.transaction_id = 42
+
+    assert session.commit_transaction() == (
+        "transaction 42: connection reset by peer")
+
+
+def test_coordination_header(http):
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+    session.transaction_id = 42
+    session.request("get", "mgmt/tm/ltm/pool/p1")
+    session.request("post", "mgmt/tm/ltm/pool", "{}")
+    session.request("delete", "mgmt/tm/ltm/pool/p1")
+
+    assert [(method, headers.get("X-F5-REST-Coordination-Id"))
+            for method, uri, headers in http.requests[1:]] == [
+        ("GET", None), ("POST", "42"), ("DELETE", "42")]
+
+
+def pool(name):
+    return {"name": name, "fullPath": "/Common/%s" % name,
+            "selfLink": "https://localhost/mgmt/tm/ltm/pool/~Common~%s" % name}
+
+
+def bigip_handler(pools):
+    """Answers for the pools (by name) configured on a stub BIG-IP"""
+    def handler(method, uri, headers):
+        if method == "GET" and uri.startswith("mgmt/tm/ltm/pool/"):
+            name = uri.split("/")[-1].split("?")[0].replace("~Common~", "")
+            if name not in pools:
+                return StubResponse(404)
+            return StubResponse(200, pools[name])
+        if method == "GET":
+            return StubResponse(200, {"items": list(pools.values())})
+        return StubResponse(200, {})
+    return handler
+
+
+def config(collection_path, name):
+    return bigip_config.BigipConfig(dict(
+        PARAMS, collection_path=collection_path, resource_key="name",
+        payload=json.dumps({"name": name})))
+
+
+def get_uris(http):
+    return [uri for method, uri, headers in http.requests
+            if method == "GET"]
+
+
+def test_exists_direct_get(http):
+    http.handler = bigip_handler({"p1": pool("p1")})
+
+    assert config("mgmt/tm/ltm/pool", "p1").resource_exists()
+    assert not config("mgmt/tm/ltm/pool", "p2").resource_exists()
+    assert get_uris(http) == [
+        "mgmt/tm/ltm/pool/p1?expandSubcollections=true",
+        "mgmt/tm/ltm/pool/p2?expandSubcollections=true"]
+
+
+def test_exists_asm_listing(http):
+    # ASM objects are addressed by an id, not by their name
+    http.handler = lambda method, uri, headers: StubResponse(200, {"items": [
+        {"name": "policy1", "fullPath": "/Common/policy1",
+         "selfLink": "https://localhost/mgmt/tm/asm/policies/Xy5"}]})
+
+    resource = config("mgmt/tm/asm/policies", "policy1")
+    assert resource.resource_exists()
+    assert resource.resource_selfLink.endswith("/mgmt/tm/asm/policies/Xy5")
+    assert not config("mgmt/tm/asm/policies", "policy2").resource_exists()
+    assert get_uris(http) == [
+        "mgmt/tm/asm/policies?$select=name,selfLink,fullPath"]
+
+
+@pytest.mark.parametrize("response", [
+    StubResponse(500, {"message": "restjavad is restarting"}),
+    StubResponse(200, {"name": "other"}),
+])
+def test_exists_inconclusive_get(http, response):
+    def handler(method, uri, headers):
+        if "$select" in uri:
+            return StubResponse(200, {"items": [pool("p1")]})
+        return response
+
+    http.handler = handler
+    assert config("mgmt/tm/ltm/pool", "p1").resource_exists()
+    assert get_uris(http) == [
+        "mgmt/tm/ltm/pool/p1?expandSubcollections=true",
+        "mgmt/tm/ltm/pool?$select=name,selfLink,fullPath"]
+
+
+def test_listing_updated(http):
+    pools = {"p1": pool("p1")}
+    http.handler = bigip_handler(pools)
+    session = bigip_config.get_session("10.0.0.1", "admin", "secret")
+    session.list_collection("mgmt/tm/ltm/pool", "name")
+
+    # once listed, the collection is not requested again
+    created = config("mgmt/tm/ltm/pool", "p2")
+    assert not created.resource_exists()
+    assert created.create_resource()[0] == 0
+    assert config("mgmt/tm/ltm/pool", "p2").resource_exists()
+
+    deleted = config("mgmt/tm/ltm/pool", "p1")
+    assert deleted.resource_exists()
+    assert deleted.delete_resource()[0] == 0
+    assert not config("mgmt/tm/ltm/pool", "p1").resource_exists()
+
+    assert get_uris(http) == [
+        "mgmt/tm/ltm/pool?$select=name,selfLink,fullPath"]
+    assert [(method, uri) for method, uri, headers in http.requests
+            if method != "GET"] == [
+        ("POST", "mgmt/shared/authn/login"),
+        ("POST", "mgmt/tm/ltm/pool"),
+        ("DELETE", "mgmt/tm/ltm/pool/~Common~p1")]
@@ -0,0 +1,41 @@
+"""
+test_catalog.py
+
+Checks the environment catalog read by `list`, including updates made by
+several processes at once as with `deploy-many`.
+"""
+
+import multiprocessing
+
+from f5_aws.catalog import Catalog
+
+INFO = {'status': 'deployed', 'vars': {'deployment_model': 'single-standalone'}}
+
+
+def test_update_and_remove(tmpdir):
+    path = str(tmpdir.join('catalog.json'))
+    Catalog(path).update('lab-1', INFO)
+
+    catalog = Catalog(path)
+    assert catalog.get('lab-1')['status'] == 'deployed'
+    assert catalog.get('lab-2') is None
+
+    catalog.remove('lab-1')
+    assert Catalog(path).get('lab-1') is None
+
+
+def update(path, env_name):
+    Catalog(path).update(env_name, INFO)
+
+
+def test_concurrent_updates(tmpdir):
+    path = str(tmpdir.join('catalog.json'))
+    # every catalog object was loaded before the others wrote their entry
+    workers = [multiprocessing.Process(target=update, args=(path, 'lab-%s' % i))
+               for i in range(8)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    assert sorted(Catalog(path).entries) == ['lab-%s' % i for i in range(8)]
@@ -0,0 +1,26 @@
+"""
+test_config.py
+
+Checks that the config files are read the first time Config().config is
+used, rather than when our modules are imported.
+"""
+
+import os
+import sys
+import subprocess
+
+MODULES = ["cli", "environment_manager", "playbook_runner", "journal",
+           "state_store", "catalog", "live_status", "run_history", "timeline",
+           "job_queue", "server"]
+
+
+def test_import_does_not_read_config(tmpdir):
+    src_path = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    script = "\n".join(["import f5_aws.%s" % m for m in MODULES] + [
+        "from f5_aws.config import Config",
+        "assert Config()._config is None"])
+    # there is no conf/config.ini to read in tmpdir
+    env = dict(os.environ, PYTHONPATH=src_path)
+    subprocess.check_call([sys.executable, "-c", script], cwd=str(tmpdir),
+                          env=env)
@@ -0,0 +1,128 @@
+"""
+test_deploy_graph.py
+
+Checks the declared dependencies between the deployment playbooks and the
+scheduler in PlaybookRunner which executes them.  These tests do not
+deploy anything to AWS, the playbooks are replaced by a stub which
+records when it was started.
+"""
+
+import time
+import argparse
+import multiprocessing
+import pytest
+
+from f5_aws.exceptions import ValidationError
+from f5_aws.playbook_runner import PlaybookRunner
+from f5_aws.deploy_graph import (DEPLOY_PLAYBOOKS, DEPLOY_DEPENDENCIES,
+                                 get_dependencies, get_pipeline, check_acyclic)
+
+
+def test_every_playbook_declared():
+    assert sorted(DEPLOY_PLAYBOOKS) == sorted(DEPLOY_DEPENDENCIES.keys())
+    for pb, deps in DEPLOY_DEPENDENCIES.items():
+        for dep in deps:
+            # dependencies must also run earlier in the serial order
+            assert DEPLOY_PLAYBOOKS.index(dep) < DEPLOY_PLAYBOOKS.index(pb)
+
+
+def test_subset_drops_unselected_dependencies():
+    graph = get_dependencies(['deploy_bigip.yml', 'cluster_bigips.yml'])
+    assert graph == {'deploy_bigip.yml': [],
+                     'cluster_bigips.yml': ['deploy_bigip.yml']}
+
+
+def test_cycle_detected():
+    with pytest.raises(ValidationError):
+        check_acyclic({'a.yml': ['b.yml'], 'b.yml': ['a.yml']})
+
+
+class StubRunner(PlaybookRunner):
+    """Replaces ansible with a short sleep, records the start/end of each job"""
+
+    def __init__(self, graph, parallel, failing=(), **kwargs):
+        options = argparse.Namespace(parallel=parallel)
+        PlaybookRunner.__init__(self, list(graph.keys()), {}, '', options, {},
+                                dependencies=graph, **kwargs)
+        self.failing = failing
+        self.log = multiprocessing.Queue()
+
+    def _run_playbook(self, playbook):
+        self.log.put(('start', playbook, time.time()))
+        time.sleep(0.2)
+        self.log.put(('end', playbook, time.time()))
+        return 2 if playbook in self.failing else 0
+
+    def events(self):
+        events = []
+        while not self.log.empty():
+            events.append(self.log.get())
+        return events
+
+
+def run_stub(graph, parallel, failing=()):
+    runner = StubRunner(graph, parallel, failing)
+    runner.statuscode = runner._run_scheduled()
+    return runner, runner.events()
+
+
+def test_scheduler_respects_dependencies():
+    graph = {'a.yml': [], 'b.yml': ['a.yml'], 'c.yml': ['a.yml'],
+             'd.yml': ['b.yml', 'c.yml']}
+    runner, events = run_stub(graph, parallel=4)
+    times = dict(((kind, pb), t) for kind, pb, t in events)
+
+    assert runner.statuscode == 0
+    for pb, deps in graph.items():
+        for dep in deps:
+            assert times[('end', dep)] <= times[('start', pb)]
+    # b and c are independent, they should have overlapped
+    assert times[('start', 'c.yml')] < times[('end', 'b.yml')]
+
+
+def test_scheduler_stops_after_failure():
+    graph = {'a.yml': [], 'b.yml': ['a.yml'], 'c.yml': ['b.yml']}
+    runner, events = run_stub(graph, parallel=2, failing=('b.yml',))
+    started = [pb for kind, pb, t in events if kind == 'start']
+
+    assert runner.statuscode == 2
+    assert 'c.yml' not in started
+
+
+# groups of a two zone cluster-per-zone inventory, without analytics
+GROUPS = {
+    'all': ['vpc-manager', 'zone1-az', 'zone1-bigip1', 'zone1-bigip2',
+            'zone1-apphost1', 'zone1-gtm1', 'zone1-clienthost1', 'zone2-az',
+            'zone2-bigip1', 'zone2-bigip2', 'zone2-apphost1', 'zone2-gtm1'],
+    'zone1': ['zone1-az', 'zone1-bigip1', 'zone1-bigip2', 'zone1-apphost1',
+              'zone1-gtm1', 'zone1-clienthost1'],
+    'zone2': ['zone2-az', 'zone2-bigip1', 'zone2-bigip2', 'zone2-apphost1',
+              'zone2-gtm1'],
+    'azs': ['zone1-az', 'zone2-az'],
+    'bigips': ['zone1-bigip1', 'zone1-bigip2', 'zone2-bigip1', 'zone2-bigip2'],
+    'gtms': ['zone1-gtm1', 'zone2-gtm1'],
+    'apphosts': ['zone1-apphost1', 'zone2-apphost1'],
+    'clienthosts': ['zone1-clienthost1'],
+}
+
+
+def test_pipeline_host_chains():
+    graph = get_pipeline(DEPLOY_PLAYBOOKS, GROUPS)
+
+    # onboarding a bigip only waits for its own stack
+    assert graph[('deploy_bigip.yml', 'zone2-bigip1')] == [
+        ('deploy_bigip_cft.yml', 'zone2-bigip1')]
+    # stacks only wait for the availability zone of their own zone
+    assert graph[('deploy_bigip_cft.yml', 'zone2-bigip1')] == [
+        ('deploy_az_cft.yml', 'zone2-az')]
+    assert graph[('deploy_az_cft.yml', 'zone1-az')] == ['deploy_vpc_cft.yml']
+
+
+def test_pipeline_joins():
+    graph = get_pipeline(DEPLOY_PLAYBOOKS, GROUPS)
+
+    assert sorted(graph['cluster_bigips.yml']) == [
+        ('deploy_bigip.yml', h) for h in GROUPS['bigips']]
+    # there are no analytics hosts to wait for
+    assert ('deploy_analytics_cft.yml', 'zone1-analyticshost1') not in graph
+    assert 'cluster_bigips.yml' in graph['deploy_apps_bigip.yml']
@@ -0,0 +1,127 @@
+"""
+test_deploy_many.py
+
+Checks the selection of environments for `deploy-many`, the scheduling of
+their deploys and the BIG-IP image cache shared by the environments deployed
+together.  No AWS calls are made.
+"""
+
+import os
+import time
+import argparse
+import multiprocessing
+import pytest
+
+from f5_aws import environment_manager
+from f5_aws.config import Config
+from f5_aws.exceptions import ValidationError
+from f5_aws.environment_manager import EnvironmentManager
+from f5_aws.image_finder import BigIpImageFinder
+
+
+def test_matching_envs(monkeypatch):
+    monkeypatch.setattr(EnvironmentManager, 'get_envs', staticmethod(
+        lambda: ['lab-2', 'lab-1', 'demo', 'lab-10']))
+
+    assert EnvironmentManager.get_matching_envs(['lab-*']) == [
+        'lab-1', 'lab-10', 'lab-2']
+    assert EnvironmentManager.get_matching_envs(['demo', 'lab-1*', 'demo']) == [
+        'demo', 'lab-1', 'lab-10']
+    with pytest.raises(ValidationError):
+        EnvironmentManager.get_matching_envs(['trainee-*'])
+
+
+class CountingImageFinder(BigIpImageFinder):
+    searches = 0
+
+    def searchImagesForRegion(self, region):
+        CountingImageFinder.searches += 1
+        return [{'id': 'ami-1', 'version': '11.6.0.1.0.403-hf1',
+                 'package': 'best', 'license': 'byol', 'throughput': 'None'}]
+
+
+def test_image_cache(tmpdir):
+    CountingImageFinder.searches = 0
+    cache_path = str(tmpdir.join('image_cache'))
+
+    first = CountingImageFinder(cache_path=cache_path).getImagesForRegion('us-east-1')
+    # a second finder, as in another process, reads the cache
+    second = CountingImageFinder(cache_path=cache_path).getImagesForRegion('us-east-1')
+
+    assert first == second
+    assert CountingImageFinder.searches == 1
+    assert os.path.isfile(os.path.join(cache_path, 'us-east-1.json'))
+
+
+def test_image_cache_expired(tmpdir):
+    CountingImageFinder.searches = 0
+    cache_path = str(tmpdir.join('image_cache'))
+
+    CountingImageFinder(cache_path=cache_path).getImagesForRegion('us-east-1')
+    CountingImageFinder(cache_path=cache_path, cache_ttl=0).getImagesForRegion('us-east-1')
+
+    assert CountingImageFinder.searches == 2
+
+
+class EmptyInventory(object):
+    def list_hosts(self, pattern):
+        return []
+
+
+@pytest.fixture
+def envs(monkeypatch):
+    monkeypatch.setattr(EnvironmentManager, 'get_envs', staticmethod(
+        lambda: ['lab-1', 'lab-2', 'lab-3', 'lab-4', 'lab-5']))
+    monkeypatch.setattr(environment_manager.inventory_cache, 'get',
+                        lambda path: EmptyInventory())
+    monkeypatch.setattr(environment_manager, 'WORKER_POLL_INTERVAL', 0.1)
+
+
+def test_deploy_many_schedule(envs, monkeypatch):
+    active = multiprocessing.Value('i', 0)
+    most_active = multiprocessing.Value('i', 0)
+
+    def deploy_worker(args, log_path, results):
+        with active.get_lock():
+            active.value += 1
+            most_active.value = max(most_active.value, active.value)
+        time.sleep(0.2)
+        with active.get_lock():
+            active.value -= 1
+        failed = args.env_name == 'lab-3'
+        results.put((args.env_name, 2 if failed else 0,
+                     'unreachable' if failed else None, 0.2))
+
+    monkeypatch.setattr(environment_manager, '_deploy_worker', deploy_worker)
+
+    summary = EnvironmentManager.deploy_many(
+        argparse.Namespace(env_names=['lab-*'], max_envs=2))
+
+    assert most_active.value == 2
+    assert sorted(summary) == ['lab-1', 'lab-2', 'lab-3', 'lab-4', 'lab-5']
+    for env_name, result in summary.items():
+        assert result['log'] == '%s/%s/deploy.log' % (
+            Config().config['env_path'], env_name)
+        assert result['runtime'] == 0.2
+    assert summary['lab-3']['statuscode'] == 2
+    assert summary['lab-3']['error'] == 'unreachable'
+    assert summary['lab-1']['statuscode'] == 0
+    assert summary['lab-1']['error'] is None
+
+
+def test_deploy_many_dead_worker(envs, monkeypatch):
+    def deploy_worker(args, log_path, results):
+        if args.env_name == 'lab-2':
+            # killed before it could report
+            os._exit(9)
+        results.put((args.env_name, 0, None, 0))
+
+    monkeypatch.setattr(environment_manager, '_deploy_worker', deploy_worker)
+
+    summary = EnvironmentManager.deploy_many(
+        argparse.Namespace(env_names=['lab-1', 'lab-2', 'lab-3'], max_envs=4))
+
+    assert summary['lab-1']['statuscode'] == 0
+    assert summary['lab-3']['statuscode'] == 0
+    assert summary['lab-2']['statuscode'] == 9
+    assert 'exited with code 9' in summary['lab-2']['error']
@@ -0,0 +1,162 @@
+"""
+test_deploy_plan.py
+
+Checks that an incremental deploy only plans the jobs of the hosts which
+are new or changed since the last deploy, along with the jobs depending on
+them, and how --limit narrows a run.  The previous deploy is recorded
+straight into the journal, nothing is deployed to AWS.
+"""
+
+import argparse
+import pytest
+
+from f5_aws.deploy_graph import DEPLOY_PLAYBOOKS, get_pipeline
+from f5_aws.deploy_plan import DeployPlan
+from f5_aws.inventory_cache import inventory_cache
+from f5_aws.journal import DeployJournal, HostInputs
+from f5_aws.playbook_runner import PlaybookRunner
+
+HOSTS = """
+vpc-manager
+
+[zone1]
+zone1-az
+zone1-bigip1
+zone1-apphost1
+
+[zone2]
+zone2-az
+zone2-bigip1
+zone2-apphost1
+
+[azs]
+zone1-az
+zone2-az
+
+[bigips]
+zone1-bigip1
+zone2-bigip1
+
+[apphosts]
+zone1-apphost1
+zone2-apphost1
+
+[all:vars]
+region=us-east-1
+"""
+
+PLAYBOOKS = [pb for pb in DEPLOY_PLAYBOOKS if 'gtm' not in pb and
+             'client' not in pb and 'analytics' not in pb]
+
+
+@pytest.fixture
+def env(tmpdir):
+    tmpdir.join("hosts").write(HOSTS)
+    return str(tmpdir.join("hosts")), str(tmpdir.join("deploy_journal.json"))
+
+
+def plan(env, extra_vars={}, statuses=None, limit=None):
+    inventory_path, journal_path = env
+    inventory = inventory_cache.get(inventory_path)
+    groups = inventory.groups_list()
+    if limit is not None:
+        # as EnvironmentManager.get_groups()
+        hosts = inventory.list_hosts(limit)
+        groups = dict((g, [h for h in members if h in hosts])
+                      for g, members in groups.items())
+    host_inputs = HostInputs(inventory_path, extra_vars, limit)
+    if statuses is None:
+        statuses = dict((h, {"state": "deployed"}) for h in groups["all"])
+    return DeployPlan(get_pipeline(PLAYBOOKS, groups),
+                      DeployJournal("unused", path=journal_path),
+                      host_inputs, statuses)
+
+
+def deploy(env, extra_vars={}):
+    """Records every job of the plan as completed"""
+    inventory_path, journal_path = env
+    host_inputs = HostInputs(inventory_path, extra_vars)
+    journal = DeployJournal("unused", path=journal_path)
+    for job in plan(env, extra_vars).get_jobs():
+        journal.record(job, "inputs", 0, {}, host_inputs=host_inputs.get(job))
+
+
+def test_first_deploy_runs_everything(env):
+    deploy_plan = plan(env)
+    assert sorted(deploy_plan.get_jobs()) == sorted(deploy_plan.graph)
+
+    deploy(env)
+    assert plan(env).get_jobs() == []
+
+
+def test_new_host(env, tmpdir):
+    deploy(env)
+    tmpdir.join("hosts").write(HOSTS.replace(
+        "zone2-apphost1\n", "zone2-apphost1\nzone2-apphost2\n"))
+
+    deploy_plan = plan(env)
+    assert sorted(deploy_plan.get_jobs()) == [
+        'deploy_apps_bigip.yml',
+        ('deploy_app.yml', 'zone2-apphost2'),
+        ('deploy_app_cft.yml', 'zone2-apphost2')]
+    assert deploy_plan.reasons[('deploy_app_cft.yml', 'zone2-apphost2')] == {
+        'zone2-apphost2': 'new'}
+
+    # without --pipeline each playbook runs once, limited to the new host
+    assert deploy_plan.get_dependencies() == {
+        ('deploy_app_cft.yml', 'zone2-apphost2'): [],
+        ('deploy_app.yml', 'zone2-apphost2'): [
+            ('deploy_app_cft.yml', 'zone2-apphost2')],
+        'deploy_apps_bigip.yml': [('deploy_app.yml', 'zone2-apphost2')]}
+
+
+def test_changed_extra_vars(env):
+    deploy(env)
+    assert len(plan(env, {"image_id": "new"}).get_jobs()) == len(plan(env).graph)
+
+
+def test_stack_torn_down(env):
+    deploy(env)
+    statuses = dict((h, {"state": "deployed"}) for h in
+                    inventory_cache.get(env[0]).groups_list()["all"])
+    statuses["zone1-bigip1"] = {"state": "absent"}
+
+    deploy_plan = plan(env, statuses=statuses)
+    assert deploy_plan.reasons[('deploy_bigip_cft.yml', 'zone1-bigip1')] == {
+        'zone1-bigip1': 'stack absent'}
+    assert ('deploy_bigip.yml', 'zone1-bigip1') in deploy_plan.reasons
+    assert 'cluster_bigips.yml' in deploy_plan.reasons
+    assert ('deploy_bigip_cft.yml', 'zone2-bigip1') not in deploy_plan.reasons
+    assert 'deploy_vpc_cft.yml' not in deploy_plan.reasons
+
+
+def test_limit(env):
+    deploy(env)
+    deploy_plan = plan(env, {"image_id": "new"}, limit="zone2")
+    assert sorted(deploy_plan.get_jobs()) == [
+        'cluster_bigips.yml', 'deploy_apps_bigip.yml',
+        ('deploy_app.yml', 'zone2-apphost1'),
+        ('deploy_app_cft.yml', 'zone2-apphost1'),
+        ('deploy_az_cft.yml', 'zone2-az'),
+        ('deploy_bigip.yml', 'zone2-bigip1'),
+        ('deploy_bigip_cft.yml', 'zone2-bigip1')]
+    # the hosts of zone1 are not mistaken for removed hosts
+    assert deploy_plan.reasons['cluster_bigips.yml'] == {
+        'zone2-bigip1': 'changed'}
+
+    # a limited run keeps what the journal knows about the other hosts
+    journal = DeployJournal("unused", path=env[1])
+    host_inputs = HostInputs(env[0], {"image_id": "new"}, "zone2")
+    journal.record('deploy_apps_bigip.yml', "inputs", 0, {},
+                   host_inputs=host_inputs.get('deploy_apps_bigip.yml'),
+                   limited=True)
+    assert sorted(journal.host_inputs['deploy_apps_bigip.yml']) == [
+        'zone1-apphost1', 'zone1-bigip1', 'zone2-apphost1', 'zone2-bigip1']
+
+
+def test_limit_skips_playbook_without_hosts(env):
+    runner = PlaybookRunner(['deploy_vpc_cft.yml'], {}, env[0],
+                            argparse.Namespace(limit='zone1'), {})
+    statuscode, retry_hosts, pb = runner._run_playbook_once(
+        'deploy_vpc_cft.yml', 'deploy_vpc_cft.yml', None)
+    assert (statuscode, retry_hosts, pb) == (0, [], None)
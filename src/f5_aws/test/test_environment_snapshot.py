@@ -0,0 +1,58 @@
+"""
+test_environment_snapshot.py
+
+Checks the indexes and accessors of the snapshot read by the info commands.
+"""
+
+import pytest
+
+from f5_aws.environment_snapshot import EnvironmentSnapshot
+
+HOSTS = ['vpc-manager', 'zone1-az', 'zone1-bigip1', 'zone1-bigip2',
+         'zone1-bigip-cluster', 'zone1-apphost1', 'zone2-gtm1']
+
+
+def get_snapshot():
+    inventory = {'all': {'hosts': HOSTS, 'vars': {}}}
+    statuses = dict((h, {'state': 'deployed'}) for h in HOSTS)
+    return EnvironmentSnapshot(
+        'lab', inventory, statuses,
+        availability_zones={'zone1-bigip1': 'us-east-1a'},
+        facts={'zone1-bigip1': {'items': [
+            {'name': 'vs1', 'destination': '/Common/10.0.0.5:80'}]}},
+        elastic_ips={'zone1-bigip1': [
+            {'eipAddress': '5.6.7.8', 'privateIpAddress': '10.0.0.5'}]})
+
+
+def test_indexes():
+    snapshot = get_snapshot()
+
+    assert 'zone1-bigip-cluster' not in snapshot.resources
+    assert 'zone1-bigip-cluster' not in snapshot.statuses
+    assert [h.name for h in snapshot.hosts.of_type('bigip')] == [
+        'zone1-bigip1', 'zone1-bigip2']
+    assert [h.name for h in snapshot.hosts.in_zone('zone1')] == [
+        'zone1-az', 'zone1-bigip1', 'zone1-bigip2', 'zone1-bigip-cluster',
+        'zone1-apphost1']
+
+
+def test_accessors():
+    snapshot = get_snapshot()
+
+    assert snapshot.get_az_name('zone1-bigip1') == 'us-east-1a/zone1-bigip1'
+    assert snapshot.get_az_name('zone1-bigip2') == ''
+    assert snapshot.get_virtual_servers('zone1-bigip1') == [
+        {'name': 'vs1', 'destination': '/Common/10.0.0.5:80'}]
+    assert snapshot.get_virtual_servers('zone1-bigip2') == []
+    assert snapshot.get_elastic_ips('zone1-bigip1') == [
+        {'eipAddress': '5.6.7.8', 'privateIpAddress': '10.0.0.5'}]
+
+
+def test_read_only():
+    snapshot = get_snapshot()
+    with pytest.raises(AttributeError):
+        snapshot.statuses = {}
+
+    inventory, resources, statuses = snapshot.copy()
+    statuses['zone1-bigip1']['state'] = 'absent'
+    assert snapshot.get_status('zone1-bigip1')['state'] == 'deployed'
@@ -0,0 +1,97 @@
+"""
+test_events.py
+
+Checks that the events of a run reach the caller through each kind of
+event stream target, including from forked processes as ansible does for
+host results.
+"""
+
+import os
+import json
+import socket
+import multiprocessing
+import pytest
+
+from f5_aws.events import EventStream
+from f5_aws.exceptions import ValidationError
+
+
+def write_from_children(stream, count):
+    children = [multiprocessing.Process(target=stream.write, args=({'n': i},))
+                for i in range(count)]
+    for c in children:
+        c.start()
+    for c in children:
+        c.join()
+
+
+def test_fd():
+    r, w = os.pipe()
+    stream = EventStream('fd:%s' % w)
+    stream.write({'event': 'run_start'})
+    write_from_children(stream, 3)
+    os.close(w)
+
+    with os.fdopen(r) as f:
+        events = [json.loads(line) for line in f]
+    assert events[0] == {'event': 'run_start'}
+    assert sorted(e['n'] for e in events[1:]) == [0, 1, 2]
+
+
+def test_unix_socket(tmpdir):
+    path = str(tmpdir.join('events.sock'))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+
+    write_from_children(EventStream('unix:' + path), 3)
+
+    lines = []
+    for i in range(3):
+        conn, addr = server.accept()
+        lines.extend(conn.makefile().readlines())
+        conn.close()
+    server.close()
+    assert sorted(json.loads(line)['n'] for line in lines) == [0, 1, 2]
+
+
+def test_file(tmpdir):
+    path = tmpdir.join('events.jsonl')
+    stream = EventStream(str(path))
+    stream.write({'event': 'run_start'})
+    stream.write({'event': 'run_end'})
+    assert [json.loads(line)['event'] for line in path.readlines()] == [
+        'run_start', 'run_end']
+
+
+def test_invalid_fd():
+    with pytest.raises(ValidationError):
+        EventStream('fd:stdout')
+
+
+def test_fd_reader_closed():
+    r, w = os.pipe()
+    stream = EventStream('fd:%s' % w)
+    stream.write({'event': 'run_start'})
+    os.close(r)
+    stream.write({'event': 'task_start'})
+    stream.write({'event': 'run_end'})
+    os.close(w)
+    assert stream.broken
+
+
+def test_unix_socket_reader_closed(tmpdir):
+    path = str(tmpdir.join('events.sock'))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    stream = EventStream('unix:%s' % path)
+    stream.write({'event': 'run_start'})
+    conn, _ = server.accept()
+    conn.close()
+    server.close()
+    # the first writes after the reader went away may still be buffered
+    for i in range(10):
+        stream.write({'event': 'host_result', 'n': i})
+    assert stream.broken
+    assert stream._socket is None
@@ -0,0 +1,64 @@
+"""
+test_forks.py
+
+Checks that the number of forks for a playbook is sized from the hosts
+targeted by its plays.
+"""
+
+import ansible.inventory
+
+from f5_aws.playbook_runner import get_play_host_patterns, get_forks
+
+HOSTS = """
+[bigips]
+zone1-bigip1
+zone1-bigip2
+zone2-bigip1
+zone2-bigip2
+
+[gtms]
+zone1-gtm1
+zone2-gtm1
+"""
+
+PLAYBOOK = """
+- hosts: bigips
+  gather_facts: no
+  tasks: []
+- hosts: gtms
+  gather_facts: no
+  tasks: []
+- hosts: bigip-cluster-seeds
+  gather_facts: no
+  tasks: []
+"""
+
+
+def setup_files(tmpdir):
+    hosts = tmpdir.join('hosts')
+    hosts.write(HOSTS)
+    playbook = tmpdir.join('playbook.yml')
+    playbook.write(PLAYBOOK)
+    return ansible.inventory.Inventory(str(hosts)), str(playbook)
+
+
+def test_play_host_patterns(tmpdir):
+    inventory, playbook = setup_files(tmpdir)
+    assert get_play_host_patterns(playbook) == [
+        'bigips', 'gtms', 'bigip-cluster-seeds']
+
+
+def test_forks_from_largest_play(tmpdir):
+    inventory, playbook = setup_files(tmpdir)
+    assert get_forks(playbook, inventory, 100) == 4
+
+
+def test_forks_capped(tmpdir):
+    inventory, playbook = setup_files(tmpdir)
+    assert get_forks(playbook, inventory, 3) == 3
+
+
+def test_forks_limited_inventory(tmpdir):
+    inventory, playbook = setup_files(tmpdir)
+    inventory.subset('zone1-bigip1')
+    assert get_forks(playbook, inventory, 100) == 1
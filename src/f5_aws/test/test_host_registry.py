@@ -0,0 +1,42 @@
+"""
+test_host_registry.py
+
+Checks the parsing of inventory hostnames and the indexes of the registry.
+"""
+
+import pytest
+
+from f5_aws.host_registry import HostRecord, HostRegistry
+
+
+@pytest.mark.parametrize('name,expected', [
+    ('zone1-bigip2', ('zone1', 'bigip', 2)),
+    ('zone12-analyticshost1', ('zone12', 'analyticshost', 1)),
+    ('zone2-bigip-cluster', ('zone2', 'bigip-cluster', None)),
+    ('zone1-az', ('zone1', 'az', None)),
+    ('vpc-manager', (None, 'vpc-manager', None)),
+    ('localhost', (None, 'localhost', None)),
+])
+def test_parse(name, expected):
+    record = HostRecord.parse(name)
+    assert (record.zone, record.host_type, record.index) == expected
+
+
+def test_slots():
+    record = HostRecord.parse('zone1-bigip1')
+    with pytest.raises(AttributeError):
+        record.region = 'us-east-1'
+
+
+def test_registry():
+    hosts = HostRegistry(['vpc-manager', 'zone1-bigip1', 'zone1-bigip-cluster',
+                          'zone2-bigip1', 'zone2-gtm1'])
+
+    assert len(hosts) == 5
+    assert hosts.get('zone2-gtm1').zone == 'zone2'
+    assert hosts.get('zone3-gtm1') is None
+    assert [h.name for h in hosts.of_type('bigip')] == [
+        'zone1-bigip1', 'zone2-bigip1']
+    assert [h.name for h in hosts.in_zone('zone1')] == [
+        'zone1-bigip1', 'zone1-bigip-cluster']
+    assert [h.name for h in hosts if h.is_cluster] == ['zone1-bigip-cluster']
@@ -0,0 +1,65 @@
+"""
+test_inventory_cache.py
+
+Checks that parsed inventories (and the summaries kept on disk) are reused
+until one of the inventory files changes, and that each caller gets a copy
+it is free to modify.
+"""
+
+from f5_aws.inventory_cache import InventoryCache
+
+
+def write_inventory(tmpdir, zone):
+    tmpdir.join("hosts").write("[bigips]\nzone1-bigip1\n")
+    tmpdir.join("group_vars").ensure(dir=True)
+    tmpdir.join("group_vars", "bigips").write("availability_zone: %s\n" % zone)
+    return str(tmpdir.join("hosts"))
+
+
+def test_cache_hit_returns_copy(tmpdir):
+    cache = InventoryCache()
+    path = write_inventory(tmpdir, "us-east-1b")
+
+    first = cache.get(path)
+    first.add_group(first.get_group("bigips").__class__("dynamic"))
+    second = cache.get(path)
+
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert "dynamic" not in second.groups_list()
+
+
+def test_cache_miss_after_rewrite(tmpdir):
+    cache = InventoryCache()
+    path = write_inventory(tmpdir, "us-east-1b")
+    cache.get(path)
+
+    write_inventory(tmpdir, "us-east-1c")
+    inventory = cache.get(path)
+
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert inventory.get_host("zone1-bigip1").get_variables()[
+        "availability_zone"] == "us-east-1c"
+
+
+def summarize(inventory):
+    return {"hosts": inventory.list_hosts("bigips")}
+
+
+def test_summary(tmpdir):
+    path = write_inventory(tmpdir, "us-east-1b")
+    summary_path = str(tmpdir.join("summary.json"))
+
+    cache = InventoryCache()
+    assert cache.get_summary(path, summarize, summary_path) == {
+        "hosts": ["zone1-bigip1"]}
+
+    # read from disk by a new process, without parsing the inventory
+    cache = InventoryCache()
+    assert cache.get_summary(path, summarize, summary_path) == {
+        "hosts": ["zone1-bigip1"]}
+    assert cache.misses == 0
+
+    tmpdir.join("hosts").write("[bigips]\nzone1-bigip2\n")
+    assert cache.get_summary(path, summarize, summary_path) == {
+        "hosts": ["zone1-bigip2"]}
+    assert cache.misses == 1
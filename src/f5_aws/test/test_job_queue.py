@@ -0,0 +1,97 @@
+"""
+test_job_queue.py
+
+Checks the job queue: one running job per environment in submission order,
+reclaiming the jobs of a worker whose lease expired, and the worker pool,
+with a stand-in for the process which runs a job.
+"""
+
+import os
+import json
+import time
+import pytest
+
+from f5_aws.job_queue import JobQueue, run_workers
+from f5_aws.exceptions import ValidationError
+
+
+def test_one_job_per_env(tmpdir):
+    queue = JobQueue(str(tmpdir.join('jobs.db')))
+    first = queue.submit('lab-1', 'deploy', {'deployment_type': 'lb_only'})
+    second = queue.submit('lab-1', 'teardown')
+    other = queue.submit('lab-2', 'deploy')
+
+    assert queue.claim('w1')['id'] == first
+    # the teardown waits for the deploy of lab-1
+    job = queue.claim('w1')
+    assert job['id'] == other
+    assert job['extra_vars'] == {}
+    assert queue.claim('w1') is None
+
+    queue.finish(first, 'w1', 0)
+    assert queue.get_job(first)['status'] == 'succeeded'
+    assert queue.claim('w2')['id'] == second
+
+
+def test_submit_validation(tmpdir):
+    queue = JobQueue(str(tmpdir.join('jobs.db')))
+    with pytest.raises(ValidationError):
+        queue.submit('lab-1', 'start_traffic')
+    with pytest.raises(ValidationError):
+        queue.submit('lab-1', 'teardown', {'a': 1})
+
+
+def test_lease_reclaimed(tmpdir):
+    queue = JobQueue(str(tmpdir.join('jobs.db')))
+    job_id = queue.submit('lab-1', 'deploy')
+
+    assert queue.claim('w1', lease=0.1)['id'] == job_id
+    assert queue.claim('w2') is None
+    time.sleep(0.2)
+
+    job = queue.claim('w2')
+    assert (job['id'], job['worker'], job['attempts']) == (job_id, 'w2', 2)
+    # w1 lost the job
+    assert not queue.renew(job_id, 'w1')
+    assert queue.renew(job_id, 'w2')
+
+
+def test_lease_attempts(tmpdir, monkeypatch):
+    monkeypatch.setattr('f5_aws.job_queue.MAX_ATTEMPTS', 2)
+    queue = JobQueue(str(tmpdir.join('jobs.db')))
+    job_id = queue.submit('lab-1', 'deploy')
+
+    for worker in ['w1', 'w2']:
+        queue.claim(worker, lease=0)
+        time.sleep(0.01)
+    assert queue.claim('w3') is None
+    assert queue.get_job(job_id)['status'] == 'failed'
+
+
+def fake_job(job, event_fd):
+    """Sends two events, fails the jobs of 'bad' environments"""
+    for event in ['run_start', 'run_end']:
+        os.write(event_fd, json.dumps({'event': event, 'env': job['env'],
+                                       'time': time.time()}) + '\n')
+        time.sleep(0.3)
+    os._exit(1 if job['env'].startswith('bad') else 0)
+
+
+def test_workers(tmpdir, monkeypatch):
+    monkeypatch.setattr('f5_aws.job_queue.get_job_log_path',
+                        lambda job_id: str(tmpdir.join('jobs', '%s.log' % job_id)))
+    queue = JobQueue(str(tmpdir.join('jobs.db')))
+    ids = [queue.submit(env, 'deploy') for env in ['lab-1', 'lab-2', 'bad-1']]
+
+    start = time.time()
+    run_workers(queue, concurrency=3, run=fake_job, exit_when_idle=True,
+                poll_interval=0.1)
+
+    # the three environments ran in parallel
+    assert time.time() - start < 1.5
+    assert [queue.get_job(i)['status'] for i in ids] == [
+        'succeeded', 'succeeded', 'failed']
+    assert [e['event'] for seq, e in queue.get_events(ids[0])] == [
+        'run_start', 'run_end']
+    seq, event = queue.get_events(ids[0])[0]
+    assert queue.get_events(ids[0], after=seq)[0][1]['event'] == 'run_end'
@@ -0,0 +1,70 @@
+"""
+test_journal.py
+
+Checks that `deploy --resume` skips the jobs which completed in a previous
+run with the same inputs.  The playbooks are replaced by a stub, nothing is
+deployed to AWS.
+"""
+
+import pytest
+
+from f5_aws.journal import DeployJournal
+from test_deploy_graph import StubRunner
+
+GRAPH = {
+    'deploy_vpc_cft.yml': [],
+    'deploy_az_cft.yml': ['deploy_vpc_cft.yml'],
+    'deploy_bigip_cft.yml': ['deploy_az_cft.yml'],
+    'deploy_gtm_cft.yml': ['deploy_az_cft.yml'],
+}
+
+
+@pytest.fixture
+def inventory(tmpdir):
+    tmpdir.join("hosts").write("[bigips]\nzone1-bigip1\n")
+    return str(tmpdir.join("hosts"))
+
+
+def run(tmpdir, inventory, extra_vars, failing=(), resume=False):
+    journal = DeployJournal(
+        "unused", path=str(tmpdir.join("deploy_journal.json")))
+    runner = StubRunner(GRAPH, 1, failing, journal=journal, resume=resume)
+    runner.inventory_path = inventory
+    runner.extra_vars = extra_vars
+    runner.statuscode = runner._run_scheduled()
+    started = [pb for kind, pb, t in runner.events() if kind == 'start']
+    return runner, started
+
+
+def test_resume_skips_completed(tmpdir, inventory):
+    runner, started = run(tmpdir, inventory, {"region": "us-east-1"},
+                          failing=('deploy_bigip_cft.yml',))
+    assert runner.statuscode == 2
+
+    runner, started = run(tmpdir, inventory, {"region": "us-east-1"},
+                          resume=True)
+    assert runner.statuscode == 0
+    assert sorted(started) == ['deploy_bigip_cft.yml', 'deploy_gtm_cft.yml']
+    assert 'deploy_az_cft.yml' in runner.skipped
+
+
+def test_resume_reruns_changed_inputs(tmpdir, inventory):
+    run(tmpdir, inventory, {"region": "us-east-1"})
+
+    runner, started = run(tmpdir, inventory, {"region": "us-west-2"},
+                          resume=True)
+    assert len(started) == len(GRAPH)
+
+
+def test_interrupted_save_keeps_journal(tmpdir, inventory, monkeypatch):
+    run(tmpdir, inventory, {"region": "us-east-1"})
+    path = tmpdir.join("deploy_journal.json")
+    saved = path.read()
+
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr('f5_aws.journal.json.dump', interrupted)
+    journal = DeployJournal("unused", path=str(path))
+    with pytest.raises(KeyboardInterrupt):
+        journal.record('deploy_vpc_cft.yml', "other", 0, {})
+    assert path.read() == saved
@@ -0,0 +1,110 @@
+"""
+test_live_status.py
+
+Checks the live stack status used by `info resources --live`: pagination of
+describe_stacks, the mapping of stack statuses, and the cache.  The last
+test runs against moto's CloudFormation stand-in when it is installed.
+"""
+
+import json
+import pytest
+
+from f5_aws.live_status import LiveStatus, get_stack_state
+
+
+class Output(object):
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+
+class Stack(object):
+    def __init__(self, name, status, outputs=None):
+        self.stack_name = name
+        self.stack_status = status
+        self.outputs = [Output(k, v) for k, v in (outputs or {}).items()]
+
+
+class Page(list):
+    next_token = None
+
+
+class FakeConnection(object):
+    """Returns the stacks two at a time, as CloudFormation pages them"""
+
+    def __init__(self, stacks):
+        self.stacks = stacks
+        self.calls = 0
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        self.calls += 1
+        start = int(next_token or 0)
+        page = Page(self.stacks[start:start + 2])
+        if start + 2 < len(self.stacks):
+            page.next_token = str(start + 2)
+        return page
+
+
+STACKS = [
+    Stack('lab-vpc-manager', 'CREATE_COMPLETE', {'vpc': 'vpc-1'}),
+    Stack('lab-zone1-bigip1', 'ROLLBACK_COMPLETE'),
+    Stack('lab-zone1-client', 'UPDATE_IN_PROGRESS'),
+    Stack('other-vpc-manager', 'CREATE_COMPLETE'),
+    Stack('lab2-vpc-manager', 'CREATE_COMPLETE'),
+]
+
+
+def test_get_stack_state():
+    assert get_stack_state('CREATE_COMPLETE') == 'deployed'
+    assert get_stack_state('UPDATE_COMPLETE') == 'deployed'
+    assert get_stack_state('CREATE_IN_PROGRESS') == 'in progress'
+    assert get_stack_state('ROLLBACK_COMPLETE') == 'deploy-error'
+    assert get_stack_state('DELETE_FAILED') == 'teardown-error'
+    assert get_stack_state(None) == 'absent'
+
+
+def test_env_stacks(tmpdir):
+    conns = {'us-east-1': FakeConnection(STACKS)}
+    live = LiveStatus(str(tmpdir), connect=conns.get)
+
+    stacks = live.get_env_stacks({'lab': 'us-east-1', 'lab2': 'us-east-1'})
+
+    # all pages were read, with one listing for both environments
+    assert conns['us-east-1'].calls == 3
+    assert sorted(stacks['lab']) == ['vpc-manager', 'zone1-bigip1',
+                                     'zone1-client']
+    assert stacks['lab']['vpc-manager'] == {
+        'stack_status': 'CREATE_COMPLETE', 'outputs': {'vpc': 'vpc-1'}}
+    assert list(stacks['lab2']) == ['vpc-manager']
+
+
+def test_cache(tmpdir):
+    conn = FakeConnection(STACKS)
+    live = LiveStatus(str(tmpdir), connect=lambda region: conn)
+
+    first = live.get_region_stacks('us-west-2')
+    assert live.get_region_stacks('us-west-2') == first
+    assert conn.calls == 3
+    assert json.load(tmpdir.join('us-west-2.json').open()) == first
+
+    LiveStatus(str(tmpdir), cache_ttl=0,
+               connect=lambda region: conn).get_region_stacks('us-west-2')
+    assert conn.calls == 6
+
+
+def test_moto(tmpdir):
+    moto = pytest.importorskip('moto')
+    import boto.cloudformation
+
+    template = json.dumps({
+        'Resources': {'Queue': {'Type': 'AWS::SQS::Queue'}},
+        'Outputs': {'QueueName': {'Value': 'lab-queue'}}})
+
+    with moto.mock_cloudformation_deprecated():
+        conn = boto.cloudformation.connect_to_region('us-east-1')
+        conn.create_stack('lab-vpc-manager', template_body=template)
+
+        stacks = LiveStatus(str(tmpdir)).get_env_stacks({'lab': 'us-east-1'})
+
+    assert get_stack_state(
+        stacks['lab']['vpc-manager']['stack_status']) == 'deployed'
@@ -0,0 +1,69 @@
+"""
+test_retries.py
+
+Checks that a playbook which failed on some hosts is run again: the per-host
+playbooks against only those hosts, the playbooks which join the results of
+every host as a whole.  ansible is replaced by a stub, nothing is deployed
+to AWS.
+"""
+
+import argparse
+import pytest
+
+from f5_aws.playbook_runner import PlaybookRunner
+
+
+class RetryRunner(PlaybookRunner):
+    """Fails the hosts of failures[attempt] on each attempt"""
+
+    def __init__(self, failures, retries, retry_delay=0):
+        options = argparse.Namespace(retries=retries, retry_delay=retry_delay)
+        PlaybookRunner.__init__(self, [], {}, '', options, {})
+        self.failures = failures
+        self.limits = []
+
+    def _run_playbook_once(self, job, playbook, limit, recorder=None):
+        self.limits.append(limit)
+        failed = self.failures[min(len(self.limits), len(self.failures)) - 1]
+        return (2 if failed else 0), failed, None
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('f5_aws.playbook_runner.time.sleep', sleeps.append)
+    return sleeps
+
+
+def test_join_playbook_reruns_whole(sleeps):
+    runner = RetryRunner([['zone1-bigip1'], []], retries=1)
+    assert runner._run_playbook('cluster_bigips.yml') == 0
+    # the seeds of every cluster are gathered again
+    assert runner.limits == [None, None]
+
+
+def test_retries_failed_hosts(sleeps):
+    runner = RetryRunner([['zone1-bigip1', 'zone2-bigip1'], ['zone2-bigip1'],
+                          []], retries=3, retry_delay=5)
+    assert runner._run_playbook('deploy_bigip.yml') == 0
+    assert runner.limits == [None, 'zone1-bigip1:zone2-bigip1', 'zone2-bigip1']
+    # the delay doubles with every retry
+    assert sleeps == [5, 10]
+
+
+def test_retries_exhausted(sleeps):
+    runner = RetryRunner([['zone1-bigip1']], retries=2, retry_delay=1)
+    assert runner._run_playbook(('deploy_bigip.yml', 'zone1-bigip1')) == 2
+    assert len(runner.limits) == 3
+    assert sleeps == [1, 2]
+
+
+def test_no_retries_by_default(sleeps):
+    from f5_aws.cli import get_parser
+    options = get_parser().parse_args(['deploy', 'lab'])
+    assert options.retries == 0
+
+    runner = RetryRunner([['zone1-bigip1']], retries=options.retries)
+    assert runner._run_playbook('deploy_bigip.yml') == 2
+    assert runner.limits == [None]
+    assert sleeps == []
@@ -0,0 +1,60 @@
+"""
+test_run_history.py
+
+Checks that runs are recorded from their timeline, and the stage
+percentiles and regressions computed from the run history.
+"""
+
+from f5_aws.run_history import (RunHistory, percentile, get_stage_percentiles,
+                                find_regressions)
+
+
+def timeline(run_id, start, durations):
+    """Timeline events for a serial run of the given {playbook: duration}"""
+    events = [{'run': run_id, 'job': None, 'event': 'run_start',
+               'time': start, 'playbooks': sorted(durations)}]
+    t = start
+    for pb in sorted(durations):
+        events.append({'run': run_id, 'job': pb, 'event': 'playbook_start',
+                       'time': t, 'requires': []})
+        events.append({'run': run_id, 'job': pb, 'event': 'host_result',
+                       'time': t + durations[pb], 'start': t, 'host': 'zone1-bigip1',
+                       'task': 'wait', 'status': 'ok'})
+        t += durations[pb]
+        events.append({'run': run_id, 'job': pb, 'event': 'playbook_end',
+                       'time': t, 'statuscode': 0})
+    return events
+
+
+def test_percentile():
+    assert percentile([4, 1, 3, 2], 50) == 2
+    assert percentile([4, 1, 3, 2], 90) == 4
+    assert percentile([], 50) is None
+
+
+def test_record_and_percentiles(tmpdir):
+    history = RunHistory(str(tmpdir.join('run_history.db')))
+    for i, d in enumerate([10, 20, 30, 40]):
+        run_id = 'run%s' % i
+        history.record_run(run_id, 'lab-%s' % i, 'single-standalone', 'us-east-1',
+                           timeline(run_id, i * 1000, {'a.yml': d, 'b.yml': 5}), 0)
+    durations = history.get_stage_durations('single-standalone')
+    stats = get_stage_percentiles(durations)
+
+    assert stats[('single-standalone', 'a.yml')]['runs'] == 4
+    assert stats[('single-standalone', 'a.yml')][50] == 20
+    assert stats[('single-standalone', 'b.yml')][90] == 5
+    assert history.get_stage_durations('cluster-per-zone') == {}
+
+
+def test_regression(tmpdir):
+    history = RunHistory(str(tmpdir.join('run_history.db')))
+    for i, d in enumerate([10, 11, 9, 10, 30]):
+        run_id = 'run%s' % i
+        history.record_run(run_id, 'lab', 'single-standalone', 'us-east-1',
+                           timeline(run_id, i * 1000, {'a.yml': d, 'b.yml': 5}), 0)
+    regressions = find_regressions(history.get_stage_durations(), threshold=1.5)
+
+    assert [(pb, run_id) for m, pb, run_id, env, d, b in regressions] == [
+        ('a.yml', 'run4')]
+    assert regressions[0][5] == 10
@@ -0,0 +1,129 @@
+"""
+test_server.py
+
+Checks that bin/f5aws forwards commands to `f5aws serve` and gets their
+output and exit status back, that commands run with the environment of the
+client and concurrently, and that the commands which change an environment
+take its lock.
+"""
+
+import os
+import sys
+import time
+import fcntl
+import threading
+import multiprocessing
+
+from f5_aws import server
+from f5_aws.config import Config
+from f5_aws.environment_manager import lock_environment
+
+
+def fake_command(request):
+    if request['argv'][0] == 'sleep':
+        time.sleep(1)
+    sys.stdout.write('ran %s\n' % ' '.join(request['argv']))
+    sys.stderr.write('in %s with %s\n' % (
+        os.getcwd(), os.environ.get('F5AWS_TEST_VAR')))
+    return 3
+
+
+class SlowRefreshServer(server.CommandServer):
+    def refresh(self):
+        time.sleep(5)
+
+
+def start_server(socket_path, server_class=server.CommandServer):
+    def run():
+        command_server = server_class(socket_path, run=fake_command)
+        command_server.start_refresh(interval=0.01)
+        command_server.serve_forever()
+
+    process = multiprocessing.Process(target=run)
+    process.start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.05)
+    return process
+
+
+def test_no_server(tmpdir):
+    assert server.forward(['list'], str(tmpdir.join('f5aws.sock'))) is None
+
+
+def test_forward(tmpdir, capsys, monkeypatch):
+    socket_path = str(tmpdir.join('f5aws.sock'))
+    process = start_server(socket_path)
+    monkeypatch.setenv('F5AWS_TEST_VAR', 'client')
+    try:
+        assert server.forward(['info', 'login', 'lab'], socket_path) == 3
+        out, err = capsys.readouterr()
+        assert out == 'ran info login lab\n'
+        assert err == 'in %s with client\n' % os.getcwd()
+
+        # these are always run in-process
+        assert server.forward(['serve'], socket_path) is None
+        assert server.forward(['--event-stream', 'fd:3', 'deploy', 'lab'],
+                              socket_path) is None
+    finally:
+        process.terminate()
+
+
+def test_refused_import_time_settings(tmpdir, monkeypatch):
+    socket_path = str(tmpdir.join('f5aws.sock'))
+    process = start_server(socket_path)
+    # ansible read its settings when the server imported it
+    monkeypatch.setenv('ANSIBLE_FORKS', '7')
+    try:
+        assert server.forward(['info', 'login', 'lab'], socket_path) is None
+    finally:
+        process.terminate()
+
+
+def test_refresh_does_not_block(tmpdir):
+    socket_path = str(tmpdir.join('f5aws.sock'))
+    process = start_server(socket_path, SlowRefreshServer)
+    try:
+        time.sleep(0.1)
+        start = time.time()
+        assert server.forward(['info'], socket_path) == 3
+        assert time.time() - start < 2
+    finally:
+        process.terminate()
+
+
+def test_concurrent(tmpdir):
+    socket_path = str(tmpdir.join('f5aws.sock'))
+    process = start_server(socket_path)
+    try:
+        start = time.time()
+        threads = [threading.Thread(target=server.forward,
+                                    args=(['sleep'], socket_path))
+                   for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert time.time() - start < 2.5
+    finally:
+        process.terminate()
+
+
+def try_lock(env_name, locked):
+    path = '%s/locks/%s.lock' % (Config().config['vars_path'], env_name)
+    with open(path, 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            locked.value = 1
+
+
+def test_lock_environment():
+    locked = multiprocessing.Value('i', 0)
+    with lock_environment('test-lock-a'):
+        for env_name, expected in [('test-lock-a', 1), ('test-lock-b', 0)]:
+            locked.value = 0
+            p = multiprocessing.Process(target=try_lock,
+                                        args=(env_name, locked))
+            p.start()
+            p.join()
+            assert locked.value == expected
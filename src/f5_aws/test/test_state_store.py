@@ -0,0 +1,87 @@
+"""
+test_state_store.py
+
+Checks the state store of an environment, and the import of the YAML/JSON
+files persisted by deploys which ran before the store existed.
+"""
+
+import json
+import yaml
+import pytest
+import sqlite3
+
+from f5_aws.state_store import SCHEMA, StateStore
+from library_modules import load_library_module
+
+BIGIP_RESULT = {
+    'invocation': {'module_name': 'cloudformation'},
+    'output': 'Stack CREATE complete',
+    'stack_outputs': {'ManagementInterfacePublicIp': '1.2.3.4'},
+}
+
+EIP_RESULT = {
+    'invocation': {'module_name': 'cloudformation'},
+    'output': 'Stack CREATE complete',
+    'stack_outputs': {'eipAddress': '5.6.7.8', 'privateIpAddress': '10.0.0.5'},
+}
+
+
+def test_import_files(tmpdir):
+    tmpdir.join('zone1-bigip1.yml').write(yaml.dump(BIGIP_RESULT))
+    tmpdir.join('zone1-bigip1-vip-Vip1.yml').write(yaml.dump(EIP_RESULT))
+    tmpdir.join('facts_zone1-bigip1.json').write(json.dumps({'items': []}))
+    tmpdir.join('zone1-bigip1_peer_info.yml').write(yaml.dump({'peer': 'x'}))
+
+    store = StateStore('demo', str(tmpdir.join('state.db')))
+
+    assert store.get_all('result') == {'zone1-bigip1': BIGIP_RESULT}
+    assert store.find('zone1-bigip1', 'result', 'vip-') == [EIP_RESULT]
+    assert store.find_all('result', 'vip-') == {'zone1-bigip1': [EIP_RESULT]}
+    assert store.get('zone1-bigip1', 'facts') == {'items': []}
+
+
+def test_recorded_entries_kept(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    # written by a task (library/f5aws_state.py) before the first read
+    store = StateStore('demo', path)
+    store.db.execute("DELETE FROM state WHERE kind = 'meta'")
+    store.db.commit()
+    store.put('zone1-bigip1', 'result', EIP_RESULT)
+    store.close()
+    tmpdir.join('zone1-bigip1.yml').write(yaml.dump(BIGIP_RESULT))
+
+    store = StateStore('demo', path)
+    assert store.get('zone1-bigip1', 'result') == EIP_RESULT
+
+
+def test_import_once(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    StateStore('demo', path).close()
+    tmpdir.join('zone1-bigip1.yml').write(yaml.dump(BIGIP_RESULT))
+
+    assert StateStore('demo', path).get_all('result') == {}
+
+
+def test_facts_as_json_string(tmpdir):
+    store = StateStore('demo', str(tmpdir.join('state.db')))
+    # the gtm facts are handed to the module through to_json
+    store.put('zone1-gtm1', 'facts', json.dumps({'items': [{'name': 'wip'}]}))
+    assert store.get('zone1-gtm1', 'facts') == {'items': [{'name': 'wip'}]}
+
+
+def test_imported_store_is_read_only(tmpdir):
+    path = tmpdir.join('state.db')
+    StateStore('demo', str(path)).close()
+    tmpdir.join('zone1-bigip1.yml').write(yaml.dump(BIGIP_RESULT))
+    mtime = path.mtime()
+
+    store = StateStore('demo', str(path))
+    assert store.get_all('result') == {}
+    with pytest.raises(sqlite3.OperationalError):
+        store.put('zone1-bigip1', 'result', BIGIP_RESULT)
+    assert path.mtime() == mtime
+
+
+def test_schema_matches_module():
+    # library/f5aws_state.py writes the store the tasks record into
+    assert load_library_module('f5aws_state').SCHEMA == SCHEMA
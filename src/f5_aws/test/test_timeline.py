@@ -0,0 +1,79 @@
+"""
+test_timeline.py
+
+Checks the events written by TimelineRecorder and the reports built from
+the timeline of a run.
+"""
+
+import json
+
+from f5_aws.timeline import (TimelineFile, TimelineRecorder, load_timeline,
+                             get_critical_path, get_slowest_tasks)
+
+
+def record(path, run_id, job, event, at, **fields):
+    fields.update({'run': run_id, 'job': job, 'event': event, 'time': at})
+    path.write(json.dumps(fields) + '\n', mode='a')
+
+
+def write_run(path, run_id):
+    # a and b are independent, c waits for both of them
+    record(path, run_id, 'a.yml', 'playbook_start', 0, requires=[])
+    record(path, run_id, 'b.yml', 'playbook_start', 0, requires=[])
+    record(path, run_id, 'a.yml', 'host_result', 5, play='a', task='create stack',
+           host='zone1-bigip1', status='changed', start=1)
+    record(path, run_id, 'a.yml', 'playbook_end', 6, statuscode=0)
+    record(path, run_id, 'b.yml', 'host_result', 9, play='b', task='wait for bigip',
+           host='zone1-bigip2', status='ok', start=1)
+    record(path, run_id, 'b.yml', 'playbook_end', 10, statuscode=0)
+    record(path, run_id, 'c.yml', 'playbook_start', 10, requires=['a.yml', 'b.yml'])
+    record(path, run_id, 'c.yml', 'playbook_end', 12, statuscode=0)
+
+
+def test_latest_run(tmpdir):
+    path = tmpdir.join('timeline.jsonl')
+    write_run(path, 'run1')
+    record(path, 'run2', 'a.yml', 'playbook_start', 20, requires=[])
+
+    assert [e['job'] for e in load_timeline(str(path))] == ['a.yml']
+    assert len(load_timeline(str(path), 'run1')) == 8
+
+
+def test_critical_path(tmpdir):
+    path = tmpdir.join('timeline.jsonl')
+    write_run(path, 'run1')
+    events = load_timeline(str(path))
+
+    assert get_critical_path(events) == [('b.yml', 0, 10), ('c.yml', 10, 12)]
+
+
+def test_slowest_tasks(tmpdir):
+    path = tmpdir.join('timeline.jsonl')
+    write_run(path, 'run1')
+    tasks = get_slowest_tasks(load_timeline(str(path)), top=1)
+
+    assert len(tasks) == 1
+    assert tasks[0]['task'] == 'wait for bigip'
+    assert tasks[0]['duration'] == 8
+
+
+def test_recorder(tmpdir):
+    path = tmpdir.join('timeline.jsonl')
+    recorder = TimelineRecorder([TimelineFile(str(path))], 'run1', 'a.yml')
+    recorder.play = 'a'
+    recorder.start_task('create stack')
+    recorder.host_result('zone1-bigip1', 'changed')
+    recorder.start_task('wait for stack')
+    events = load_timeline(str(path))
+
+    assert [e['event'] for e in events] == [
+        'task_start', 'host_result', 'task_end', 'task_start']
+    assert events[1]['task'] == 'create stack'
+    assert events[1]['start'] == events[0]['time']
+    assert events[2]['task'] == 'create stack'
+
+
+def test_missing_environment_directory(tmpdir):
+    path = tmpdir.join('removed', 'timeline.jsonl')
+    TimelineFile(str(path)).write({'event': 'playbook_start'})
+    assert not path.check()
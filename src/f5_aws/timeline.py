@@ -0,0 +1,209 @@
+# timeline.py
+
+"""
+Records when each playbook, play, task and host result of a run started and
+finished, so that we can see where the time of a deploy goes (creating the
+CloudFormation stacks, waiting for the BIG-IPs to become ready, or pushing
+configuration over REST).
+
+Events are appended as json lines to ~/vars/f5aws/env/<env>/timeline.jsonl.
+Host results are reported from within the processes ansible forks for each
+task, every event is therefore written with a single append.
+"""
+
+import os
+import json
+import time
+import datetime
+
+import ansible.utils
+from ansible import callbacks
+
+from f5_aws.config import Config
+
+
+def get_timeline_path(env_name):
+    return "{}/{}/timeline.jsonl".format(Config().config["env_path"], env_name)
+
+
+def new_run_id():
+    return "{}-{}".format(
+        datetime.datetime.now().strftime("%Y%m%d%H%M%S"), os.getpid())
+
+
+class TimelineFile(object):
+    """Appends events to the timeline file of an environment"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, event):
+        # the environment directory is only created by `init`, and is gone
+        #  after `remove`
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps(event, sort_keys=True) + "\n")
+
+
+class TimelineRecorder(object):
+    """
+      Passes the events for one job of a run to each of the sinks (a
+      TimelineFile, or an EventStream from events.py).  The callbacks below
+      keep track of the play and task which is currently executing, so that
+      host results can be attributed to them.
+    """
+
+    def __init__(self, sinks, run_id, job):
+        self.sinks = sinks
+        self.run_id = run_id
+        self.job = job
+        self.play = None
+        self.task = None
+        self.task_start = None
+
+    def record(self, event, **fields):
+        fields.setdefault("time", time.time())
+        fields.update({"run": self.run_id, "job": self.job, "event": event})
+        for sink in self.sinks:
+            sink.write(fields)
+
+    def start_task(self, name):
+        self.end_task()
+        self.task = name
+        self.task_start = time.time()
+        self.record("task_start", play=self.play, task=name,
+                    time=self.task_start)
+
+    def end_task(self):
+        if self.task is None:
+            return
+        self.record("task_end", play=self.play, task=self.task,
+                    start=self.task_start)
+        self.task = None
+
+    def host_result(self, host, status):
+        self.record("host_result", play=self.play, task=self.task,
+                    host=host, status=status, start=self.task_start)
+
+
+class TimelinePlaybookCallbacks(callbacks.PlaybookCallbacks):
+
+    def __init__(self, recorder, verbose=False):
+        callbacks.PlaybookCallbacks.__init__(self, verbose=verbose)
+        self.recorder = recorder
+
+    def on_play_start(self, name):
+        self.recorder.end_task()
+        self.recorder.play = name
+        self.recorder.record("play_start", play=name)
+        callbacks.PlaybookCallbacks.on_play_start(self, name)
+
+    def on_setup(self):
+        self.recorder.start_task("GATHERING FACTS")
+        callbacks.PlaybookCallbacks.on_setup(self)
+
+    def on_task_start(self, name, is_conditional):
+        self.recorder.start_task(name)
+        callbacks.PlaybookCallbacks.on_task_start(self, name, is_conditional)
+
+    def on_stats(self, stats):
+        self.recorder.end_task()
+        self.recorder.record("stats", hosts=dict(
+            (h, stats.summarize(h)) for h in stats.processed))
+        callbacks.PlaybookCallbacks.on_stats(self, stats)
+
+
+class TimelineRunnerCallbacks(callbacks.PlaybookRunnerCallbacks):
+
+    def __init__(self, recorder, stats, verbose=None):
+        callbacks.PlaybookRunnerCallbacks.__init__(self, stats, verbose=verbose)
+        self.recorder = recorder
+
+    def on_ok(self, host, host_result):
+        self.recorder.host_result(
+            host, "changed" if host_result.get("changed", False) else "ok")
+        callbacks.PlaybookRunnerCallbacks.on_ok(self, host, host_result)
+
+    def on_failed(self, host, results, ignore_errors=False):
+        self.recorder.host_result(host, "ignored" if ignore_errors else "failed")
+        callbacks.PlaybookRunnerCallbacks.on_failed(
+            self, host, results, ignore_errors=ignore_errors)
+
+    def on_unreachable(self, host, results):
+        self.recorder.host_result(host, "unreachable")
+        callbacks.PlaybookRunnerCallbacks.on_unreachable(self, host, results)
+
+    def on_skipped(self, host, item=None):
+        self.recorder.host_result(host, "skipped")
+        callbacks.PlaybookRunnerCallbacks.on_skipped(self, host, item)
+
+
+def load_timeline(path, run_id=None):
+    """
+      Returns the events of the given run, by default the most recent run
+      found in the timeline file.
+    """
+    events = []
+    if not os.path.isfile(path):
+        return events
+    with open(path) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # a line cut short by an interrupted run
+                continue
+    if run_id is None and events:
+        run_id = events[-1]["run"]
+    return [e for e in events if e["run"] == run_id]
+
+
+def get_jobs(events):
+    """Returns {job: {start, end, status, requires}} for the jobs of a run"""
+    jobs = {}
+    for e in events:
+        if e["event"] == "playbook_start":
+            jobs[e["job"]] = {"start": e["time"], "end": None,
+                              "status": None, "requires": e.get("requires", [])}
+        elif e["event"] == "playbook_end" and e["job"] in jobs:
+            jobs[e["job"]]["end"] = e["time"]
+            jobs[e["job"]]["status"] = e.get("statuscode")
+    return jobs
+
+
+def get_critical_path(events):
+    """
+      Returns the chain of jobs which determined the duration of the run as
+      a list of (job, start, end).  Starting from the job which finished
+      last, we walk back through the dependency which finished last, i.e.
+      the one the job had to wait for.
+    """
+    jobs = dict((name, job) for name, job in get_jobs(events).items()
+                if job["end"] is not None)
+    if not jobs:
+        return []
+
+    path = []
+    name = max(jobs, key=lambda j: jobs[j]["end"])
+    while name is not None:
+        path.append((name, jobs[name]["start"], jobs[name]["end"]))
+        requires = [j for j in jobs[name]["requires"] if j in jobs]
+        if requires:
+            name = max(requires, key=lambda j: jobs[j]["end"])
+        else:
+            name = None
+    path.reverse()
+    return path
+
+
+def get_slowest_tasks(events, top=10):
+    """Returns the top slowest task results as dicts, slowest first"""
+    tasks = []
+    for e in events:
+        if e["event"] != "host_result" or e.get("start") is None:
+            continue
+        tasks.append({"job": e["job"], "task": e["task"], "host": e["host"],
+                      "status": e["status"], "duration": e["time"] - e["start"]})
+    tasks.sort(key=lambda t: t["duration"], reverse=True)
+    return tasks[:top]
@@ -2,8 +2,6 @@
 
 import subprocess
 import itertools
-import boto.ec2
-from boto.exception import EC2ResponseError
 
 def convert_str(inStr):
   """
@@ -24,6 +22,9 @@ def touchImage(region="", imageId="",
   flag.  This allows us to check whether all the conditions 
   required to use the image are satisfied.
   """
+  # boto is only imported when it is needed, see cli.py
+  import boto.ec2
+  from boto.exception import EC2ResponseError
 
   try: 
     ec2_conn = boto.ec2.connect_to_region(region)